@@ -5,13 +5,18 @@ Backend Flask que sirve datos del dashboard desde PostgreSQL
 Ejecutar: python api_server.py
 """
 
-from flask import Flask, jsonify, request
+from flask import Flask, jsonify, request, send_file
 from flask_cors import CORS
 from datetime import datetime, timedelta
 import json
+import os
+import re
 
 # Importar configuración de BD
 from db_config import get_connection
+import raster_archive
+import map_store
+import map_tiles
 
 app = Flask(__name__)
 CORS(app)  # Permitir requests desde el dashboard
@@ -37,6 +42,12 @@ def home():
             '/api/ndvi',
             '/api/ndvi/history',
             '/api/ndvi/daily',
+            '/api/zones',
+            '/api/zones/history',
+            '/api/pixels/timeseries',
+            '/api/maps',
+            '/api/maps/tiles/<blob>/<z>/<x>/<y>.webp',
+            '/api/climate/history',
             '/api/forecast',
             '/api/stats',
             '/api/soil/weather/correlation'
@@ -200,7 +211,7 @@ def get_ndvi():
             SELECT timestamp, image_date, ndvi_mean, ndvi_min, ndvi_max,
                    ndvi_std, ndwi_mean, cloud_coverage, ndsi_mean, ndsi_interpretation
             FROM ndvi_data
-            ORDER BY timestamp DESC
+            ORDER BY image_date DESC NULLS LAST, timestamp DESC
             LIMIT 1
         """)
         row = cur.fetchone()
@@ -259,6 +270,73 @@ def get_ndvi_history():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/climate/history')
+def get_climate_history():
+    """
+    Clima diario histórico (ERA5-Land) de una finca
+
+    Parámetros: polygon_id, start/end (YYYY-MM-DD) o days (por defecto 365),
+    period = day | week | month (agregado en la BD; precipitación sumada)
+    """
+    polygon_id = request.args.get('polygon_id', 'los_valles_veraguas')
+    period = request.args.get('period', 'day')
+    if period not in ('day', 'week', 'month'):
+        return jsonify({'error': 'period debe ser day, week o month'}), 400
+    days = request.args.get('days', 365, type=int)
+    try:
+        end = datetime.strptime(request.args['end'], '%Y-%m-%d').date() \
+            if request.args.get('end') else datetime.now().date()
+        start = datetime.strptime(request.args['start'], '%Y-%m-%d').date() \
+            if request.args.get('start') else end - timedelta(days=days)
+    except ValueError:
+        return jsonify({'error': 'start/end deben ser YYYY-MM-DD'}), 400
+    
+    conn = get_connection()
+    if not conn:
+        return jsonify({'error': 'Database connection failed'}), 500
+    
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT date_trunc(%s, date)::date AS period_start,
+                   AVG(temp_mean_c), MIN(temp_min_c), MAX(temp_max_c),
+                   AVG(dew_point_c), AVG(humidity_percent), SUM(precipitation_mm),
+                   AVG(wind_speed_ms), AVG(soil_temp_c), AVG(soil_moisture),
+                   COUNT(*)
+            FROM climate_daily
+            WHERE polygon_id = %s
+              AND date BETWEEN %s AND %s
+            GROUP BY period_start
+            ORDER BY period_start
+        """, (period, polygon_id, start, end))
+        
+        rows = cur.fetchall()
+        cur.close()
+        conn.close()
+        
+        def number(value, digits=2):
+            return round(float(value), digits) if value is not None else None
+        
+        data = [{
+            'date': row[0].isoformat(),
+            'temp_mean_c': number(row[1]),
+            'temp_min_c': number(row[2]),
+            'temp_max_c': number(row[3]),
+            'dew_point_c': number(row[4]),
+            'humidity_percent': number(row[5]),
+            'precipitation_mm': number(row[6]),
+            'wind_speed_ms': number(row[7]),
+            'soil_temp_c': number(row[8]),
+            'soil_moisture': number(row[9], 4),
+            'days': row[10]
+        } for row in rows]
+        
+        return jsonify({'count': len(data), 'polygon_id': polygon_id, 'period': period,
+                        'source': 'ERA5-Land', 'data': data})
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/forecast')
 def get_forecast():
     """Obtiene el pronóstico más reciente"""
@@ -419,6 +497,216 @@ def get_ndvi_daily():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/zones')
+def get_zones():
+    """Obtiene las últimas estadísticas por zona de cultivo"""
+    polygon_id = request.args.get('polygon_id', 'los_valles_veraguas')
+    
+    conn = get_connection()
+    if not conn:
+        return jsonify({'error': 'Database connection failed'}), 500
+    
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT DISTINCT ON (zone, index_name)
+                zone, index_name, image_date, mean, min, max, std, p25, p50, p75, valid_fraction
+            FROM zone_stats
+            WHERE polygon_id = %s
+            ORDER BY zone, index_name, image_date DESC
+        """, (polygon_id,))
+        
+        rows = cur.fetchall()
+        cur.close()
+        conn.close()
+        
+        zones = {}
+        for row in rows:
+            zones.setdefault(row[0], {})[row[1]] = {
+                'image_date': row[2].isoformat() if row[2] else None,
+                'mean': float(row[3]) if row[3] is not None else None,
+                'min': float(row[4]) if row[4] is not None else None,
+                'max': float(row[5]) if row[5] is not None else None,
+                'std': float(row[6]) if row[6] is not None else None,
+                'p25': float(row[7]) if row[7] is not None else None,
+                'p50': float(row[8]) if row[8] is not None else None,
+                'p75': float(row[9]) if row[9] is not None else None,
+                'valid_fraction': float(row[10]) if row[10] is not None else None
+            }
+        
+        if zones:
+            return jsonify({'polygon_id': polygon_id, 'zones': zones})
+        return jsonify({'message': 'No data available'}), 404
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/zones/history')
+def get_zones_history():
+    """Obtiene el historial de un índice por zona de cultivo"""
+    polygon_id = request.args.get('polygon_id', 'los_valles_veraguas')
+    index_name = request.args.get('index', 'ndvi')
+    zone = request.args.get('zone')
+    days = request.args.get('days', 90, type=int)
+    
+    conn = get_connection()
+    if not conn:
+        return jsonify({'error': 'Database connection failed'}), 500
+    
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT zone, image_date, mean, std, p25, p50, p75
+            FROM zone_stats
+            WHERE polygon_id = %s
+              AND index_name = %s
+              AND (%s IS NULL OR zone = %s)
+              AND image_date > NOW() - INTERVAL '%s days'
+            ORDER BY image_date DESC, zone
+        """, (polygon_id, index_name, zone, zone, days))
+        
+        rows = cur.fetchall()
+        cur.close()
+        conn.close()
+        
+        data = [{
+            'zone': row[0],
+            'image_date': row[1].isoformat(),
+            'mean': float(row[2]) if row[2] is not None else None,
+            'std': float(row[3]) if row[3] is not None else None,
+            'p25': float(row[4]) if row[4] is not None else None,
+            'p50': float(row[5]) if row[5] is not None else None,
+            'p75': float(row[6]) if row[6] is not None else None
+        } for row in rows]
+        
+        return jsonify({'count': len(data), 'index': index_name, 'data': data})
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/pixels/timeseries', methods=['GET', 'POST'])
+def get_pixel_timeseries():
+    """
+    Serie temporal de índices desde el archivo local de rasters
+
+    GET  ?lon=&lat=[&radius=]   píxel (radius=0) o ventana de (2r+1)^2 píxeles
+    POST {"geometry": {...}}    polígono GeoJSON dibujado en el mapa
+    Parámetros comunes: polygon_id, indices (por defecto ndvi,ndwi)
+
+    Solo responde donde corre el colector: el archivo (archive/) no se sube
+    al repo, así que en un servidor sin él se responde 503.
+    """
+    if not raster_archive.available():
+        return jsonify({
+            'error': 'El archivo de rasters no está disponible en este servidor',
+            'detail': 'archive/ solo existe donde corre el colector (caché de GitHub Actions)'
+        }), 503
+    
+    body = request.get_json(silent=True) or {}
+    polygon_id = body.get('polygon_id') or request.args.get('polygon_id', 'los_valles_veraguas')
+    indices = body.get('indices') or request.args.get('indices', 'ndvi,ndwi').split(',')
+    indices = [index for index in indices if index in raster_archive.LAYERS]
+    if not indices:
+        return jsonify({'error': f'indices debe incluir alguno de {list(raster_archive.LAYERS)}'}), 400
+    
+    try:
+        stack = raster_archive.open_stack(polygon_id)
+        if not stack or not stack.get('bbox'):
+            return jsonify({'message': 'No archived rasters available'}), 404
+        
+        geometry = body.get('geometry')
+        region = None
+        if geometry:
+            if geometry.get('type') == 'Feature':
+                geometry = geometry['geometry']
+            rows, cols, region = raster_archive.geometry_window(stack, geometry)
+            if region is None:
+                return jsonify({'error': 'El polígono no cubre ningún píxel del raster'}), 400
+            query = {'type': 'polygon', 'pixels': int(region.sum())}
+        else:
+            lon = body.get('lon', request.args.get('lon', type=float))
+            lat = body.get('lat', request.args.get('lat', type=float))
+            radius = int(body.get('radius', request.args.get('radius', 0, type=int)))
+            if lon is None or lat is None:
+                return jsonify({'error': 'Se requiere lon/lat o una geometría'}), 400
+            pixel = raster_archive.lonlat_to_pixel(stack, float(lon), float(lat))
+            if pixel is None:
+                return jsonify({'error': 'El punto cae fuera del raster'}), 400
+            radius = max(0, min(radius, 50))
+            rows = (pixel[0] - radius, pixel[0] + radius + 1)
+            cols = (pixel[1] - radius, pixel[1] + radius + 1)
+            query = {'type': 'pixel' if radius == 0 else 'window',
+                     'row': pixel[0], 'col': pixel[1], 'radius': radius}
+        
+        data = raster_archive.region_series(stack, indices, rows, cols, region)
+        return jsonify({
+            'polygon_id': polygon_id,
+            'query': query,
+            'indices': indices,
+            'count': len(data),
+            'data': data
+        })
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/maps')
+def get_maps():
+    """Lista los mapas guardados con su pirámide de teselas"""
+    polygon_id = request.args.get('polygon_id')
+    map_type = request.args.get('type')
+    limit = request.args.get('limit', 30, type=int)
+    
+    try:
+        entries = sorted(map_store.load_manifest()['maps'].items(), reverse=True)
+        data = []
+        for name, entry in entries:
+            if polygon_id and entry.get('polygon_id', 'los_valles_veraguas') != polygon_id:
+                continue
+            if map_type and entry.get('map_type') != map_type:
+                continue
+            pyramid = map_tiles.load_pyramid(entry['blob'])
+            data.append({
+                'name': name,
+                'blob': entry['blob'],
+                'date': entry.get('date'),
+                'bytes': entry['bytes'],
+                'pyramid': pyramid,
+                'tiles_url': f"/api/maps/tiles/{entry['blob']}/{{z}}/{{x}}/{{y}}.webp" if pyramid else None,
+                'full_url': f"/api/maps/tiles/{entry['blob']}/full.webp" if pyramid else None
+            })
+            if len(data) >= limit:
+                break
+        
+        return jsonify({'count': len(data), 'data': data})
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# Las URLs de teselas cuelgan del hash del contenido: nunca cambian
+IMMUTABLE_CACHE = 'public, max-age=31536000, immutable'
+BLOB_DIGEST = re.compile(r'^[0-9a-f]{64}$')
+
+def _send_derivative(blob, path, fmt):
+    """Envía un derivado de mapa con cabeceras de caché inmutable"""
+    if not BLOB_DIGEST.match(blob) or fmt not in map_tiles.MIME_TYPES:
+        return jsonify({'error': 'Invalid tile request'}), 400
+    if not os.path.isfile(path):
+        return jsonify({'message': 'Tile not found'}), 404
+    response = send_file(os.path.abspath(path), mimetype=map_tiles.MIME_TYPES[fmt])
+    response.headers['Cache-Control'] = IMMUTABLE_CACHE
+    return response
+
+@app.route('/api/maps/tiles/<blob>/<int:z>/<int:x>/<int:y>.<fmt>')
+def get_map_tile(blob, z, x, y, fmt):
+    """Tesela de la pirámide de un mapa"""
+    return _send_derivative(blob, map_tiles.tile_path(blob, z, x, y, fmt), fmt)
+
+@app.route('/api/maps/tiles/<blob>/full.<fmt>')
+def get_map_full(blob, fmt):
+    """Imagen completa comprimida de un mapa"""
+    return _send_derivative(blob, os.path.join(map_tiles.pyramid_dir(blob), f"full.{fmt}"), fmt)
+
 @app.route('/api/soil/weather/correlation')
 def get_soil_weather_correlation():
     """Obtiene correlación entre humedad del suelo y temperatura del clima"""
@@ -646,6 +934,12 @@ if __name__ == '__main__':
     print("    GET /api/ndvi                 - NDVI actual")
     print("    GET /api/ndvi/history         - Historial NDVI")
     print("    GET /api/ndvi/daily           - Estadísticas diarias NDVI")
+    print("    GET /api/zones                - Índices por zona de cultivo")
+    print("    GET /api/zones/history        - Historial por zona de cultivo")
+    print("    GET /api/pixels/timeseries    - Serie temporal por píxel/ventana/polígono")
+    print("    GET /api/maps                 - Mapas satelitales y sus teselas")
+    print("    GET /api/maps/tiles/...       - Teselas WebP (caché inmutable)")
+    print("    GET /api/climate/history      - Clima diario histórico ERA5-Land")
     print("    GET /api/forecast             - Pronóstico 5 días")
     print("    GET /api/stats                - Estadísticas")
     print("    GET /api/soil/weather/correlation - Correlación suelo-clima")
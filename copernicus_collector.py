@@ -7,15 +7,20 @@ Usa APIs de Copernicus/ESA para datos climáticos y satelitales profesionales:
 - Statistical API: Estadísticas zonales
 
 IMPORTANTE: Sistema de gestión de cuota incluido
-- Límite mensual: 10,000 Processing Units y 10,000 Requests
+- Límite mensual: 30,000 Processing Units y 30,000 Requests (QUOTA_MONTHLY_LIMIT_*)
 - El sistema rastrea el uso y previene exceder el límite
 """
 
 import os
 import math
 import json
+import time
+import tempfile
+import threading
 import cdsapi
-from datetime import datetime, timedelta
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timedelta, timezone
 from sentinelhub import (
     SHConfig, 
     BBox, 
@@ -23,12 +28,28 @@ from sentinelhub import (
     DataCollection,
     SentinelHubRequest,
     SentinelHubStatistical,
+    SentinelHubSession,
+    SentinelHubDownloadClient,
+    SentinelHubCatalog,
+    Geometry,
     MimeType,
     bbox_to_dimensions
 )
 import db_config
-import csv
+import db_writer
+import spool
+import sentinel_cache
+import raster_stats
+import zone_masks
+import map_render
+import map_store
+import map_tiles
+import quota_ledger
+import raster_archive
+import history_store
+import era5_climate
 import requests
+from requests.adapters import HTTPAdapter
 
 # ============================================================
 # CÁLCULO DE PUNTO DE ROCÍO
@@ -71,60 +92,144 @@ OWM_API_KEY = os.environ.get("OWM_API_KEY", "ca45f79113069e3524b4877bebe6e0dd")
 OWM_URL = "https://api.openweathermap.org/data/2.5/weather"
 
 # ============================================================
-# GESTIÓN DE CUOTA
+# CLIENTE HTTP COMPARTIDO (APIs REST)
 # ============================================================
 
-QUOTA_FILE = os.path.join(os.path.dirname(__file__), 'quota_tracker.json')
+HTTP_TIMEOUT = 10           # Segundos máximos por intento
+HTTP_MAX_RETRIES = 3        # Reintentos ante errores transitorios
+HTTP_BACKOFF_BASE = 0.5     # Segundos de espera inicial, se duplica en cada reintento
+HTTP_RUN_BUDGET = float(os.environ.get('HTTP_RUN_BUDGET', 60))  # Segundos por ejecución
+HTTP_RETRY_STATUS = {429, 500, 502, 503, 504}
+
+_http_session = None
+_http_lock = threading.Lock()
+_http_deadline = None
+
+def get_http_session():
+    """Sesión HTTP compartida con pool de conexiones keep-alive"""
+    global _http_session
+    with _http_lock:
+        if _http_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=COLLECTOR_MAX_WORKERS)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _http_session = session
+        return _http_session
+
+def start_http_budget(seconds=None):
+    """
+    Inicia el presupuesto de tiempo HTTP de una ejecución
+    
+    Todas las llamadas (incluidos reintentos) comparten el mismo límite,
+    de modo que una API lenta no puede alargar la ejecución indefinidamente.
+    Con seconds=0 se desactiva el límite.
+    """
+    global _http_deadline
+    if seconds is None:
+        seconds = HTTP_RUN_BUDGET
+    _http_deadline = time.monotonic() + seconds if seconds else None
+
+def _http_remaining():
+    """Segundos restantes del presupuesto (None si no hay límite)"""
+    if _http_deadline is None:
+        return None
+    return _http_deadline - time.monotonic()
+
+def http_get_json(url, params=None):
+    """
+    GET con reintentos y backoff exponencial acotado
+    
+    Reintenta errores de conexión, timeouts y respuestas 429/5xx. Nunca
+    espera más allá del presupuesto de la ejecución.
+    
+    Returns:
+        dict: Respuesta JSON decodificada
+    """
+    session = get_http_session()
+    error = None
+    
+    for attempt in range(HTTP_MAX_RETRIES + 1):
+        remaining = _http_remaining()
+        if remaining is not None and remaining <= 0:
+            raise TimeoutError(f"Presupuesto HTTP agotado ({error or 'sin respuesta'})")
+        timeout = HTTP_TIMEOUT if remaining is None else min(HTTP_TIMEOUT, remaining)
+        
+        try:
+            response = session.get(url, params=params, timeout=timeout)
+            if response.status_code not in HTTP_RETRY_STATUS:
+                response.raise_for_status()
+                return response.json()
+            error = requests.HTTPError(f"HTTP {response.status_code}", response=response)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = e
+        
+        if attempt == HTTP_MAX_RETRIES:
+            break
+        
+        delay = HTTP_BACKOFF_BASE * (2 ** attempt)
+        remaining = _http_remaining()
+        if remaining is not None and delay >= remaining:
+            break
+        print(f"[HTTP] Reintento {attempt + 1}/{HTTP_MAX_RETRIES} en {delay:.1f}s: {error}")
+        time.sleep(delay)
+    
+    raise error
+
+# ============================================================
+# GESTIÓN DE CUOTA
+# ============================================================
 
-# Estimación de Processing Units por operación
+# Estimación inicial de Processing Units por operación; se usa hasta que
+# el modelo de costo tenga mediciones reales (ver estimate_pu)
 PU_COSTS = {
     'map_rgb': 50,      # Mapa RGB
-    'map_ndvi': 50,     # Mapa NDVI coloreado
     'ndvi': 30,         # Valor NDVI
     'ndwi': 30,         # Valor NDWI
     'ndsi': 30,         # Valor NDSI
+    'spectral_indices': 40,  # NDVI + NDWI + NDSI en una solicitud (4 bandas)
     'zonal_stats': 40,  # Estadísticas zonales
 }
 
-def load_quota():
-    """Carga el estado actual de la cuota"""
-    if os.path.exists(QUOTA_FILE):
-        with open(QUOTA_FILE, 'r') as f:
-            quota = json.load(f)
-            
-        # Reset si es un nuevo mes
-        current_month = datetime.now().strftime('%Y-%m')
-        if quota.get('current_month') != current_month:
-            quota['current_month'] = current_month
-            quota['processing_units_used'] = 0
-            quota['requests_used'] = 0
-            quota['collections_today'] = 0
-            save_quota(quota)
-            print(f"[QUOTA] Nuevo mes detectado - cuota reseteada")
-            
-        return quota
-    else:
-        # Crear archivo por defecto
-        quota = {
-            "monthly_limit_pu": 10000,
-            "monthly_limit_requests": 10000,
-            "current_month": datetime.now().strftime('%Y-%m'),
-            "processing_units_used": 0,
-            "requests_used": 0,
-            "last_updated": datetime.now().isoformat(),
-            "daily_budget_pu": 300,
-            "daily_budget_requests": 300,
-            "collections_today": 0,
-            "last_collection_date": None
-        }
-        save_quota(quota)
-        return quota
+# Cabecera con la que Sentinel Hub informa las PU cobradas por solicitud
+PU_SPENT_HEADER = 'x-processingunits-spent'
+
+def request_shape(operation_type, sizes):
+    """Forma de una solicitud para el modelo de costo: 'operación:anchoxalto'"""
+    return f"{operation_type}:" + '+'.join(f"{w}x{h}" for w, h in sizes)
+
+def estimate_pu(operation_type, size=None):
+    """
+    Costo esperado de una operación según las PU medidas
+    
+    Usa el promedio de la forma exacta si se conoce el tamaño; si no, el
+    promedio de todas las formas medidas de la operación ponderado por
+    muestras; y si aún no hay mediciones, la estimación fija de PU_COSTS.
+    """
+    model = quota_ledger.cost_model()
+    if size is not None:
+        entry = model.get(request_shape(operation_type, [size]))
+        if entry:
+            return round(entry['avg_pu'], 2)
+    
+    prefix = f"{operation_type}:"
+    measured = [entry for shape, entry in model.items() if shape.startswith(prefix)]
+    samples = sum(entry['samples'] for entry in measured)
+    if samples:
+        return round(sum(entry['avg_pu'] * entry['samples'] for entry in measured) / samples, 2)
+    return PU_COSTS.get(operation_type, 30)
 
-def save_quota(quota):
-    """Guarda el estado de la cuota"""
-    quota['last_updated'] = datetime.now().isoformat()
-    with open(QUOTA_FILE, 'w') as f:
-        json.dump(quota, f, indent=4)
+def estimate_mode_pu(mode, groups=None):
+    """Costo esperado de una recolección completa en el modo indicado (por defecto, una finca)"""
+    return sum(
+        estimate_pu(task[1])
+        for group in groups or [None]
+        for task in _build_sentinel_tasks(mode, group)
+    )
+
+def load_quota():
+    """Carga el estado actual de la cuota (libro en BD o quota_tracker.json)"""
+    return quota_ledger.load()
 
 def check_quota(operation_type='general', pu_cost=50):
     """
@@ -134,9 +239,7 @@ def check_quota(operation_type='general', pu_cost=50):
         bool: True si hay cuota disponible, False si no
     """
     quota = load_quota()
-    
-    remaining_pu = quota['monthly_limit_pu'] - quota['processing_units_used']
-    remaining_req = quota['monthly_limit_requests'] - quota['requests_used']
+    remaining_pu, remaining_req = quota_ledger.remaining(quota)
     
     if remaining_pu < pu_cost:
         print(f"[QUOTA] ⚠️ Sin cuota de PU suficiente. Restante: {remaining_pu}/{quota['monthly_limit_pu']}")
@@ -148,35 +251,57 @@ def check_quota(operation_type='general', pu_cost=50):
     
     return True
 
-def use_quota(operation_type, pu_cost=None):
-    """Registra el uso de cuota después de una operación exitosa"""
-    quota = load_quota()
+def _print_quota_usage(pu_cost, quota):
+    remaining_pu, _ = quota_ledger.remaining(quota)
+    print(f"[QUOTA] Usado: {pu_cost} PU | Total mes: {quota['processing_units_used']}/{quota['monthly_limit_pu']} | Restante: {remaining_pu}")
+
+def reserve_quota(operation_type, pu_cost=None):
+    """
+    Reserva cuota antes de una solicitud
     
+    Returns:
+        dict: Reserva a liquidar con settle_quota/release_quota, o None si no hay cuota
+    """
     if pu_cost is None:
-        pu_cost = PU_COSTS.get(operation_type, 30)
-    
-    quota['processing_units_used'] += pu_cost
-    quota['requests_used'] += 1
-    
-    # Actualizar contador diario
-    today = datetime.now().strftime('%Y-%m-%d')
-    if quota.get('last_collection_date') != today:
-        quota['collections_today'] = 1
-        quota['last_collection_date'] = today
-    else:
-        quota['collections_today'] += 1
+        pu_cost = estimate_pu(operation_type)
+    if not check_quota(operation_type, pu_cost):
+        return None
+    reservation = quota_ledger.reserve(operation_type, pu_cost)
+    if reservation is None:
+        print(f"[QUOTA] ⚠️ No se pudo reservar {pu_cost} PU para {operation_type}")
+    return reservation
+
+def settle_quota(reservation, pu_cost=None, samples=None, shares=None, requests=1):
+    """
+    Liquida una reserva tras una operación exitosa
     
-    save_quota(quota)
+    Args:
+        pu_cost: PU reales reportadas por Sentinel Hub (None = lo reservado)
+        samples: [(forma, PU)] por solicitud, para actualizar el modelo de costo
+        shares: {polygon_id: fracción} para el consumo por finca
+        requests: Solicitudes hechas (una por tesela en AOIs grandes)
+    """
+    quota = quota_ledger.settle(reservation, pu_cost, samples, shares, requests)
+    _print_quota_usage(reservation['pu'] if pu_cost is None else pu_cost, quota)
+
+def release_quota(reservation):
+    """Libera una reserva que no consumió cuota"""
+    quota_ledger.release(reservation)
+
+def use_quota(operation_type, pu_cost=None):
+    """Registra el uso de cuota después de una operación exitosa"""
+    if pu_cost is None:
+        pu_cost = estimate_pu(operation_type)
     
-    remaining_pu = quota['monthly_limit_pu'] - quota['processing_units_used']
-    print(f"[QUOTA] Usado: {pu_cost} PU | Total mes: {quota['processing_units_used']}/{quota['monthly_limit_pu']} | Restante: {remaining_pu}")
+    quota = quota_ledger.record(operation_type, pu_cost)
+    if quota:
+        _print_quota_usage(pu_cost, quota)
 
 def get_quota_status():
     """Retorna el estado actual de la cuota"""
     quota = load_quota()
     
-    remaining_pu = quota['monthly_limit_pu'] - quota['processing_units_used']
-    remaining_req = quota['monthly_limit_requests'] - quota['requests_used']
+    remaining_pu, remaining_req = quota_ledger.remaining(quota)
     percent_used = (quota['processing_units_used'] / quota['monthly_limit_pu']) * 100
     
     # Calcular días restantes del mes
@@ -190,8 +315,14 @@ def get_quota_status():
     # Calcular presupuesto diario recomendado
     safe_daily_pu = remaining_pu // max(days_remaining, 1) if days_remaining > 0 else 0
     
+    # Proyección del mes con el ritmo de gasto real y el costo medido por modo
+    avg_daily_pu = quota['processing_units_used'] / today.day
+    projected_month_pu = quota['processing_units_used'] + avg_daily_pu * days_remaining
+    mode_costs = {mode: estimate_mode_pu(mode) for mode in MODE_LADDER}
+    
     return {
         'pu_used': quota['processing_units_used'],
+        'pu_reserved': quota['processing_units_reserved'],
         'pu_remaining': remaining_pu,
         'pu_limit': quota['monthly_limit_pu'],
         'requests_used': quota['requests_used'],
@@ -199,6 +330,11 @@ def get_quota_status():
         'percent_used': percent_used,
         'days_remaining': days_remaining,
         'safe_daily_pu': safe_daily_pu,
+        'avg_daily_pu': avg_daily_pu,
+        'projected_month_pu': projected_month_pu,
+        'mode_costs': mode_costs,
+        'cost_model': quota_ledger.cost_model(),
+        'farm_usage': quota_ledger.farm_usage(),
         'collections_today': quota.get('collections_today', 0)
     }
 
@@ -215,6 +351,13 @@ def print_quota_status():
     print(f"  Dias del mes:     {status['days_remaining']} restantes")
     print(f"  Presupuesto/dia:  ~{status['safe_daily_pu']} PU recomendado")
     print(f"  Colecciones hoy:  {status['collections_today']}")
+    print(f"  Gasto medio/dia:  {status['avg_daily_pu']:.1f} PU -> proyección mes {status['projected_month_pu']:,.0f} PU")
+    print("  Costo por modo:   " + " | ".join(
+        f"{mode} ~{cost:.0f} PU" for mode, cost in status['mode_costs'].items()))
+    if len(status['farm_usage']) > 1:
+        print("  Consumo por finca:")
+        for polygon_id, usage in sorted(status['farm_usage'].items(), key=lambda item: -item[1]['pu']):
+            print(f"    {polygon_id:<28} {usage['pu']:8.1f} PU")
     
     # Barra de progreso visual
     bar_length = 40
@@ -279,16 +422,478 @@ FARM_COORDS = {
     }
 }
 
-# Cargar configuración para Copernicus Data Space
+# ============================================================
+# FINCAS (POLÍGONOS) Y AGRUPACIÓN DE SOLICITUDES
+# ============================================================
+
+POLYGON_CONFIG_FILE = os.path.join(os.path.dirname(__file__), 'polygon_config.json')
+DEFAULT_POLYGON_ID = 'los_valles_veraguas'
+
+# Fincas cuyo bbox combinado cabe en este lado se piden en una sola solicitud
+# Sentinel. A 10 m/píxel, 5 km son ~500 píxeles: una solicitud de hasta
+# 512x512 cuesta lo mismo que la de una finca pequeña
+FARM_GROUP_MAX_KM = float(os.environ.get('FARM_GROUP_MAX_KM', 5))
+
+# Hilos máximos de una ejecución (fincas x fuentes)
+COLLECTOR_MAX_WORKERS = int(os.environ.get('COLLECTOR_MAX_WORKERS', 8))
+
+# Lado máximo (px) de una solicitud Process API; un AOI mayor se pide por
+# teselas de a lo sumo este tamaño
+SENTINEL_MAX_TILE_PX = int(os.environ.get('SENTINEL_MAX_TILE_PX', 2500))
+
+# Teselas en vuelo a la vez: acota la memoria pico de un AOI grande
+SENTINEL_TILE_WORKERS = int(os.environ.get('SENTINEL_TILE_WORKERS', 4))
+
+# Si se define, los rasters de un AOI por teselas se escriben a disco (.npy
+# mapeados en memoria) para zonas, mapas y archivo; vacío = solo estadísticas
+SENTINEL_MOSAIC_DIR = os.environ.get('SENTINEL_MOSAIC_DIR', '')
+
+def _bbox_polygon(bbox):
+    min_lon, min_lat, max_lon, max_lat = bbox
+    return {
+        "type": "Polygon",
+        "coordinates": [[
+            [min_lon, min_lat], [min_lon, max_lat], [max_lon, max_lat],
+            [max_lon, min_lat], [min_lon, min_lat]
+        ]]
+    }
+
+def _make_farm(entry):
+    """Normaliza una entrada de 'polygons' al formato de FARM_COORDS"""
+    bbox = [float(v) for v in entry['bbox']]
+    return {
+        'id': entry['id'],
+        'nombre': entry.get('nombre', entry['id']),
+        'lat': entry.get('lat', (bbox[1] + bbox[3]) / 2),
+        'lon': entry.get('lon', (bbox[0] + bbox[2]) / 2),
+        'bbox': bbox,
+        'polygon': entry.get('polygon') or _bbox_polygon(bbox),
+        # Solo zonas levantadas en campo; las marcadas 'placeholder' (borradores
+        # sin medir) no llegan a zone_stats ni a la API
+        'zonas': [zone for zone in entry.get('zonas', []) if not zone.get('placeholder')]
+    }
+
+def _default_farm():
+    return dict(FARM_COORDS, id=DEFAULT_POLYGON_ID, nombre='los valles')
+
+def load_farms():
+    """
+    Lista de fincas a monitorear desde polygon_config.json ('polygons')
+    
+    Sin lista configurada se monitorea solo la finca de FARM_COORDS.
+    """
+    try:
+        with open(POLYGON_CONFIG_FILE, 'r', encoding='utf-8') as f:
+            entries = json.load(f).get('polygons') or []
+        farms = [_make_farm(entry) for entry in entries]
+    except Exception as e:
+        print(f"[WARN] No se pudo leer la lista de polígonos: {e}")
+        farms = []
+    return farms or [_default_farm()]
+
+def _bbox_extent_km(bbox):
+    """Ancho y alto aproximados de un bbox WGS84 en km"""
+    km_per_deg_lat = 111.32
+    km_per_deg_lon = km_per_deg_lat * math.cos(math.radians((bbox[1] + bbox[3]) / 2))
+    return (bbox[2] - bbox[0]) * km_per_deg_lon, (bbox[3] - bbox[1]) * km_per_deg_lat
+
+def _bbox_union(a, b):
+    return [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+
+def _bbox_area(bbox):
+    return (bbox[2] - bbox[0]) * (bbox[3] - bbox[1])
+
+def make_farm_group(farms):
+    """Grupo de fincas que comparten las solicitudes Sentinel sobre su bbox combinado"""
+    bbox = farms[0]['bbox']
+    for farm in farms[1:]:
+        bbox = _bbox_union(bbox, farm['bbox'])
+    return {
+        'id': farms[0]['id'] if len(farms) == 1 else f"{farms[0]['id']}+{len(farms) - 1}",
+        'bbox': bbox,
+        'farms': farms
+    }
+
+def group_farms(farms, max_km=None):
+    """
+    Agrupa fincas cercanas (avance voraz de oeste a este)
+    
+    Cada finca se agrega al primer grupo cuyo bbox combinado siga dentro de
+    max_km de lado; si no cabe en ninguno, abre un grupo nuevo.
+    """
+    if max_km is None:
+        max_km = FARM_GROUP_MAX_KM
+    
+    groups = []
+    for farm in sorted(farms, key=lambda item: item['bbox'][0]):
+        for members in groups:
+            bbox = _bbox_union(make_farm_group(members)['bbox'], farm['bbox'])
+            if max(_bbox_extent_km(bbox)) <= max_km:
+                members.append(farm)
+                break
+        else:
+            groups.append([farm])
+    return [make_farm_group(members) for members in groups]
+
+def farm_shares(group):
+    """Fracción del costo de una solicitud de grupo que corresponde a cada finca (por área)"""
+    areas = {farm['id']: _bbox_area(farm['bbox']) for farm in group['farms']}
+    total = sum(areas.values()) or 1
+    return {farm_id: area / total for farm_id, area in areas.items()}
+
+def _bbox_window(outer_bbox, shape, inner_bbox):
+    """Ventana (fila0, fila1, col0, col1) de inner_bbox en un raster (alto, ancho) sobre outer_bbox"""
+    height, width = shape
+    if list(outer_bbox) == list(inner_bbox):
+        return 0, height, 0, width
+    lon_span = outer_bbox[2] - outer_bbox[0]
+    lat_span = outer_bbox[3] - outer_bbox[1]
+    col_start = int(math.floor((inner_bbox[0] - outer_bbox[0]) / lon_span * width))
+    col_end = int(math.ceil((inner_bbox[2] - outer_bbox[0]) / lon_span * width))
+    row_start = int(math.floor((outer_bbox[3] - inner_bbox[3]) / lat_span * height))
+    row_end = int(math.ceil((outer_bbox[3] - inner_bbox[1]) / lat_span * height))
+    return max(row_start, 0), min(row_end, height), max(col_start, 0), min(col_end, width)
+
+def _crop_to_bbox(array, outer_bbox, inner_bbox):
+    """Recorta de un raster sobre outer_bbox la ventana que cubre inner_bbox"""
+    row_start, row_end, col_start, col_end = _bbox_window(outer_bbox, array.shape[:2], inner_bbox)
+    return array[row_start:row_end, col_start:col_end]
+
+def split_bbox(bbox, size, max_px=None):
+    """
+    Divide un bbox en teselas de a lo sumo max_px por lado, alineadas a la
+    grilla de píxeles del bbox completo (sin huecos ni solapes)
+    
+    Args:
+        bbox: [min_lon, min_lat, max_lon, max_lat]
+        size: (ancho, alto) del raster completo
+    
+    Returns:
+        list: [{'bbox', 'size': (ancho, alto), 'window': (fila0, fila1, col0, col1)}]
+    """
+    max_px = max_px or SENTINEL_MAX_TILE_PX
+    width, height = size
+    cols = math.ceil(width / max_px)
+    rows = math.ceil(height / max_px)
+    lon_step = (bbox[2] - bbox[0]) / width
+    lat_step = (bbox[3] - bbox[1]) / height
+    
+    tiles = []
+    for i in range(rows):
+        row_start, row_end = i * height // rows, (i + 1) * height // rows
+        for j in range(cols):
+            col_start, col_end = j * width // cols, (j + 1) * width // cols
+            tiles.append({
+                'bbox': [bbox[0] + col_start * lon_step, bbox[3] - row_end * lat_step,
+                         bbox[0] + col_end * lon_step, bbox[3] - row_start * lat_step],
+                'size': (col_end - col_start, row_end - row_start),
+                'window': (row_start, row_end, col_start, col_end)
+            })
+    return tiles
+
 
 
 # DataCollection para CDSE (Copernicus Data Space Ecosystem)
 def get_cdse_sentinel2_collection():
     """Retorna la DataCollection correcta para CDSE"""
-    return DataCollection.SENTINEL2_L2A.define_from(
-        name="s2l2a_cdse",
-        service_url="https://sh.dataspace.copernicus.eu"
+    return get_sentinel_session().collection
+
+# ============================================================
+# SESIÓN SENTINEL HUB (CONFIGURACIÓN + TOKEN)
+# ============================================================
+
+# Caché del token OAuth en disco, fuera de data/ para que nunca se suba al repo
+SH_TOKEN_CACHE = os.environ.get(
+    'SH_TOKEN_CACHE',
+    os.path.join(tempfile.gettempdir(), 'agromonitor_sh_token.json')
+)
+TOKEN_EXPIRY_MARGIN = 120  # Segundos de margen antes de la expiración
+
+class _CachedTokenSession(SentinelHubSession):
+    """
+    SentinelHubSession que avisa cada token nuevo (el inicial y los que
+    sentinelhub negocia solo al acercarse la expiración) para guardarlo en
+    la caché en disco
+    """
+    
+    def __init__(self, config, on_token, **kwargs):
+        self._on_token = on_token
+        super().__init__(config=config, refresh_before_expiry=TOKEN_EXPIRY_MARGIN, **kwargs)
+    
+    def _collect_new_token(self):
+        token = super()._collect_new_token()
+        self._on_token(token)
+        return token
+
+class SentinelSession:
+    """
+    Configuración, colección y token de Sentinel Hub compartidos por el proceso
+    
+    SHConfig y la DataCollection de CDSE se construyen una sola vez. El token
+    OAuth se reutiliza hasta que expira: primero desde memoria, luego desde
+    la caché en disco (útil para procesos cron de corta vida) y solo como
+    último recurso se negocia uno nuevo con identity.dataspace.copernicus.eu.
+    Cada token negociado, también las renovaciones automáticas de
+    sentinelhub a mitad de la ejecución, se escribe de vuelta en la caché.
+    """
+    
+    def __init__(self):
+        self.config = load_sentinel_config()
+        self.collection = DataCollection.SENTINEL2_L2A.define_from(
+            name="s2l2a_cdse",
+            service_url=self.config.sh_base_url
+        )
+        self._session = None
+        self._lock = threading.Lock()
+    
+    @property
+    def configured(self):
+        return bool(self.config.sh_client_id)
+    
+    def authenticate(self):
+        """Garantiza un token vigente y lo registra para todas las solicitudes"""
+        with self._lock:
+            if self._session is not None and self._token_valid(self._session.token):
+                return
+            
+            token = self._load_cached_token()
+            if token:
+                session = _CachedTokenSession(self.config, self._save_cached_token, _token=token)
+                print("[AUTH] Token de Sentinel Hub reutilizado desde caché")
+            else:
+                session = _CachedTokenSession(self.config, self._save_cached_token)
+                print("[AUTH] Nuevo token de Sentinel Hub obtenido")
+            
+            SentinelHubDownloadClient.cache_session(session)
+            self._session = session
+    
+    @staticmethod
+    def _token_valid(token):
+        return bool(token) and token.get('expires_at', 0) - time.time() > TOKEN_EXPIRY_MARGIN
+    
+    def _load_cached_token(self):
+        """Lee el token en disco si pertenece a este cliente y sigue vigente"""
+        try:
+            with open(SH_TOKEN_CACHE, 'r') as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if cached.get('client_id') != self.config.sh_client_id:
+            return None
+        token = cached.get('token')
+        return token if self._token_valid(token) else None
+    
+    def _save_cached_token(self, token):
+        """Guarda el token en disco con permisos restringidos"""
+        try:
+            fd = os.open(SH_TOKEN_CACHE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump({
+                    'client_id': self.config.sh_client_id,
+                    'token': {
+                        'access_token': token['access_token'],
+                        'expires_at': token['expires_at']
+                    }
+                }, f)
+        except OSError as e:
+            print(f"[WARN] No se pudo guardar la caché del token: {e}")
+
+_sentinel_session = None
+_sentinel_session_lock = threading.Lock()
+
+def get_sentinel_session():
+    """Retorna la sesión Sentinel Hub del proceso (se crea en el primer uso)"""
+    global _sentinel_session
+    with _sentinel_session_lock:
+        if _sentinel_session is None:
+            _sentinel_session = SentinelSession()
+        return _sentinel_session
+
+# ============================================================
+# SOLICITUDES SENTINEL HUB (CATÁLOGO + CACHÉ POR ESCENA)
+# ============================================================
+
+def _resolve_time_interval(start_date=None, end_date=None):
+    """Normaliza el intervalo de búsqueda (por defecto los últimos 30 días)"""
+    if not end_date:
+        end_date = datetime.now()
+    if isinstance(end_date, str):
+        end_date = datetime.strptime(end_date, '%Y-%m-%d')
+    if not start_date:
+        start_date = end_date - timedelta(days=30)
+    if isinstance(start_date, str):
+        start_date = datetime.strptime(start_date, '%Y-%m-%d')
+    return start_date, end_date
+
+_acquisitions_memo = {}
+_acquisitions_lock = threading.Lock()
+
+def search_sentinel_acquisitions(start_date=None, end_date=None, bbox=None):
+    """
+    Lista las adquisiciones Sentinel-2 L2A sobre el área via Catalog API
+    
+    Una búsqueda de catálogo no consume Processing Units. El resultado se
+    memoriza por proceso para que las tareas de una misma ejecución no
+    repitan la consulta.
+    
+    Returns:
+        list: [{'id', 'datetime', 'cloud_cover'}] ordenada por fecha, o None si falla
+    """
+    start_date, end_date = _resolve_time_interval(start_date, end_date)
+    bbox = bbox or FARM_COORDS['bbox']
+    memo_key = (tuple(bbox), start_date.date(), end_date.date())
+    
+    with _acquisitions_lock:
+        if memo_key in _acquisitions_memo:
+            return _acquisitions_memo[memo_key]
+    
+    sentinel = get_sentinel_session()
+    if not sentinel.configured:
+        return None
+    
+    try:
+        sentinel.authenticate()
+        catalog = SentinelHubCatalog(config=sentinel.config)
+        search = catalog.search(
+            sentinel.collection,
+            bbox=BBox(bbox=bbox, crs=CRS.WGS84),
+            time=(start_date, end_date),
+            fields={
+                "include": ["id", "properties.datetime", "properties.eo:cloud_cover"],
+                "exclude": []
+            }
+        )
+        acquisitions = sorted(
+            (
+                {
+                    'id': feature['id'],
+                    'datetime': feature['properties']['datetime'],
+                    'cloud_cover': feature['properties'].get('eo:cloud_cover')
+                }
+                for feature in search
+            ),
+            key=lambda item: item['datetime']
+        )
+    except Exception as e:
+        print(f"[WARN] Catalog API: {e}")
+        return None
+    
+    with _acquisitions_lock:
+        _acquisitions_memo[memo_key] = acquisitions
+    return acquisitions
+
+def select_mosaic_acquisition(acquisitions):
+    """
+    Escena que elige el mosaico 'leastCC': la de menor nubosidad
+    (en empate, la más reciente)
+    """
+    if not acquisitions:
+        return None
+    newest_first = sorted(acquisitions, key=lambda item: item['datetime'], reverse=True)
+    return min(
+        newest_first,
+        key=lambda item: item['cloud_cover'] if item['cloud_cover'] is not None else 100.0
+    )
+
+# Registro por hilo de las solicitudes Sentinel hechas por la tarea actual,
+# usado por el colector para no cobrar cuota cuando se sirvió desde caché
+_request_log = threading.local()
+
+def start_request_log():
+    """Empieza a registrar las solicitudes Sentinel del hilo actual"""
+    _request_log.entries = []
+
+def collect_request_log():
+    """Retorna y limpia las solicitudes registradas en el hilo actual"""
+    entries = getattr(_request_log, 'entries', None) or []
+    _request_log.entries = None
+    return entries
+
+def _log_sentinel_request(**entry):
+    entries = getattr(_request_log, 'entries', None)
+    if entries is not None:
+        entries.append(entry)
+
+def _read_pu_spent(headers):
+    """PU cobradas según la cabecera de la respuesta (None si no viene)"""
+    for name, value in (headers or {}).items():
+        if name.lower() == PU_SPENT_HEADER:
+            try:
+                return float(value)
+            except (TypeError, ValueError):
+                return None
+    return None
+
+def _execute_sentinel_request(evalscript, responses, start_date, end_date, size, bbox=None):
+    """
+    Ejecuta una solicitud Process API sobre el mosaico 'leastCC' del intervalo
+    
+    Antes de pedir datos se consulta el catálogo para saber qué escena
+    resolverá el mosaico; si esa combinación (bbox, tamaño, evalscript,
+    escena) ya está en la caché local se devuelve sin consumir PU.
+    
+    Args:
+        responses: Lista de (identificador, MimeType)
+    
+    Returns:
+        dict: {identificador: np.ndarray}
+    """
+    sentinel = get_sentinel_session()
+    bbox = bbox or FARM_COORDS['bbox']
+    
+    acquisition = select_mosaic_acquisition(
+        search_sentinel_acquisitions(start_date, end_date, bbox=bbox)
+    )
+    cache_key = None
+    if acquisition:
+        cache_key = sentinel_cache.make_key(
+            bbox, size, evalscript, acquisition['id'],
+            responses=[f"{identifier}.{mime.extension}" for identifier, mime in responses],
+            mosaicking_order='leastCC'
+        )
+        cached = sentinel_cache.get(cache_key)
+        if cached is not None:
+            print(f"[CACHE] Sin escena nueva ({acquisition['datetime'][:10]}), reutilizando datos")
+            _log_sentinel_request(cached=True, acquisition=acquisition, size=tuple(size), pu=0)
+            return cached
+    
+    sentinel.authenticate()
+    request = SentinelHubRequest(
+        evalscript=evalscript,
+        input_data=[
+            SentinelHubRequest.input_data(
+                data_collection=sentinel.collection,
+                time_interval=(start_date, end_date),
+                mosaicking_order='leastCC'  # Menor nubosidad
+            )
+        ],
+        responses=[
+            SentinelHubRequest.output_response(identifier, mime)
+            for identifier, mime in responses
+        ],
+        bbox=BBox(bbox=bbox, crs=CRS.WGS84),
+        size=size,
+        config=sentinel.config
     )
+    
+    data = request.get_data(decode_data=False)
+    if not data:
+        return None
+    
+    response = data[0]
+    pu_spent = _read_pu_spent(response.headers)
+    payload = response.decode()
+    # Con una sola salida la respuesta es el array; con varias, un dict
+    # {'<identificador>.tif': array} extraído del TAR
+    if isinstance(payload, dict):
+        payload = {name.rsplit('.', 1)[0]: array for name, array in payload.items()}
+    else:
+        payload = {responses[0][0]: payload}
+    
+    _log_sentinel_request(cached=False, acquisition=acquisition, size=tuple(size), pu=pu_spent)
+    if cache_key:
+        sentinel_cache.put(cache_key, payload)
+    return payload
 
 # ============================================================
 # MAPAS SATELITALES
@@ -309,7 +914,9 @@ function evaluatePixel(sample) {
 }
 """
 
-# Evalscript para NDVI coloreado (verde-amarillo-rojo)
+# Evalscript para NDVI coloreado (verde-amarillo-rojo). Ya no se solicita:
+# map_render aplica la misma paleta sobre el raster NDVI descargado para
+# los índices. Se conserva como referencia de los cortes y colores.
 NDVI_COLOR_EVALSCRIPT = """
 //VERSION=3
 function setup() {
@@ -342,108 +949,125 @@ function evaluatePixel(sample) {
 }
 """
 
-def get_satellite_map(map_type='rgb', start_date=None, end_date=None):
+def _store_map(png, farm_id, map_type, end_date):
     """
-    Genera un mapa satelital de la finca
+    Guarda un mapa en el almacén por contenido (map_store); el nombre es el
+    del antiguo archivo suelto (la finca original conserva el prefijo 'farm').
+    Luego genera su pirámide de teselas WebP (map_tiles), que no se repite
+    si el contenido ya existía.
+    
+    Returns:
+        Ruta del blob con el PNG
+    """
+    prefix = 'farm' if farm_id == DEFAULT_POLYGON_ID else farm_id
+    path = map_store.put(
+        f"{prefix}_{map_type}_{end_date.strftime('%Y%m%d')}", png,
+        polygon_id=farm_id, map_type=map_type, date=end_date.date().isoformat()
+    )
+    map_tiles.build_pyramid(path)
+    return path
+
+def fetch_satellite_maps(group, map_type='rgb', start_date=None, end_date=None):
+    """
+    Genera el mapa satelital de cada finca de un grupo con una sola solicitud
+    
+    El mapa NDVI se colorea localmente a partir del raster NDVI (ver
+    map_render), que es más liviano que pedir la imagen RGBA coloreada.
     
     Args:
+        group: Grupo de fincas (make_farm_group / group_farms)
         map_type: 'rgb' para True Color, 'ndvi' para NDVI coloreado
-        start_date: Fecha inicio
-        end_date: Fecha fin
     
     Returns:
-        Ruta al archivo PNG guardado
+        dict: {polygon_id: ruta al PNG guardado}
     """
-    config = load_sentinel_config()
+    if map_type == 'ndvi':
+        results = fetch_spectral_indices(group, start_date, end_date, ['ndvi'], render_maps=True)
+        if not results:
+            return None
+        return {polygon_id: result['map_ndvi'] for polygon_id, result in results.items()}
     
-    if not config.sh_client_id:
+    sentinel = get_sentinel_session()
+    
+    if not sentinel.configured:
         print("[WARN] Sentinel Hub no configurado.")
         return None
     
-    if not end_date:
-        end_date = datetime.now()
-    if not start_date:
-        start_date = end_date - timedelta(days=30)
-    
-    if isinstance(start_date, str):
-        start_date = datetime.strptime(start_date, '%Y-%m-%d')
-    if isinstance(end_date, str):
-        end_date = datetime.strptime(end_date, '%Y-%m-%d')
+    start_date, end_date = _resolve_time_interval(start_date, end_date)
     
-    print(f"[Sentinel Hub] Generando mapa {map_type.upper()}...")
+    print(f"[Sentinel Hub] Generando mapa {map_type.upper()} ({group['id']})...")
     
     try:
-        bbox = BBox(bbox=FARM_COORDS['bbox'], crs=CRS.WGS84)
+        # Resolución nativa de Sentinel-2; la ampliación para visualización
+        # se hace localmente al guardar (map_render.MAP_DISPLAY_SCALE)
+        bbox = BBox(bbox=group['bbox'], crs=CRS.WGS84)
         resolution = 10  # metros
         size = bbox_to_dimensions(bbox, resolution=resolution)
+        if max(size) > SENTINEL_MAX_TILE_PX:
+            # Un mapa es para visualizar: en un AOI grande se reduce la
+            # resolución hasta entrar en una solicitud (las teselas del
+            # dashboard salen luego de map_tiles)
+            scale = SENTINEL_MAX_TILE_PX / max(size)
+            size = tuple(max(1, int(side * scale)) for side in size)
+            print(f"[WARN] AOI grande: mapa {map_type.upper()} a {resolution / scale:.0f} m/píxel {size}")
         
-        # Aumentar resolución para mejor visualización
-        size = (size[0] * 2, size[1] * 2)
-        
-        evalscript = RGB_EVALSCRIPT if map_type == 'rgb' else NDVI_COLOR_EVALSCRIPT
-        cdse_collection = get_cdse_sentinel2_collection()
-        
-        request = SentinelHubRequest(
-            evalscript=evalscript,
-            input_data=[
-                SentinelHubRequest.input_data(
-                    data_collection=cdse_collection,
-                    time_interval=(start_date, end_date),
-                    mosaicking_order='leastCC'
-                )
-            ],
-            responses=[
-                SentinelHubRequest.output_response('default', MimeType.PNG)
-            ],
-            bbox=bbox,
-            size=size,
-            config=config
+        data = _execute_sentinel_request(
+            RGB_EVALSCRIPT, [('default', MimeType.PNG)], start_date, end_date, size,
+            bbox=group['bbox']
         )
         
-        data = request.get_data()
-        
-        if data and len(data) > 0:
-            from PIL import Image
-            import numpy as np
-            
-            img_array = data[0]
-            
-            # Guardar imagen
-            os.makedirs('data/maps', exist_ok=True)
-            output_file = f"data/maps/farm_{map_type}_{end_date.strftime('%Y%m%d')}.png"
-            
-            if img_array.shape[-1] == 4:
-                img = Image.fromarray(img_array, 'RGBA')
-            else:
-                img = Image.fromarray(img_array)
-            
-            img.save(output_file)
-            print(f"[OK] Mapa guardado: {output_file}")
-            return output_file
+        if data:
+            paths = {}
+            for farm in group['farms']:
+                img_array = _crop_to_bbox(data['default'], group['bbox'], farm['bbox'])
+                
+                # Guardar imagen ampliada para visualización
+                output_file = _store_map(
+                    map_render.encode_png(img_array), farm['id'], map_type, end_date
+                )
+                print(f"[OK] Mapa guardado: {output_file}")
+                paths[farm['id']] = output_file
+            return paths
         
     except Exception as e:
         print(f"[ERROR] Generación de mapa: {e}")
         return None
 
+def get_satellite_map(map_type='rgb', start_date=None, end_date=None, farm=None):
+    """
+    Genera un mapa satelital de la finca
+    
+    Args:
+        map_type: 'rgb' para True Color, 'ndvi' para NDVI coloreado (local)
+        start_date: Fecha inicio
+        end_date: Fecha fin
+        farm: Finca de load_farms() (por defecto, la de FARM_COORDS)
+    
+    Returns:
+        Ruta al archivo PNG guardado
+    """
+    farm = farm or _default_farm()
+    paths = fetch_satellite_maps(make_farm_group([farm]), map_type, start_date, end_date)
+    return paths.get(farm['id']) if paths else None
+
 # ============================================================
 # OPENWEATHERMAP API - CLIMA ACTUAL
 # ============================================================
 
-def get_weather_data():
+def get_weather_data(farm=None):
     """Obtiene datos del clima actual via OpenWeatherMap"""
-    print(f"\n[OpenWeather] Consultando clima actual...")
+    farm = farm or FARM_COORDS
+    print("\n[OpenWeather] Consultando clima actual...")
     try:
         params = {
-            'lat': FARM_COORDS['lat'],
-            'lon': FARM_COORDS['lon'],
+            'lat': farm['lat'],
+            'lon': farm['lon'],
             'appid': OWM_API_KEY,
             'units': 'metric',
             'lang': 'es'
         }
         
-        response = requests.get(OWM_URL, params=params, timeout=10)
-        response.raise_for_status()
-        data = response.json()
+        data = http_get_json(OWM_URL, params=params)
         
         temp = data['main']['temp']
         humidity = data['main']['humidity']
@@ -462,7 +1086,9 @@ def get_weather_data():
             'description': data['weather'][0]['description'],
             'icon': data['weather'][0]['icon'],
             'clouds': data['clouds']['all'],
-            'dew_point': dew_point
+            'dew_point': dew_point,
+            # Momento de la observación (clave natural en weather_data)
+            'observed_at': datetime.fromtimestamp(data['dt'], timezone.utc) if 'dt' in data else None
         }
         
         print(f"[OK] Clima actual: {weather['temp']}°C, {weather['description']}, Punto de rocío: {dew_point}°C")
@@ -476,25 +1102,24 @@ def get_weather_data():
 # OPEN-METEO API - DATOS DE SUELO (GRATIS)
 # ============================================================
 
-def get_soil_data():
+def get_soil_data(farm=None):
     """
     Obtiene datos de suelo via Open-Meteo API (gratis, sin API key)
     - Temperatura del suelo a 0cm y 6cm
     - Humedad del suelo a 0-1cm y 1-3cm
     """
-    print(f"\n[Open-Meteo] Consultando datos de suelo...")
+    farm = farm or FARM_COORDS
+    print("\n[Open-Meteo] Consultando datos de suelo...")
     try:
         url = "https://api.open-meteo.com/v1/forecast"
         params = {
-            'latitude': FARM_COORDS['lat'],
-            'longitude': FARM_COORDS['lon'],
+            'latitude': farm['lat'],
+            'longitude': farm['lon'],
             'current': 'soil_temperature_0cm,soil_temperature_6cm,soil_moisture_0_to_1cm,soil_moisture_1_to_3cm',
             'timezone': 'America/Panama'
         }
         
-        response = requests.get(url, params=params, timeout=10)
-        response.raise_for_status()
-        data = response.json()
+        data = http_get_json(url, params=params)
         
         current = data.get('current', {})
         
@@ -509,10 +1134,17 @@ def get_soil_data():
         soil_moisture = (moist_0 + moist_1) / 2 if moist_0 and moist_1 else moist_0 or moist_1
         soil_moisture_percent = soil_moisture * 100  # Convertir a porcentaje
         
+        # Hora local de la lectura del modelo (clave natural en soil_data)
+        observed_at = None
+        if current.get('time'):
+            offset = timezone(timedelta(seconds=data.get('utc_offset_seconds', 0)))
+            observed_at = datetime.fromisoformat(current['time']).replace(tzinfo=offset)
+        
         soil = {
             'soil_temp_c': round(soil_temp, 2),
             'soil_moisture': round(soil_moisture, 4),
-            'soil_moisture_percent': round(soil_moisture_percent, 2)
+            'soil_moisture_percent': round(soil_moisture_percent, 2),
+            'observed_at': observed_at
         }
         
         print(f"[OK] Suelo: {soil['soil_temp_c']}C, {soil['soil_moisture_percent']}% humedad")
@@ -526,439 +1158,819 @@ def get_soil_data():
 # CDS API - CLIMA HISTÓRICO
 # ============================================================
 
-def get_climate_data_cds(start_date=None, end_date=None):
+# Meses ya ingeridos: {'AAAA-MM': {'from', 'through', 'farms', ...}}
+ERA5_STATE_FILE = os.path.join(os.path.dirname(__file__), 'data', 'era5_state.json')
+
+# ERA5-Land se publica con unos días de retraso: no se piden días más nuevos
+ERA5_LATENCY_DAYS = int(os.environ.get('ERA5_LATENCY_DAYS', 6))
+
+# Meses hacia atrás que cubre la ingesta sin fechas explícitas
+ERA5_DEFAULT_MONTHS = int(os.environ.get('ERA5_DEFAULT_MONTHS', 12))
+
+# Resolución de ERA5-Land (grados): margen del área para tener celdas de tierra
+ERA5_GRID_DEG = 0.1
+ERA5_SOURCE = 'ERA5-Land'
+
+def _load_era5_state():
+    try:
+        with open(ERA5_STATE_FILE, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'months': {}}
+
+def _save_era5_state(state):
+    os.makedirs(os.path.dirname(ERA5_STATE_FILE), exist_ok=True)
+    tmp_path = f"{ERA5_STATE_FILE}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, ERA5_STATE_FILE)
+
+def era5_chunks(start_date, end_date, farms, state=None):
     """
-    Obtiene datos climáticos históricos de ERA5 via CDS API
+    Tramos mensuales (primer día, último día) que faltan por ingerir
     
-    Datos disponibles:
-    - Temperatura (2m)
-    - Precipitación total
-    - Humedad relativa
-    - Viento
+    Un mes ya ingerido para las mismas fincas solo pide los días posteriores
+    a su 'through' (el mes en curso se completa en ejecuciones siguientes).
     """
-    if not start_date:
-        start_date = (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d')
-    if not end_date:
-        end_date = datetime.now().strftime('%Y-%m-%d')
+    state = state or _load_era5_state()
+    available = datetime.now(timezone.utc).date() - timedelta(days=ERA5_LATENCY_DAYS)
+    end_date = min(end_date, available)
+    farm_ids = {farm['id'] for farm in farms}
+    
+    chunks = []
+    month = start_date.replace(day=1)
+    while month <= end_date:
+        next_month = (month + timedelta(days=32)).replace(day=1)
+        first = max(start_date, month)
+        last = min(end_date, next_month - timedelta(days=1))
+        entry = state['months'].get(month.strftime('%Y-%m'))
+        if entry and farm_ids <= set(entry['farms']) and entry['from'] <= first.isoformat():
+            first = max(first, datetime.fromisoformat(entry['through']).date() + timedelta(days=1))
+        if first <= last:
+            chunks.append((first, last))
+        month = next_month
+    return chunks
+
+def _era5_request(first, last, farms):
+    """Solicitud CDS de un tramo (días de un mismo mes, 24 horas, área de las fincas)"""
+    bbox = farms[0]['bbox']
+    for farm in farms[1:]:
+        bbox = _bbox_union(bbox, farm['bbox'])
+    return {
+        'product_type': ['reanalysis'],
+        'variable': list(era5_climate.VARIABLES),
+        'year': str(first.year),
+        'month': f"{first.month:02d}",
+        'day': [f"{day:02d}" for day in range(first.day, last.day + 1)],
+        'time': [f"{hour:02d}:00" for hour in range(24)],
+        'area': [
+            bbox[3] + ERA5_GRID_DEG,  # North
+            bbox[0] - ERA5_GRID_DEG,  # West
+            bbox[1] - ERA5_GRID_DEG,  # South
+            bbox[2] + ERA5_GRID_DEG   # East
+        ],
+        'data_format': 'netcdf',
+        'download_format': 'unarchived'
+    }
+
+def get_climate_data_cds(start_date=None, end_date=None, farms=None):
+    """
+    Ingiere clima histórico ERA5-Land (CDS API) en la tabla climate_daily
+    
+    Pide solo los tramos mensuales que faltan (era5_chunks), decodifica
+    cada NetCDF con era5_climate (serie diaria de la celda de cada finca) y
+    carga las filas por lotes vía db_writer. El NetCDF se descarta después.
+    
+    Datos por día: temperatura media/mín/máx, punto de rocío, humedad
+    relativa, precipitación, viento, temperatura y humedad del suelo.
     
-    print(f"[CDS] Solicitando datos ERA5 del {start_date} al {end_date}...")
+    Args:
+        start_date: Primer día (ISO); por defecto, ERA5_DEFAULT_MONTHS atrás
+        end_date: Último día (ISO); por defecto, el último publicado
+        farms: Fincas (por defecto, load_farms())
+    
+    Returns:
+        dict: {'chunks', 'rows', 'failed'}, o None si no hubo nada que pedir
+    """
+    farms = farms or load_farms()
+    today = datetime.now(timezone.utc).date()
+    if start_date:
+        start = datetime.fromisoformat(start_date).date()
+    else:
+        months_back = today.year * 12 + today.month - 1 - ERA5_DEFAULT_MONTHS
+        start = datetime(months_back // 12, months_back % 12 + 1, 1).date()
+    end = datetime.fromisoformat(end_date).date() if end_date else today
+    
+    state = _load_era5_state()
+    chunks = era5_chunks(start, end, farms, state)
+    if not chunks:
+        print(f"[CDS] ERA5-Land al día ({start} -> {end})")
+        return None
     
+    print(f"[CDS] Solicitando ERA5-Land: {len(chunks)} tramo(s) mensual(es), {len(farms)} finca(s)")
     try:
-        c = cdsapi.Client()
-        
-        # Definir la solicitud para ERA5-Land (resolución horaria)
-        result = c.retrieve(
-            'reanalysis-era5-land',
-            {
-                'product_type': 'reanalysis',
-                'variable': [
-                    '2m_temperature',
-                    '2m_dewpoint_temperature',
-                    'total_precipitation',
-                    '10m_u_component_of_wind',
-                    '10m_v_component_of_wind',
-                    'soil_temperature_level_1',
-                    'volumetric_soil_water_layer_1'
-                ],
-                'year': start_date[:4],
-                'month': start_date[5:7],
-                'day': [str(i).zfill(2) for i in range(1, 32)],
-                'time': ['12:00'],
-                'area': [
-                    FARM_COORDS['lat'] + 0.1,  # North
-                    FARM_COORDS['lon'] - 0.1,  # West
-                    FARM_COORDS['lat'] - 0.1,  # South
-                    FARM_COORDS['lon'] + 0.1   # East
-                ],
-                'format': 'netcdf'
-            }
-        )
-        
-        # Guardar archivo
-        output_file = f"data/era5_climate_{start_date[:7]}.nc"
-        os.makedirs('data', exist_ok=True)
-        result.download(output_file)
-        
-        print(f"[OK] Datos climáticos guardados en {output_file}")
-        return output_file
-        
+        client = cdsapi.Client()
     except Exception as e:
         print(f"[ERROR] CDS API: {e}")
         return None
+    
+    summary = {'chunks': 0, 'rows': 0, 'failed': 0}
+    db_writer.start()
+    try:
+        for first, last in chunks:
+            fd, path = tempfile.mkstemp(suffix='.nc')
+            os.close(fd)
+            try:
+                client.retrieve('reanalysis-era5-land', _era5_request(first, last, farms)).download(path)
+                rows = era5_climate.daily_series(
+                    era5_climate.read_netcdf(path), farms, first.isoformat(), last.isoformat()
+                )
+            except Exception as e:
+                print(f"[ERROR] CDS API {first} -> {last}: {e}")
+                summary['failed'] += 1
+                continue
+            finally:
+                os.remove(path)
+        
+            for row in rows:
+                db_writer.add('climate_daily', dict(row, source=ERA5_SOURCE))
+            if not flush_results():
+                summary['failed'] += 1
+                break
+        
+            # El mes queda registrado en cuanto sus filas están en el spool
+            key = first.strftime('%Y-%m')
+            entry = state['months'].get(key)
+            continues = entry and entry['through'] >= (first - timedelta(days=1)).isoformat() \
+                and {farm['id'] for farm in farms} <= set(entry['farms'])
+            state['months'][key] = {
+                'from': entry['from'] if continues else first.isoformat(),
+                'through': last.isoformat(),
+                'farms': sorted(farm['id'] for farm in farms),
+                'ingested_at': datetime.now().isoformat()
+            }
+            _save_era5_state(state)
+            summary['chunks'] += 1
+            summary['rows'] += len(rows)
+            print(f"[OK] ERA5-Land {first} -> {last}: {len(rows)} fila(s) diarias")
+    finally:
+        # Lo que ya está en el spool se entrega aunque un tramo falle
+        flush_results()
+        drain_results()
+    return summary
 
 # ============================================================
-# SENTINEL HUB - NDVI/NDWI
+# SENTINEL HUB - ÍNDICES ESPECTRALES (NDVI/NDWI/NDSI)
 # ============================================================
 
-# Evalscript para calcular NDVI
-NDVI_EVALSCRIPT = """
-//VERSION=3
-function setup() {
-    return {
-        input: [{
-            bands: ["B04", "B08", "dataMask"]
-        }],
-        output: [{
-            id: "ndvi",
-            bands: 1,
-            sampleType: "FLOAT32"
-        }]
-    };
-}
-
-function evaluatePixel(sample) {
-    let ndvi = (sample.B08 - sample.B04) / (sample.B08 + sample.B04);
-    return [ndvi];
-}
-"""
-
-# Evalscript para calcular NDWI
-NDWI_EVALSCRIPT = """
-//VERSION=3
-function setup() {
-    return {
-        input: [{
-            bands: ["B03", "B08", "dataMask"]
-        }],
-        output: [{
-            id: "ndwi",
-            bands: 1,
-            sampleType: "FLOAT32"
-        }]
-    };
-}
-
-function evaluatePixel(sample) {
-    let ndwi = (sample.B03 - sample.B08) / (sample.B03 + sample.B08);
-    return [ndwi];
+# Índices de diferencia normalizada: nombre -> (banda_a, banda_b)
+# índice = (banda_a - banda_b) / (banda_a + banda_b)
+# - NDVI: vegetación (NIR vs Rojo)
+# - NDWI: agua/humedad (Verde vs NIR)
+# - NDSI: suelo expuesto (SWIR vs NIR), positivo = suelo, negativo = vegetación
+SPECTRAL_INDICES = {
+    'ndvi': ('B08', 'B04'),
+    'ndwi': ('B03', 'B08'),
+    'ndsi': ('B11', 'B08'),
 }
-"""
 
-# Evalscript para calcular NDSI (Normalized Difference Soil Index)
-# Útil para detectar suelo expuesto vs vegetación
-# NDSI = (SWIR - NIR) / (SWIR + NIR) usando B11 (SWIR) y B08 (NIR)
-NDSI_EVALSCRIPT = """
+def build_indices_evalscript(indices, data_mask=False):
+    """
+    Construye un evalscript con una salida FLOAT32 nombrada por cada índice.
+    
+    Solo se solicitan las bandas que necesitan los índices pedidos, de modo
+    que pedir únicamente NDVI sigue costando lo mismo que antes. Con
+    data_mask=True se agrega la salida 'dataMask' (requerida por la
+    Statistical API para excluir píxeles sin dato).
+    """
+    bands = sorted({band for index in indices for band in SPECTRAL_INDICES[index]})
+    input_bands = ', '.join(f'"{band}"' for band in bands + ['dataMask'])
+    outputs = [
+        f'            {{ id: "{index}", bands: 1, sampleType: "FLOAT32" }}'
+        for index in indices
+    ]
+    formulas = [
+        '        {0}: [(sample.{1} - sample.{2}) / (sample.{1} + sample.{2})]'.format(
+            index, *SPECTRAL_INDICES[index]
+        )
+        for index in indices
+    ]
+    if data_mask:
+        outputs.append('            { id: "dataMask", bands: 1, sampleType: "UINT8" }')
+        formulas.append('        dataMask: [sample.dataMask]')
+    outputs = ',\n'.join(outputs)
+    formulas = ',\n'.join(formulas)
+    return f"""
 //VERSION=3
-function setup() {
-    return {
-        input: [{
-            bands: ["B08", "B11", "dataMask"]
-        }],
-        output: [{
-            id: "ndsi",
-            bands: 1,
-            sampleType: "FLOAT32"
-        }]
-    };
-}
+function setup() {{
+    return {{
+        input: [{{
+            bands: [{input_bands}]
+        }}],
+        output: [
+{outputs}
+        ]
+    }};
+}}
 
-function evaluatePixel(sample) {
-    // NDSI: valores positivos = suelo, negativos = vegetación
-    let ndsi = (sample.B11 - sample.B08) / (sample.B11 + sample.B08);
-    return [ndsi];
-}
+function evaluatePixel(sample) {{
+    return {{
+{formulas}
+    }};
+}}
 """
 
-def get_ndvi_sentinel(start_date=None, end_date=None):
+def _index_stats(index, array, date, mask=None):
     """
-    Obtiene NDVI de Sentinel-2 via Sentinel Hub Processing API
+    Estadísticas de un raster de índice con raster_stats, excluyendo los
+    píxeles sin dato según la banda dataMask
     """
-    config = load_sentinel_config()
-    
-    if not config.sh_client_id:
-        print("[WARN] Sentinel Hub no configurado. Configura sentinel_config.json")
+    return _format_index_stats(index, raster_stats.masked_stats(array, mask), date)
+
+def _format_index_stats(index, summary, date):
+    """Da a un resumen de raster_stats el formato de resultados del colector"""
+    if summary is None:
         return None
     
-    if not end_date:
-        end_date = datetime.now()
-    if not start_date:
-        start_date = end_date - timedelta(days=30)
-    
-    if isinstance(start_date, str):
-        start_date = datetime.strptime(start_date, '%Y-%m-%d')
-    if isinstance(end_date, str):
-        end_date = datetime.strptime(end_date, '%Y-%m-%d')
+    mean_value = summary['mean']
+    stats = {
+        f'{index}_mean': mean_value,
+        f'{index}_min': summary['min'],
+        f'{index}_max': summary['max'],
+        f'{index}_std': summary['std'],
+        f'{index}_percentiles': summary['percentiles'],
+        f'{index}_histogram': summary['histogram'],
+        'valid_fraction': summary['valid_fraction'],
+        'date': date
+    }
+    if index == 'ndsi':
+        stats['interpretation'] = 'Suelo expuesto' if mean_value > 0 else 'Vegetación cubriendo'
+    return stats
+
+def _zone_stats(farm, result):
+    """
+    Estadísticas por zona de cultivo sobre los rasters ya descargados
     
-    print(f"[Sentinel Hub] Calculando NDVI del {start_date.date()} al {end_date.date()}...")
+    Returns:
+        dict: {cultivo: {índice: stats}} (vacío si la finca no tiene zonas)
+    """
+    valid = result['mask'] != 0
+    zones = {}
+    for zone, zone_mask in zone_masks.zone_masks(farm, valid.shape).items():
+        stats = {
+            index: _index_stats(index, array, result['date'], valid & zone_mask)
+            for index, array in result['rasters'].items()
+        }
+        stats = {index: value for index, value in stats.items() if value}
+        # Fracción válida respecto a los píxeles de la zona, no de la finca
+        zone_share = zone_mask.sum() / zone_mask.size
+        for value in stats.values():
+            value['valid_fraction'] = float(value['valid_fraction'] / zone_share)
+        if stats:
+            zones[zone] = stats
+            if 'ndvi' in stats:
+                print(f"[OK] {farm['id']} zona {zone}: NDVI {stats['ndvi']['ndvi_mean']:.4f}")
+    return zones
+
+def _fetch_group_indices(group, indices, start_date, end_date, size):
+    """Índices de un grupo con una sola solicitud; recorta la ventana de cada finca"""
+    payload = _execute_sentinel_request(
+        build_indices_evalscript(indices, data_mask=True),
+        [(index, MimeType.TIFF) for index in indices + ['dataMask']],
+        start_date, end_date, size, bbox=group['bbox']
+    )
+    if not payload:
+        return None
     
+    results = {}
+    for farm in group['farms']:
+        mask = _crop_to_bbox(payload['dataMask'], group['bbox'], farm['bbox'])
+        result = {'date': end_date.isoformat(), 'rasters': {}, 'mask': mask}
+        for index in indices:
+            array = _crop_to_bbox(payload[index], group['bbox'], farm['bbox'])
+            stats = _index_stats(index, array, result['date'], mask)
+            if stats:
+                result[index] = stats
+                result['rasters'][index] = array
+        results[farm['id']] = result
+    return results
+
+def _fetch_tile(evalscript, responses, start_date, end_date, tile):
+    """
+    Descarga una tesela en un hilo del pool; retorna también las solicitudes
+    registradas en ese hilo para trasladarlas al registro de la tarea
+    """
+    start_request_log()
     try:
-        # Definir bounding box
-        bbox = BBox(bbox=FARM_COORDS['bbox'], crs=CRS.WGS84)
-        resolution = 10  # metros
-        size = bbox_to_dimensions(bbox, resolution=resolution)
-        
-        # Crear solicitud usando DataCollection de CDSE
-        cdse_collection = get_cdse_sentinel2_collection()
-        
-        request = SentinelHubRequest(
-            evalscript=NDVI_EVALSCRIPT,
-            input_data=[
-                SentinelHubRequest.input_data(
-                    data_collection=cdse_collection,
-                    time_interval=(start_date, end_date),
-                    mosaicking_order='leastCC'  # Menor nubosidad
-                )
-            ],
-            responses=[
-                SentinelHubRequest.output_response('ndvi', MimeType.TIFF)
-            ],
-            bbox=bbox,
-            size=size,
-            config=config
+        payload = _execute_sentinel_request(
+            evalscript, responses, start_date, end_date, tile['size'], bbox=tile['bbox']
         )
-        
-        # Ejecutar
-        data = request.get_data()
-        
-        if data and len(data) > 0:
-            ndvi_array = data[0]
-            mean_ndvi = float(ndvi_array[ndvi_array != 0].mean())
-            print(f"[OK] NDVI promedio: {mean_ndvi:.4f}")
-            return {
-                'ndvi_mean': mean_ndvi,
-                'ndvi_min': float(ndvi_array[ndvi_array != 0].min()),
-                'ndvi_max': float(ndvi_array[ndvi_array != 0].max()),
-                'date': end_date.isoformat()
-            }
-        
     except Exception as e:
-        print(f"[ERROR] Sentinel Hub NDVI: {e}")
-        return None
+        print(f"[ERROR] Tesela {tile['window']}: {e}")
+        payload = None
+    return payload, collect_request_log()
 
-def get_ndwi_sentinel(start_date=None, end_date=None):
+def _open_mosaic(polygon_id, indices, shape):
+    """Archivos .npy mapeados en memoria para el mosaico de una finca"""
+    directory = os.path.join(SENTINEL_MOSAIC_DIR, polygon_id)
+    os.makedirs(directory, exist_ok=True)
+    return {
+        layer: np.lib.format.open_memmap(
+            os.path.join(directory, f"{layer}.npy"), mode='w+',
+            dtype=np.uint8 if layer == 'dataMask' else np.float32, shape=shape
+        )
+        for layer in indices + ['dataMask']
+    }
+
+def _merge_tile(tile, payload, windows, partials, mosaics, indices):
+    """Incorpora una tesela a los acumuladores (y mosaicos) de cada finca"""
+    tile_r0, tile_r1, tile_c0, tile_c1 = tile['window']
+    for polygon_id, (farm_r0, farm_r1, farm_c0, farm_c1) in windows.items():
+        r0, r1 = max(tile_r0, farm_r0), min(tile_r1, farm_r1)
+        c0, c1 = max(tile_c0, farm_c0), min(tile_c1, farm_c1)
+        if r0 >= r1 or c0 >= c1:
+            continue
+        in_tile = (slice(r0 - tile_r0, r1 - tile_r0), slice(c0 - tile_c0, c1 - tile_c0))
+        in_farm = (slice(r0 - farm_r0, r1 - farm_r0), slice(c0 - farm_c0, c1 - farm_c0))
+        mask = payload['dataMask'][in_tile]
+        for index in indices:
+            block = payload[index][in_tile]
+            partials[polygon_id][index] = raster_stats.merge_stats(
+                partials[polygon_id].get(index), raster_stats.partial_stats(block, mask)
+            )
+            if polygon_id in mosaics:
+                mosaics[polygon_id][index][in_farm] = block
+        if polygon_id in mosaics:
+            mosaics[polygon_id]['dataMask'][in_farm] = mask
+
+def _fetch_tiled_indices(group, indices, start_date, end_date, size):
     """
-    Obtiene NDWI de Sentinel-2 via Sentinel Hub Processing API
+    Índices de un AOI mayor que SENTINEL_MAX_TILE_PX, por teselas
+    
+    Las teselas se piden en paralelo, pero con a lo sumo
+    SENTINEL_TILE_WORKERS en vuelo; cada una se reduce a acumuladores de
+    estadísticas por finca (raster_stats.partial_stats/merge_stats) y se
+    descarta, así que la memoria pico no depende del tamaño del AOI. Con
+    SENTINEL_MOSAIC_DIR los rasters se escriben además a disco y quedan
+    disponibles como memmap para zonas, mapas y archivo.
     """
-    config = load_sentinel_config()
+    width, height = size
+    tiles = split_bbox(group['bbox'], size)
+    print(f"[Sentinel Hub] AOI de {width}x{height} px: {len(tiles)} teselas, "
+          f"{SENTINEL_TILE_WORKERS} en paralelo")
+    
+    evalscript = build_indices_evalscript(indices, data_mask=True)
+    responses = [(index, MimeType.TIFF) for index in indices + ['dataMask']]
+    windows = {
+        farm['id']: _bbox_window(group['bbox'], (height, width), farm['bbox'])
+        for farm in group['farms']
+    }
+    partials = {polygon_id: {} for polygon_id in windows}
+    mosaics = {}
+    if SENTINEL_MOSAIC_DIR:
+        mosaics = {
+            polygon_id: _open_mosaic(polygon_id, indices, (r1 - r0, c1 - c0))
+            for polygon_id, (r0, r1, c0, c1) in windows.items()
+        }
     
-    if not config.sh_client_id:
-        print("[WARN] Sentinel Hub no configurado.")
+    pending = iter(tiles)
+    in_flight = {}
+    failed = False
+    with ThreadPoolExecutor(max_workers=SENTINEL_TILE_WORKERS) as executor:
+        def submit_next():
+            tile = None if failed else next(pending, None)
+            if tile:
+                future = executor.submit(_fetch_tile, evalscript, responses, start_date, end_date, tile)
+                in_flight[future] = tile
+        
+        for _ in range(SENTINEL_TILE_WORKERS):
+            submit_next()
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                tile = in_flight.pop(future)
+                payload, requests_made = future.result()
+                for entry in requests_made:
+                    _log_sentinel_request(**entry)
+                if payload:
+                    _merge_tile(tile, payload, windows, partials, mosaics, indices)
+                else:
+                    failed = True
+                del payload
+                submit_next()
+    
+    if failed:
+        print(f"[ERROR] No se pudieron descargar todas las teselas de {group['id']}")
         return None
     
-    if not end_date:
-        end_date = datetime.now()
-    if not start_date:
-        start_date = end_date - timedelta(days=30)
+    results = {}
+    for polygon_id in windows:
+        result = {'date': end_date.isoformat(), 'rasters': {}, 'mask': None, 'tiles': len(tiles)}
+        for index in indices:
+            stats = _format_index_stats(
+                index, raster_stats.finalize_stats(partials[polygon_id].get(index)), result['date']
+            )
+            if stats:
+                result[index] = stats
+        if polygon_id in mosaics:
+            for layer, array in mosaics[polygon_id].items():
+                array.flush()
+                reopened = np.load(array.filename, mmap_mode='r')
+                if layer == 'dataMask':
+                    result['mask'] = reopened
+                elif layer in result:
+                    result['rasters'][layer] = reopened
+        results[polygon_id] = result
+    return results
+
+def fetch_spectral_indices(group, start_date=None, end_date=None, indices=None, render_maps=False):
+    """
+    Obtiene varios índices espectrales de Sentinel-2 en una sola solicitud
+    para todas las fincas de un grupo
     
-    if isinstance(start_date, str):
-        start_date = datetime.strptime(start_date, '%Y-%m-%d')
-    if isinstance(end_date, str):
-        end_date = datetime.strptime(end_date, '%Y-%m-%d')
+    Las bandas se descargan una vez sobre el bbox del grupo y el evalscript
+    devuelve un raster FLOAT32 por índice más la banda dataMask; las
+    estadísticas de cada finca se calculan sobre su ventana del raster.
+    Con render_maps=True también se guarda el mapa NDVI coloreado de cada
+    finca ('map_ndvi'), sin solicitud adicional.
+    
+    Returns:
+        dict: {polygon_id: {'ndvi': {...}, 'ndwi': {...}, 'rasters': {...}, 'mask': ..., 'date': ...}}
+    """
+    indices = list(indices or SPECTRAL_INDICES)
+    sentinel = get_sentinel_session()
     
-    print(f"[Sentinel Hub] Calculando NDWI del {start_date.date()} al {end_date.date()}...")
+    if not sentinel.configured:
+        print("[WARN] Sentinel Hub no configurado. Configura sentinel_config.json")
+        return None
+    
+    start_date, end_date = _resolve_time_interval(start_date, end_date)
+    names = '/'.join(index.upper() for index in indices)
+    
+    print(f"[Sentinel Hub] Calculando {names} ({group['id']}) del {start_date.date()} al {end_date.date()}...")
     
     try:
-        bbox = BBox(bbox=FARM_COORDS['bbox'], crs=CRS.WGS84)
-        resolution = 10
+        bbox = BBox(bbox=group['bbox'], crs=CRS.WGS84)
+        resolution = 10  # metros
         size = bbox_to_dimensions(bbox, resolution=resolution)
         
-        # Usar DataCollection de CDSE
-        cdse_collection = get_cdse_sentinel2_collection()
+        if max(size) > SENTINEL_MAX_TILE_PX:
+            results = _fetch_tiled_indices(group, indices, start_date, end_date, size)
+        else:
+            results = _fetch_group_indices(group, indices, start_date, end_date, size)
+        if not results:
+            return None
         
-        request = SentinelHubRequest(
-            evalscript=NDWI_EVALSCRIPT,
-            input_data=[
-                SentinelHubRequest.input_data(
-                    data_collection=cdse_collection,
-                    time_interval=(start_date, end_date),
-                    mosaicking_order='leastCC'
+        for farm in group['farms']:
+            result = results.get(farm['id'])
+            if not result:
+                continue
+            if not any(index in result for index in indices):
+                print(f"[WARN] Sin píxeles válidos para {names} en {farm['id']}")
+                del results[farm['id']]
+                continue
+            for index in indices:
+                if index in result:
+                    print(f"[OK] {farm['id']} {index.upper()} promedio: {result[index][f'{index}_mean']:.4f}")
+            if not result['rasters']:
+                if render_maps:
+                    print(f"[WARN] {farm['id']}: AOI por teselas sin SENTINEL_MOSAIC_DIR, se omite el mapa NDVI")
+                continue
+            zones = _zone_stats(farm, result)
+            if zones:
+                result['zones'] = zones
+            if render_maps and 'ndvi' in result['rasters']:
+                result['map_ndvi'] = _store_map(
+                    map_render.encode_ndvi_png(result['rasters']['ndvi'], result['mask']),
+                    farm['id'], 'ndvi', end_date
                 )
-            ],
-            responses=[
-                SentinelHubRequest.output_response('ndwi', MimeType.TIFF)
-            ],
-            bbox=bbox,
-            size=size,
-            config=config
-        )
-        
-        data = request.get_data()
-        
-        if data and len(data) > 0:
-            ndwi_array = data[0]
-            mean_ndwi = float(ndwi_array[ndwi_array != 0].mean())
-            print(f"[OK] NDWI promedio: {mean_ndwi:.4f}")
-            return {
-                'ndwi_mean': mean_ndwi,
-                'ndwi_min': float(ndwi_array[ndwi_array != 0].min()),
-                'ndwi_max': float(ndwi_array[ndwi_array != 0].max()),
-                'date': end_date.isoformat()
-            }
+                print(f"[OK] Mapa NDVI renderizado localmente: {result['map_ndvi']}")
+        return results or None
         
     except Exception as e:
-        print(f"[ERROR] Sentinel Hub NDWI: {e}")
+        print(f"[ERROR] Sentinel Hub {names}: {e}")
         return None
 
+def get_spectral_indices_sentinel(start_date=None, end_date=None, indices=None, farm=None):
+    """
+    Obtiene varios índices espectrales de Sentinel-2 para una finca
+    
+    Args:
+        start_date: Fecha inicio
+        end_date: Fecha fin
+        indices: Lista de índices a calcular (por defecto NDVI, NDWI y NDSI)
+        farm: Finca de load_farms() (por defecto, la de FARM_COORDS)
+    
+    Returns:
+        dict: {'ndvi': {...}, 'ndwi': {...}, 'ndsi': {...}, 'rasters': {...}, 'date': ...}
+    """
+    farm = farm or _default_farm()
+    results = fetch_spectral_indices(make_farm_group([farm]), start_date, end_date, indices)
+    return results.get(farm['id']) if results else None
+
+def get_ndvi_sentinel(start_date=None, end_date=None):
+    """
+    Obtiene NDVI de Sentinel-2 via Sentinel Hub Processing API
+    """
+    result = get_spectral_indices_sentinel(start_date, end_date, indices=['ndvi'])
+    return result.get('ndvi') if result else None
+
+def get_ndwi_sentinel(start_date=None, end_date=None):
+    """
+    Obtiene NDWI de Sentinel-2 via Sentinel Hub Processing API
+    """
+    result = get_spectral_indices_sentinel(start_date, end_date, indices=['ndwi'])
+    return result.get('ndwi') if result else None
+
 def get_ndsi_sentinel(start_date=None, end_date=None):
     """
     Obtiene NDSI (Normalized Difference Soil Index) de Sentinel-2
     NDSI positivo = suelo expuesto, negativo = vegetación
     """
-    config = load_sentinel_config()
+    result = get_spectral_indices_sentinel(start_date, end_date, indices=['ndsi'])
+    return result.get('ndsi') if result else None
+
+# ============================================================
+# STATISTICAL API - ESTADÍSTICAS ZONALES
+# ============================================================
+
+# Percentiles calculados por la Statistical API en modo 'stats'
+STATS_PERCENTILES = [10, 25, 50, 75, 90]
+
+def _statistical_to_stats(index, band_stats, date):
+    """Convierte las estadísticas de una banda de la Statistical API al formato de _index_stats"""
+    total = band_stats.get('sampleCount') or 0
+    valid = total - (band_stats.get('noDataCount') or 0)
+    if valid <= 0:
+        return None
     
-    if not config.sh_client_id:
+    mean_value = float(band_stats['mean'])
+    stats = {
+        f'{index}_mean': mean_value,
+        f'{index}_min': float(band_stats['min']),
+        f'{index}_max': float(band_stats['max']),
+        f'{index}_std': float(band_stats['stDev']),
+        f'{index}_percentiles': {
+            int(float(k)): float(v) for k, v in band_stats.get('percentiles', {}).items()
+        },
+        'valid_fraction': valid / total,
+        'date': date
+    }
+    if index == 'ndsi':
+        stats['interpretation'] = 'Suelo expuesto' if mean_value > 0 else 'Vegetación cubriendo'
+    return stats
+
+def get_zonal_statistics(start_date=None, end_date=None, farm=None, indices=None):
+    """
+    Obtiene estadísticas zonales de los índices sin descargar rasters
+    usando Sentinel Hub Statistical API
+    
+    Una sola agregación devuelve media, mínimo, máximo, desviación estándar
+    y percentiles de todos los índices pedidos sobre la geometría de la
+    finca. Se agrega solo el día de la escena que resolvería el mosaico
+    'leastCC', así que los valores corresponden a la misma escena que usan
+    los mapas y los índices descargados.
+    
+    Returns:
+        dict: {'ndvi': {...}, 'ndwi': {...}, 'ndsi': {...}, 'date': ...} (sin 'rasters')
+    """
+    farm = farm or _default_farm()
+    indices = list(indices or SPECTRAL_INDICES)
+    sentinel = get_sentinel_session()
+    
+    if not sentinel.configured:
         print("[WARN] Sentinel Hub no configurado.")
         return None
     
-    if not end_date:
-        end_date = datetime.now()
-    if not start_date:
-        start_date = end_date - timedelta(days=30)
+    start_date, end_date = _resolve_time_interval(start_date, end_date)
+    names = '/'.join(index.upper() for index in indices)
     
-    if isinstance(start_date, str):
-        start_date = datetime.strptime(start_date, '%Y-%m-%d')
-    if isinstance(end_date, str):
-        end_date = datetime.strptime(end_date, '%Y-%m-%d')
-    
-    print(f"[Sentinel Hub] Calculando NDSI del {start_date.date()} al {end_date.date()}...")
+    print(f"[Statistical API] Estadísticas {names} ({farm['id']})...")
     
     try:
-        bbox = BBox(bbox=FARM_COORDS['bbox'], crs=CRS.WGS84)
-        resolution = 10
-        size = bbox_to_dimensions(bbox, resolution=resolution)
+        acquisition = select_mosaic_acquisition(
+            search_sentinel_acquisitions(start_date, end_date, bbox=farm['bbox'])
+        )
+        if acquisition:
+            # Agregar solo el día de la escena elegida
+            scene_day = datetime.fromisoformat(acquisition['datetime'][:10])
+            time_interval = (scene_day, scene_day + timedelta(days=1))
+            aggregation_interval = 'P1D'
+        else:
+            # Sin catálogo: mosaico leastCC sobre todo el intervalo
+            time_interval = (start_date, end_date)
+            aggregation_interval = f"P{max((end_date - start_date).days, 1)}D"
         
-        cdse_collection = get_cdse_sentinel2_collection()
+        size = bbox_to_dimensions(BBox(bbox=farm['bbox'], crs=CRS.WGS84), resolution=10)
         
-        request = SentinelHubRequest(
-            evalscript=NDSI_EVALSCRIPT,
+        sentinel.authenticate()
+        request = SentinelHubStatistical(
+            aggregation=SentinelHubStatistical.aggregation(
+                evalscript=build_indices_evalscript(indices, data_mask=True),
+                time_interval=time_interval,
+                aggregation_interval=aggregation_interval,
+                size=size
+            ),
             input_data=[
-                SentinelHubRequest.input_data(
-                    data_collection=cdse_collection,
-                    time_interval=(start_date, end_date),
+                SentinelHubStatistical.input_data(
+                    sentinel.collection,
                     mosaicking_order='leastCC'
                 )
             ],
-            responses=[
-                SentinelHubRequest.output_response('ndsi', MimeType.TIFF)
-            ],
-            bbox=bbox,
-            size=size,
-            config=config
+            geometry=Geometry(farm['polygon'], crs=CRS.WGS84),
+            calculations={
+                'default': {'statistics': {'default': {'percentiles': {'k': STATS_PERCENTILES}}}}
+            },
+            config=sentinel.config
         )
         
-        data = request.get_data()
+        response = request.get_data(decode_data=False)[0]
+        _log_sentinel_request(cached=False, acquisition=acquisition, size=tuple(size),
+                              pu=_read_pu_spent(response.headers))
+        intervals = [item for item in response.decode().get('data', []) if 'outputs' in item]
+        if not intervals:
+            print(f"[WARN] Statistical API sin datos para {farm['id']}")
+            return None
         
-        if data and len(data) > 0:
-            ndsi_array = data[0]
-            valid_data = ndsi_array[ndsi_array != 0]
-            if len(valid_data) > 0:
-                mean_ndsi = float(valid_data.mean())
-                print(f"[OK] NDSI promedio: {mean_ndsi:.4f}")
-                return {
-                    'ndsi_mean': mean_ndsi,
-                    'ndsi_min': float(valid_data.min()),
-                    'ndsi_max': float(valid_data.max()),
-                    'date': end_date.isoformat(),
-                    'interpretation': 'Suelo expuesto' if mean_ndsi > 0 else 'Vegetación cubriendo'
-                }
+        interval = intervals[-1]
+        # Fecha de la escena; 'to' es el día siguiente (fin exclusivo)
+        date = acquisition['datetime'][:10] if acquisition else interval['interval']['from'][:10]
+        result = {'date': date}
+        for index in indices:
+            band_stats = interval['outputs'][index]['bands']['B0']['stats']
+            stats = _statistical_to_stats(index, band_stats, date)
+            if stats:
+                result[index] = stats
+                print(f"[OK] {farm['id']} {index.upper()} promedio: {stats[f'{index}_mean']:.4f} "
+                      f"(σ {stats[f'{index}_std']:.4f})")
+        
+        if len(result) == 1:
+            print(f"[WARN] Sin píxeles válidos para {names} en {farm['id']}")
+            return None
+        return result
         
     except Exception as e:
-        print(f"[ERROR] Sentinel Hub NDSI: {e}")
+        print(f"[ERROR] Statistical API: {e}")
         return None
 
 # ============================================================
-# STATISTICAL API - ESTADÍSTICAS ZONALES
+# PLANIFICACIÓN POR ADQUISICIÓN (PRE-FLIGHT DE CATÁLOGO)
 # ============================================================
 
-def get_zonal_statistics(start_date=None, end_date=None):
-    """
-    Obtiene estadísticas zonales sin descargar datos completos
-    usando Sentinel Hub Statistical API
+# Sentinel-2 revisita Veraguas cada ~5 días: solo vale la pena procesar
+# cuando aparece una escena nueva con nubosidad aceptable
+SCENE_MAX_CLOUD = float(os.environ.get('SCENE_MAX_CLOUD', 40))  # % máximo de nubes
+SCHEDULER_STATE_FILE = os.path.join(os.path.dirname(__file__), 'data', 'sentinel_state.json')
+
+def _load_last_acquisitions(polygon_ids):
     """
-    config = load_sentinel_config()
-    
-    if not config.sh_client_id:
-        print("[WARN] Sentinel Hub no configurado.")
-        return None
+    Última adquisición ya procesada de cada polígono
     
-    if not end_date:
-        end_date = datetime.now()
-    if not start_date:
-        start_date = end_date - timedelta(days=30)
+    Se consulta primero la base de datos (compartida entre el cron de Render
+    y GitHub Actions) y, si no está disponible, el archivo de estado local.
     
-    print(f"[Statistical API] Obteniendo estadísticas zonales...")
+    Returns:
+        dict: {polygon_id: acquisition_id}
+    """
+    try:
+        conn = db_config.get_connection()
+        if conn:
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT DISTINCT ON (polygon_id) polygon_id, acquisition_id
+                FROM processed_acquisitions
+                WHERE polygon_id = ANY(%s)
+                ORDER BY polygon_id, acquisition_date DESC
+            """, (list(polygon_ids),))
+            rows = cur.fetchall()
+            cur.close()
+            conn.close()
+            return dict(rows)
+    except Exception as e:
+        print(f"[WARN] Estado de adquisiciones en BD no disponible: {e}")
+    
+    if os.path.exists(SCHEDULER_STATE_FILE):
+        with open(SCHEDULER_STATE_FILE, 'r') as f:
+            state = json.load(f)
+        return {
+            polygon_id: state[polygon_id].get('acquisition_id')
+            for polygon_id in polygon_ids if polygon_id in state
+        }
+    return {}
+
+def _mark_acquisition_processed(polygon_ids, acquisition):
+    """Registra la adquisición como procesada para los polígonos (BD y archivo de estado)"""
+    state = {}
+    if os.path.exists(SCHEDULER_STATE_FILE):
+        with open(SCHEDULER_STATE_FILE, 'r') as f:
+            state = json.load(f)
+    for polygon_id in polygon_ids:
+        state[polygon_id] = {
+            'acquisition_id': acquisition['id'],
+            'acquisition_date': acquisition['datetime'],
+            'cloud_cover': acquisition['cloud_cover'],
+            'processed_at': datetime.now().isoformat()
+        }
+    os.makedirs(os.path.dirname(SCHEDULER_STATE_FILE), exist_ok=True)
+    with open(SCHEDULER_STATE_FILE, 'w') as f:
+        json.dump(state, f, indent=4)
     
     try:
-        # Geometría del polígono de la finca
-        geometry = {
-            "type": "Polygon",
-            "coordinates": [[
-                [FARM_COORDS['bbox'][0], FARM_COORDS['bbox'][1]],
-                [FARM_COORDS['bbox'][2], FARM_COORDS['bbox'][1]],
-                [FARM_COORDS['bbox'][2], FARM_COORDS['bbox'][3]],
-                [FARM_COORDS['bbox'][0], FARM_COORDS['bbox'][3]],
-                [FARM_COORDS['bbox'][0], FARM_COORDS['bbox'][1]]
-            ]]
+        conn = db_config.get_connection()
+        if conn:
+            cur = conn.cursor()
+            cur.executemany("""
+                INSERT INTO processed_acquisitions
+                (polygon_id, acquisition_id, acquisition_date, cloud_cover)
+                VALUES (%s, %s, %s, %s)
+                ON CONFLICT (polygon_id, acquisition_id) DO NOTHING
+            """, [
+                (polygon_id, acquisition['id'], acquisition['datetime'], acquisition['cloud_cover'])
+                for polygon_id in polygon_ids
+            ])
+            conn.commit()
+            cur.close()
+            conn.close()
+    except Exception as e:
+        print(f"[WARN] No se pudo registrar la adquisición en BD: {e}")
+
+def check_new_acquisition(polygon_ids=(DEFAULT_POLYGON_ID,), start_date=None, end_date=None, bbox=None):
+    """
+    Pre-flight: consulta el catálogo y decide si hay que procesar
+    
+    Con un grupo de fincas se procesa si alguna no ha visto aún la escena
+    despejada más reciente.
+    
+    Returns:
+        dict: {
+            'process': bool,
+            'reason': str,
+            'newest': escena despejada más reciente (o None),
+            'mosaic': escena que resolverá el mosaico leastCC (o None)
         }
-        
-        # Evalscript para estadísticas
-        evalscript = """
-        //VERSION=3
-        function setup() {
-            return {
-                input: [{ bands: ["B04", "B08", "dataMask"] }],
-                output: [
-                    { id: "ndvi", bands: 1, sampleType: "FLOAT32" },
-                    { id: "dataMask", bands: 1 }
-                ]
-            };
+    """
+    acquisitions = search_sentinel_acquisitions(start_date, end_date, bbox=bbox)
+    if acquisitions is None:
+        # Sin catálogo no podemos saberlo: mantener el comportamiento anterior
+        return {'process': True, 'reason': 'catálogo no disponible', 'newest': None, 'mosaic': None}
+    
+    clear = [
+        item for item in acquisitions
+        if item['cloud_cover'] is not None and item['cloud_cover'] <= SCENE_MAX_CLOUD
+    ]
+    mosaic = select_mosaic_acquisition(acquisitions)
+    if not clear:
+        return {
+            'process': False,
+            'reason': f"ninguna escena con nubosidad <= {SCENE_MAX_CLOUD:.0f}%",
+            'newest': None,
+            'mosaic': mosaic
         }
-        
-        function evaluatePixel(samples) {
-            let ndvi = (samples.B08 - samples.B04) / (samples.B08 + samples.B04);
-            return {
-                ndvi: [ndvi],
-                dataMask: [samples.dataMask]
-            };
+    
+    newest = clear[-1]  # search_sentinel_acquisitions ordena por fecha
+    last_processed = _load_last_acquisitions(polygon_ids)
+    if all(last_processed.get(polygon_id) == newest['id'] for polygon_id in polygon_ids):
+        return {
+            'process': False,
+            'reason': f"sin escena nueva desde {newest['datetime'][:10]}",
+            'newest': newest,
+            'mosaic': mosaic
         }
-        """
-        
-        request = SentinelHubStatistical(
-            aggregation=SentinelHubStatistical.aggregation(
-                evalscript=evalscript,
-                time_interval=(start_date, end_date),
-                aggregation_interval='P1D',  # Diario
-                size=(100, 100)
-            ),
-            input_data=[
-                SentinelHubStatistical.input_data(
-                    DataCollection.SENTINEL2_L2A,
-                    maxcc=0.3
-                )
-            ],
-            geometry=geometry,
-            config=config
-        )
-        
-        stats = request.get_data()
-        print(f"[OK] Estadísticas obtenidas para {len(stats)} fechas")
-        return stats
-        
-    except Exception as e:
-        print(f"[ERROR] Statistical API: {e}")
-        return None
+    
+    return {
+        'process': True,
+        'reason': f"escena nueva {newest['datetime'][:10]} ({newest['cloud_cover']:.0f}% nubes)",
+        'newest': newest,
+        'mosaic': mosaic
+    }
 
 # ============================================================
 # PERSISTENCIA DE DATOS
 # ============================================================
 
-def save_results(results):
-    """Guarda los resultados en CSV y Base de Datos"""
+def save_results(results, polygon_id=DEFAULT_POLYGON_ID, flush=True, timestamp=None):
+    """
+    Guarda los resultados de una finca en el historial local y Base de Datos
+    
+    Las filas para la BD se escriben primero en el spool local (db_writer);
+    el replicador en segundo plano las lleva a PostgreSQL.
+    
+    Args:
+        flush: Sellar ya el segmento del spool; con False las filas esperan
+               a flush_results() para replicarse juntas
+        timestamp: Momento del registro en el historial local; por defecto
+                   ahora (el backfill pasa la fecha de la escena)
+    """
     if not results:
         print("[WARN] No hay resultados para guardar")
         return
 
-    timestamp = datetime.now()
-    date_str = timestamp.strftime('%Y-%m-%d %H:%M:%S')
-    
-    # 2. Guardar en CSV local
-    csv_file = 'data/copernicus_history.csv'
-    os.makedirs('data', exist_ok=True)
+    timestamp = timestamp or datetime.now()
     
-    # Preparar fila
+    # 1. Guardar en el historial columnar local (history_store)
     row = {
-        'timestamp': date_str,
-        'polygon_id': 'los_valles_veraguas',
+        'timestamp': timestamp.replace(microsecond=0),
+        'polygon_id': polygon_id,
         'ndvi_mean': results.get('ndvi', {}).get('ndvi_mean', ''),
         'ndwi_mean': results.get('ndwi', {}).get('ndwi_mean', ''),
         'ndsi_mean': results.get('ndsi', {}).get('ndsi_mean', ''),
@@ -972,243 +1984,712 @@ def save_results(results):
         'weather_desc': results.get('weather', {}).get('description', '')
     }
     
-    file_exists = os.path.isfile(csv_file)
-    with open(csv_file, 'a', newline='', encoding='utf-8') as f:
-        # Nota: Si el archivo ya existe y tiene otros encabezados, esto podría ser un problema
-        # Idealmente verificar headers, pero por simplicidad agregamos al final
-        writer = csv.DictWriter(f, fieldnames=row.keys())
-        if not file_exists:
-            writer.writeheader()
-        writer.writerow(row)
-    print(f"[OK] Datos guardados en CSV: {csv_file}")
-    
-    # 2. Guardar en Base de Datos (Neon PostgreSQL)
-    try:
-        conn = db_config.get_connection()
-        if conn:
-            cur = conn.cursor()
-            
-            # Insertar Clima (OpenWeather)
-            if 'weather' in results and results['weather']:
-                w = results['weather']
-                cur.execute("""
-                    INSERT INTO weather_data
-                    (polygon_id, temperature_c, temp_min_c, temp_max_c, humidity_percent, pressure_hpa, wind_speed_ms, wind_deg, clouds_percent, weather_main, weather_description, dew_point_c)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                """, (
-                    'los_valles_veraguas',
-                    w.get('temp'),
-                    w.get('temp_min'),
-                    w.get('temp_max'),
-                    w.get('humidity'),
-                    w.get('pressure'),
-                    w.get('wind_speed'),
-                    w.get('wind_deg'),
-                    w.get('clouds'),
-                    'OpenWeather',
-                    w.get('description'),
-                    w.get('dew_point')
-                ))
-                print(f"[OK] Clima guardado en BD (Punto de rocío: {w.get('dew_point')}°C)")
-            
-            # Insertar NDVI/NDWI/NDSI
-            if 'ndvi' in results or 'ndwi' in results or 'ndsi' in results:
-                cur.execute("""
-                    INSERT INTO ndvi_data 
-                    (polygon_id, ndvi_mean, ndvi_min, ndvi_max, ndwi_mean, ndsi_mean, ndsi_interpretation, cloud_coverage)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                """, (
-                    'los_valles_veraguas',
-                    results.get('ndvi', {}).get('ndvi_mean'),
-                    results.get('ndvi', {}).get('ndvi_min'),
-                    results.get('ndvi', {}).get('ndvi_max'),
-                    results.get('ndwi', {}).get('ndwi_mean'),
-                    results.get('ndsi', {}).get('ndsi_mean'),
-                    results.get('ndsi', {}).get('interpretation'),
-                    0.0 # Cloud coverage placeholder
-                ))
-            
-            # Insertar Suelo (Open-Meteo)
-            if 'soil' in results and results['soil']:
-                s = results['soil']
-                cur.execute("""
-                    INSERT INTO soil_data
-                    (polygon_id, soil_temp_c, soil_moisture, soil_moisture_percent)
-                    VALUES (%s, %s, %s, %s)
-                """, (
-                    'los_valles_veraguas',
-                    s.get('soil_temp_c'),
-                    s.get('soil_moisture'),
-                    s.get('soil_moisture_percent')
-                ))
-                print("[OK] Suelo guardado en BD")
-            
-            conn.commit()
-            cur.close()
-            conn.close()
-            print("[OK] Datos guardados en Base de Datos Neon")
-    except Exception as e:
-        print(f"[ERROR] Guardando en BD: {e}")
+    history_store.append(row)
+    print(f"[OK] Datos guardados en historial: {history_store.HISTORY_DIR}")
+    
+    # 2. Escribir las filas en el spool (db_writer); con flush=False el
+    #    llamador replica varias fincas en una sola transacción
+    if 'weather' in results and results['weather']:
+        w = results['weather']
+        db_writer.add('weather_data', {
+            'timestamp': w.get('observed_at') or timestamp,
+            'polygon_id': polygon_id,
+            'source': 'OpenWeather',
+            'temperature_c': w.get('temp'),
+            'temp_min_c': w.get('temp_min'),
+            'temp_max_c': w.get('temp_max'),
+            'humidity_percent': w.get('humidity'),
+            'pressure_hpa': w.get('pressure'),
+            'wind_speed_ms': w.get('wind_speed'),
+            'wind_deg': w.get('wind_deg'),
+            'clouds_percent': w.get('clouds'),
+            'weather_main': 'OpenWeather',
+            'weather_description': w.get('description'),
+            'dew_point_c': w.get('dew_point')
+        })
+    
+    # Escena que resolvió el mosaico: ndvi_data y zone_stats se identifican
+    # por la fecha de adquisición; sin ella (catálogo no disponible) no se
+    # guardan, porque la fecha del cálculo cambia en cada ejecución
+    scene = results.get('scene') or {}
+    image_date = scene.get('datetime')
+    has_indices = any(results.get(index) for index in SPECTRAL_INDICES)
+    if has_indices and not image_date:
+        print(f"[WARN] {polygon_id}: índices sin fecha de adquisición, no se guardan en ndvi_data")
+    
+    if has_indices and image_date:
+        db_writer.add('ndvi_data', {
+            # timestamp = momento de la escena, como en clima y suelo: un
+            # backfill de escenas viejas no pasa a ser el NDVI "más reciente"
+            'timestamp': image_date,
+            'polygon_id': polygon_id,
+            'image_date': image_date,
+            'ndvi_mean': results.get('ndvi', {}).get('ndvi_mean'),
+            'ndvi_min': results.get('ndvi', {}).get('ndvi_min'),
+            'ndvi_max': results.get('ndvi', {}).get('ndvi_max'),
+            'ndvi_std': results.get('ndvi', {}).get('ndvi_std'),
+            'ndwi_mean': results.get('ndwi', {}).get('ndwi_mean'),
+            'ndsi_mean': results.get('ndsi', {}).get('ndsi_mean'),
+            'ndsi_interpretation': results.get('ndsi', {}).get('interpretation'),
+            'cloud_coverage': scene.get('cloud_cover')
+        })
+    
+    # Estadísticas por zona de cultivo
+    for zone, zone_indices in (results.get('zones') or {}).items() if image_date else ():
+        for index, stats in zone_indices.items():
+            percentiles = stats.get(f'{index}_percentiles', {})
+            db_writer.add('zone_stats', {
+                'polygon_id': polygon_id,
+                'zone': zone,
+                'index_name': index,
+                'image_date': image_date,
+                'mean': stats[f'{index}_mean'],
+                'min': stats[f'{index}_min'],
+                'max': stats[f'{index}_max'],
+                'std': stats.get(f'{index}_std'),
+                'p25': percentiles.get(25),
+                'p50': percentiles.get(50),
+                'p75': percentiles.get(75),
+                'valid_fraction': stats.get('valid_fraction')
+            })
+    
+    # Suelo (Open-Meteo)
+    if 'soil' in results and results['soil']:
+        s = results['soil']
+        db_writer.add('soil_data', {
+            'timestamp': s.get('observed_at') or timestamp,
+            'polygon_id': polygon_id,
+            'source': 'Open-Meteo',
+            'soil_temp_c': s.get('soil_temp_c'),
+            'soil_moisture': s.get('soil_moisture'),
+            'soil_moisture_percent': s.get('soil_moisture_percent')
+        })
+    
+    if flush:
+        return flush_results()
+
+def flush_results():
+    """
+    Sella las filas de save_results en el spool para replicarlas a la BD
+    
+    No espera a la BD: retorna True en cuanto las filas son durables en disco.
+    """
+    sealed = db_writer.flush()
+    if sealed is None:
+        print("[ERROR] Guardando en BD: no se pudo escribir el spool local")
+        return False
+    if sealed:
+        print(f"[OK] {sealed} fila(s) en el spool local, replicando a Base de Datos Neon")
+    return True
+
+def drain_results(timeout=None):
+    """Espera (acotado) a que el spool llegue a la BD antes de terminar"""
+    if db_writer.drain(timeout):
+        return True
+    print(f"[WARN] BD no disponible: {db_writer.pending()} fila(s) quedan en el spool "
+          f"({spool.SPOOL_DIR}) para la próxima ejecución")
+    return False
+
+# ============================================================
+# PLANIFICADOR DE MODO (PRESUPUESTO DE CUOTA)
+# ============================================================
+
+# Modos de más completo a más económico; 'none' solo recolecta clima y suelo
+MODE_LADDER = ('normal', 'economic', 'stats', 'minimal')
+
+# Días entre pasadas de Sentinel-2 sobre la finca (constelación de 2 satélites)
+SCENE_REVISIT_DAYS = float(os.environ.get('SCENE_REVISIT_DAYS', 5))
+
+# Fracción de la cuota restante que el planificador puede comprometer;
+# el resto queda de margen para ejecuciones manuales y --force
+PLANNER_BUDGET_SHARE = float(os.environ.get('PLANNER_BUDGET_SHARE', 0.9))
+
+def plan_collection_mode(status=None, groups=None):
+    """
+    Elige qué productos pedir en esta ejecución según la cuota restante
+    
+    Con el pre-flight del catálogo Sentinel solo se procesa cuando hay una
+    escena nueva, así que el gasto del resto del mes es aproximadamente
+    (escenas esperadas) x (costo medido del modo sobre todas las fincas). La
+    cuota restante se reparte en partes iguales entre las escenas que faltan
+    y se elige el modo más completo que cabe en su parte, de modo que el
+    gasto queda distribuido hasta fin de mes en lugar de agotarse antes.
+    
+    Returns:
+        tuple: (modo, motivo)
+    """
+    status = status or get_quota_status()
+    expected_scenes = max(1, math.ceil(status['days_remaining'] / SCENE_REVISIT_DAYS))
+    pu_per_scene = status['pu_remaining'] * PLANNER_BUDGET_SHARE / expected_scenes
+    requests_per_scene = status['requests_remaining'] / expected_scenes
+    
+    for mode in MODE_LADDER:
+        cost = estimate_mode_pu(mode, groups)
+        requests_needed = sum(len(_build_sentinel_tasks(mode, group)) for group in groups or [None])
+        if cost <= pu_per_scene and requests_needed <= requests_per_scene:
+            return mode, (f"~{cost:.0f} PU por escena, presupuesto {pu_per_scene:.0f} PU "
+                          f"para ~{expected_scenes} escenas restantes")
+    return 'none', (f"presupuesto {pu_per_scene:.0f} PU por escena no alcanza "
+                    f"ni para modo minimal (~{estimate_mode_pu('minimal', groups):.0f} PU)")
 
 # ============================================================
 # MAIN
 # ============================================================
 
-def collect_all_copernicus_data(mode='normal'):
+def _build_sentinel_tasks(mode, group=None):
     """
-    Recolecta todos los datos de las APIs de Copernicus
+    Tareas Sentinel Hub de cada modo sobre un grupo de fincas, en orden de
+    prioridad de cuota
+    
+    Returns:
+        list: tuplas (clave, operación de cuota, descripción, función, alcance);
+              cada función retorna {polygon_id: resultado} y el alcance es el
+              grupo de fincas entre las que se reparte su costo
+    """
+    group = group or make_farm_group([_default_farm()])
+    if mode == 'normal':
+        # MODO COMPLETO: ~90 PU (el mapa NDVI se colorea desde el raster de índices)
+        return [
+            ('map_rgb', 'map_rgb', 'Mapa RGB satelital', lambda: fetch_satellite_maps(group, 'rgb'), group),
+            ('indices', 'spectral_indices', 'NDVI/NDWI/NDSI de Sentinel-2 + mapa NDVI',
+             lambda: fetch_spectral_indices(group, render_maps=True), group),
+        ]
+    elif mode == 'economic':
+        # MODO ECONÓMICO: Solo índices, una solicitud ~40 PU
+        return [
+            ('indices', 'spectral_indices', 'NDVI/NDWI/NDSI de Sentinel-2', lambda: fetch_spectral_indices(group), group),
+        ]
+    elif mode == 'stats':
+        # MODO ESTADÍSTICAS: índices agregados en el servidor, sin rasters.
+        # La Statistical API acepta una geometría por solicitud: una por finca
+        return [
+            ('indices', 'zonal_stats', f"Estadísticas NDVI/NDWI/NDSI ({farm['id']})",
+             lambda farm=farm: {farm['id']: get_zonal_statistics(farm=farm)}, make_farm_group([farm]))
+            for farm in group['farms']
+        ]
+    elif mode == 'minimal':
+        # MODO MÍNIMO: Solo NDVI ~30 PU
+        return [
+            ('indices', 'ndvi', 'NDVI de Sentinel-2', lambda: fetch_spectral_indices(group, indices=['ndvi']), group),
+        ]
+    else:  # none
+        # SIN SENTINEL: solo fuentes gratuitas (clima y suelo)
+        return []
+
+def _build_free_tasks(farm):
+    """Fuentes sin costo de cuota Copernicus para una finca"""
+    return [
+        ('weather', 'Clima actual (OpenWeather)', lambda: get_weather_data(farm)),
+        ('soil', 'Datos de suelo (Open-Meteo)', lambda: get_soil_data(farm)),
+    ]
+
+def _timed_call(func):
+    """
+    Ejecuta func y retorna (resultado, segundos transcurridos, solicitudes Sentinel)
+    """
+    started = time.perf_counter()
+    start_request_log()
+    try:
+        value = func()
+    except Exception as e:
+        print(f"[ERROR] Tarea de recolección: {e}")
+        value = None
+    return value, time.perf_counter() - started, collect_request_log()
+
+def _settle_task_quota(reservation, label, value, requests_made, shares=None):
+    """
+    Liquida la reserva de una tarea con las PU reales reportadas por
+    Sentinel Hub, repartidas entre las fincas según shares; la libera si
+    falló o se sirvió desde caché
+    """
+    fetched = [entry for entry in requests_made if not entry['cached']]
+    if not value:
+        release_quota(reservation)
+    elif requests_made and not fetched:
+        print(f"[CACHE] {label}: sin costo de cuota")
+        release_quota(reservation)
+    elif fetched and all(entry.get('pu') is not None for entry in fetched):
+        pu_spent = sum(entry['pu'] for entry in fetched)
+        # Una muestra por solicitud: cada tesela con su propia forma y costo
+        samples = [
+            (request_shape(reservation['operation'], [entry['size']]), entry['pu'])
+            for entry in fetched
+        ]
+        print(f"[QUOTA] {label}: {pu_spent:.2f} PU reales en {len(fetched)} solicitud(es) "
+              f"(estimado {reservation['pu']})")
+        settle_quota(reservation, pu_spent, samples, shares, requests=len(fetched))
+    else:
+        settle_quota(reservation, shares=shares, requests=max(len(fetched), 1))
+
+# Claves de resultados que provienen de solicitudes Sentinel Hub
+SENTINEL_RESULT_KEYS = ('map_rgb', 'map_ndvi') + tuple(SPECTRAL_INDICES)
+
+def _store_task_result(results, key, value):
+    """Incorpora el resultado de una tarea al diccionario de resultados"""
+    if key == 'indices':
+        for index in SPECTRAL_INDICES:
+            if index in value:
+                results[index] = value[index]
+        if value.get('zones'):
+            results['zones'] = value['zones']
+        if value.get('map_ndvi'):
+            results['map_ndvi'] = value['map_ndvi']
+    else:
+        results[key] = value
+
+def _request_acquisition(requests_made):
+    """Adquisición que resolvió el mosaico en las solicitudes de una tarea (o None)"""
+    return next(
+        (entry['acquisition'] for entry in requests_made if entry.get('acquisition')), None
+    )
+
+def _archive_indices(group, value, requests_made):
+    """
+    Agrega los rasters de índices de cada finca al archivo local
+    (raster_archive), identificados por la escena que resolvió el mosaico
+    """
+    acquisition = _request_acquisition(requests_made)
+    for farm in group['farms']:
+        result = value.get(farm['id'])
+        if not result or not result.get('rasters'):
+            continue
+        date = acquisition['datetime'][:10] if acquisition else result['date'][:10]
+        try:
+            if raster_archive.append(
+                farm['id'], date, result['rasters'], result['mask'],
+                acquisition_id=acquisition['id'] if acquisition else None,
+                bbox=farm['bbox']
+            ):
+                print(f"[OK] Rasters archivados: {farm['id']} {date}")
+        except (OSError, ValueError) as e:
+            print(f"[WARN] No se pudieron archivar los rasters de {farm['id']}: {e}")
+
+def _preflight_group(group):
+    """Pre-flight de catálogo para un grupo de fincas"""
+    return check_new_acquisition(
+        [farm['id'] for farm in group['farms']], bbox=group['bbox']
+    )
+
+def _print_farm_summary(farm, results):
+    print(f"\n  [{farm['id']}] {farm['nombre']}")
+    if results.get('scene'):
+        print(f"    Escena: {results['scene']['datetime'][:10]} ({results['scene']['cloud_cover']}% nubes)")
+    if results.get('map_rgb'):
+        print(f"    Mapa RGB: {results['map_rgb']}")
+    if results.get('map_ndvi'):
+        print(f"    Mapa NDVI: {results['map_ndvi']}")
+    if results.get('ndvi'):
+        print(f"    NDVI promedio: {results['ndvi']['ndvi_mean']:.4f}")
+    if results.get('ndwi'):
+        print(f"    NDWI promedio: {results['ndwi']['ndwi_mean']:.4f}")
+    if results.get('ndsi'):
+        print(f"    NDSI promedio: {results['ndsi']['ndsi_mean']:.4f} ({results['ndsi']['interpretation']})")
+
+def collect_all_copernicus_data(mode='normal', concurrent=True, force=False, farms=None):
+    """
+    Recolecta todos los datos de las APIs de Copernicus para cada finca
+    
+    Las fincas cercanas se agrupan (group_farms) y comparten las solicitudes
+    Sentinel; clima y suelo se consultan por finca. Todas las tareas corren
+    en un pool acotado a COLLECTOR_MAX_WORKERS hilos.
     
     Args:
-        mode: 'normal' (todos los datos ~220 PU) 
-              'economic' (solo índices ~90 PU)
-              'minimal' (solo NDVI ~30 PU)
+        mode: 'normal' (todos los datos ~90 PU por grupo) 
+              'economic' (solo índices ~40 PU por grupo)
+              'stats' (estadísticas de índices via Statistical API, por finca)
+              'minimal' (solo NDVI ~30 PU por grupo)
+              'none' (solo clima y suelo, sin Sentinel)
+              'auto' (lo elige plan_collection_mode según la cuota)
+        concurrent: Si es True, consulta las fuentes en paralelo y el tiempo
+                    total es el de la fuente más lenta
+        force: Procesar Sentinel aunque el catálogo no muestre escenas nuevas
+        farms: Fincas a recolectar (por defecto, load_farms())
+    
+    Returns:
+        dict: {'farms': {polygon_id: resultados}, 'timings': {...}}
     """
+    farms = farms or load_farms()
+    groups = group_farms(farms)
+    
+    plan_reason = None
+    if mode == 'auto':
+        mode, plan_reason = plan_collection_mode(groups=groups)
+    
     print("\n" + "="*60)
     print("  AGROMONITOR PRO - COPERNICUS DATA COLLECTOR")
     print("="*60)
     print(f"  Fecha/Hora: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-    print(f"  Ubicación: Veraguas, Panamá")
-    print(f"  Modo: {mode.upper()}")
+    print(f"  Fincas: {len(farms)} en {len(groups)} grupo(s) de solicitudes Sentinel")
+    print(f"  Modo: {mode.upper()} ({'concurrente' if concurrent else 'secuencial'})")
+    if plan_reason:
+        print(f"  Planificador: {plan_reason}")
     print("="*60)
     
     # Mostrar estado de cuota primero
     print_quota_status()
     
     # Verificar cuota general antes de empezar
-    estimated_pu = {'normal': 220, 'economic': 90, 'minimal': 30}
-    if not check_quota('collection', estimated_pu.get(mode, 220)):
+    has_sentinel = bool(_build_sentinel_tasks(mode))
+    if has_sentinel and not check_quota('collection', estimate_mode_pu(mode, groups)):
         print("\n⚠️ No hay suficiente cuota para esta operación.")
         print("   Intenta con mode='minimal' o espera al próximo mes.")
         return None
     
-    results = {}
-    
-    # 0. Clima Actual (OpenWeatherMap) - No consume cuota Copernicus
-    print("\n[0/6] Obteniendo clima actual (OpenWeather)...")
-    results['weather'] = get_weather_data()
-    
-    # 0.5 Datos de Suelo (Open-Meteo) - No consume cuota Copernicus
-    print("\n[0.5/6] Obteniendo datos de suelo (Open-Meteo)...")
-    results['soil'] = get_soil_data()
-    
-    if mode == 'normal':
-        # MODO COMPLETO: ~220 PU
-        
-        # 1. Mapa RGB satelital (~50 PU)
-        print("\n[1/5] Generando mapa RGB satelital...")
-        if check_quota('map_rgb', PU_COSTS['map_rgb']):
-            results['map_rgb'] = get_satellite_map('rgb')
-            if results['map_rgb']:
-                use_quota('map_rgb')
+    results = {farm['id']: {} for farm in farms}
+    timings = {}
+    run_started = time.perf_counter()
+    start_http_budget()
+    # Lo que quedó en el spool de ejecuciones previas se replica mientras tanto
+    db_writer.start()
+    max_workers = COLLECTOR_MAX_WORKERS if concurrent else 1
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Pre-flight: solo procesar los grupos cuyo catálogo muestra una escena
+        # nueva y despejada
+        preflights = {}
+        if has_sentinel:
+            print(f"\n[CATALOG] Buscando adquisiciones Sentinel-2 nuevas ({len(groups)} grupos)...")
+            futures = {group['id']: executor.submit(_timed_call, lambda g=group: _preflight_group(g))
+                       for group in groups}
+            for group in groups:
+                preflight, seconds, _ = futures[group['id']].result()
+                timings['catalog'] = max(timings.get('catalog', 0), seconds)
+                print(f"[CATALOG] {group['id']}: {preflight['reason']}")
+                if preflight['process'] or force:
+                    preflights[group['id']] = preflight
+                    for farm in group['farms']:
+                        results[farm['id']]['scene'] = preflight['mosaic']
+        if has_sentinel and not preflights:
+            print("[CATALOG] Se omite el procesamiento Sentinel en esta ejecución")
         
-        # 2. Mapa NDVI coloreado (~50 PU)
-        print("\n[2/5] Generando mapa NDVI coloreado...")
-        if check_quota('map_ndvi', PU_COSTS['map_ndvi']):
-            results['map_ndvi'] = get_satellite_map('ndvi')
-            if results['map_ndvi']:
-                use_quota('map_ndvi')
+        # 1. Reservar cuota de las tareas Sentinel en orden de prioridad; cada
+        #    reserva descuenta del disponible antes de lanzar las solicitudes
+        tasks = []
+        for group in groups:
+            if group['id'] not in preflights:
+                continue
+            for key, operation, label, func, scope in _build_sentinel_tasks(mode, group):
+                reservation = reserve_quota(operation)
+                if reservation:
+                    tasks.append((scope, key, reservation, f"{label} [{group['id']}]", func))
+                else:
+                    print(f"[QUOTA] Omitido: {label} [{group['id']}]")
+        for farm in farms:
+            for key, label, func in _build_free_tasks(farm):
+                tasks.append((farm, key, None, label, func))
         
-        # 3. NDVI valor numérico (~30 PU)
-        print("\n[3/5] Obteniendo NDVI de Sentinel-2...")
-        if check_quota('ndvi', PU_COSTS['ndvi']):
-            results['ndvi'] = get_ndvi_sentinel()
-            if results['ndvi']:
-                use_quota('ndvi')
+        # 2. Ejecutar todas las tareas en el pool acotado
+        print(f"\n[RUN] Consultando {len(tasks)} tareas con {max_workers} hilo(s)...")
+        futures = [executor.submit(_timed_call, task[-1]) for task in tasks]
         
-        # 4. NDWI valor numérico (~30 PU)
-        print("\n[4/5] Obteniendo NDWI de Sentinel-2...")
-        if check_quota('ndwi', PU_COSTS['ndwi']):
-            results['ndwi'] = get_ndwi_sentinel()
-            if results['ndwi']:
-                use_quota('ndwi')
-        
-        # 5. NDSI valor numérico (~30 PU)
-        print("\n[5/5] Obteniendo NDSI de Sentinel-2...")
-        if check_quota('ndsi', PU_COSTS['ndsi']):
-            results['ndsi'] = get_ndsi_sentinel()
-            if results['ndsi']:
-                use_quota('ndsi')
-    
-    elif mode == 'economic':
-        # MODO ECONÓMICO: Solo índices ~90 PU
-        
-        print("\n[1/3] Obteniendo NDVI de Sentinel-2...")
-        if check_quota('ndvi', PU_COSTS['ndvi']):
-            results['ndvi'] = get_ndvi_sentinel()
-            if results['ndvi']:
-                use_quota('ndvi')
-        
-        print("\n[2/3] Obteniendo NDWI de Sentinel-2...")
-        if check_quota('ndwi', PU_COSTS['ndwi']):
-            results['ndwi'] = get_ndwi_sentinel()
-            if results['ndwi']:
-                use_quota('ndwi')
-        
-        print("\n[3/3] Obteniendo NDSI de Sentinel-2...")
-        if check_quota('ndsi', PU_COSTS['ndsi']):
-            results['ndsi'] = get_ndsi_sentinel()
-            if results['ndsi']:
-                use_quota('ndsi')
-    
-    else:  # minimal
-        # MODO MÍNIMO: Solo NDVI ~30 PU
-        
-        print("\n[1/1] Obteniendo NDVI de Sentinel-2...")
-        if check_quota('ndvi', PU_COSTS['ndvi']):
-            results['ndvi'] = get_ndvi_sentinel()
-            if results['ndvi']:
-                use_quota('ndvi')
+        # 3. Liquidar las reservas en el mismo orden en que se hicieron
+        for (owner, key, reservation, label, func), future in zip(tasks, futures):
+            value, seconds, requests_made = future.result()
+            timings[key] = max(timings.get(key, 0), seconds)
+            if reservation is None:
+                if value:
+                    results[owner['id']][key] = value
+                continue
+            value = {polygon_id: farm_value for polygon_id, farm_value in (value or {}).items() if farm_value}
+            for polygon_id, farm_value in value.items():
+                _store_task_result(results[polygon_id], key, farm_value)
+            if key == 'indices' and value:
+                _archive_indices(owner, value, requests_made)
+                # Sin pre-flight de catálogo, la escena es la que registró la solicitud
+                acquisition = _request_acquisition(requests_made)
+                for polygon_id in value:
+                    if acquisition and not results[polygon_id].get('scene'):
+                        results[polygon_id]['scene'] = acquisition
+            _settle_task_quota(reservation, label, value, requests_made, farm_shares(owner))
+    
+    # Recordar la escena procesada para no repetirla en próximas ejecuciones
+    for group in groups:
+        preflight = preflights.get(group['id'])
+        if not preflight or not preflight['newest']:
+            continue
+        processed = [
+            farm['id'] for farm in group['farms']
+            if any(key in results[farm['id']] for key in SENTINEL_RESULT_KEYS)
+        ]
+        if processed:
+            _mark_acquisition_processed(processed, preflight['newest'])
+    
+    total_elapsed = time.perf_counter() - run_started
+    start_http_budget(0)
     
     # Resumen
     print("\n" + "="*60)
     print("  RESUMEN")
     print("="*60)
-    if results.get('map_rgb'):
-        print(f"  Mapa RGB: {results['map_rgb']}")
-    if results.get('map_ndvi'):
-        print(f"  Mapa NDVI: {results['map_ndvi']}")
-    if results.get('ndvi'):
-        print(f"  NDVI promedio: {results['ndvi']['ndvi_mean']:.4f}")
-    if results.get('ndwi'):
-        print(f"  NDWI promedio: {results['ndwi']['ndwi_mean']:.4f}")
-    if results.get('ndsi'):
-        print(f"  NDSI promedio: {results['ndsi']['ndsi_mean']:.4f} ({results['ndsi']['interpretation']})")
+    for farm in farms:
+        _print_farm_summary(farm, results[farm['id']])
+    
+    print("\n  Tiempos por fuente (la tarea más lenta de cada tipo):")
+    for key, seconds in timings.items():
+        print(f"    {key:<10} {seconds:6.2f} s")
+    print(f"    {'total':<10} {total_elapsed:6.2f} s")
     
     # Estado final de cuota
     print_quota_status()
     
-    # Guardar resultados
-    save_results(results)
+    # Guardar resultados: todas las fincas en una sola escritura a la BD
+    for farm in farms:
+        save_results(results[farm['id']], farm['id'], flush=False)
+    flush_results()
+    drain_results()
     
-    return results
+    return {'farms': results, 'timings': timings}
 
 def collect_economic():
-    """Atajo para recolección económica (~90 PU)"""
+    """Atajo para recolección económica (~40 PU)"""
     return collect_all_copernicus_data(mode='economic')
 
 def collect_minimal():
     """Atajo para recolección mínima (~30 PU)"""
     return collect_all_copernicus_data(mode='minimal')
 
+# ============================================================
+# BACKFILL HISTÓRICO
+# ============================================================
+
+# Avance de cada backfill: las ventanas terminadas no se repiten al reanudar
+BACKFILL_STATE_FILE = os.path.join(os.path.dirname(__file__), 'data', 'backfill_state.json')
+
+# Ventanas en paralelo (cada una es una solicitud Process API por grupo)
+BACKFILL_MAX_WORKERS = int(os.environ.get('BACKFILL_MAX_WORKERS', 4))
+
+def backfill_windows(start_date, end_date, window_days=None):
+    """
+    Divide un rango en ventanas del tamaño de la revisita de Sentinel-2
+    
+    Returns:
+        list: [(inicio, fin)] como datetime, la última recortada al rango
+    """
+    window_days = window_days or SCENE_REVISIT_DAYS
+    start_date, end_date = _resolve_time_interval(start_date, end_date)
+    windows = []
+    window_start = start_date
+    while window_start < end_date:
+        window_end = min(window_start + timedelta(days=window_days), end_date)
+        windows.append((window_start, window_end))
+        window_start = window_end
+    return windows
+
+def _load_backfill_state():
+    if os.path.exists(BACKFILL_STATE_FILE):
+        try:
+            with open(BACKFILL_STATE_FILE, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"[WARN] Estado de backfill ilegible, se empieza de cero: {e}")
+    return {'jobs': {}}
+
+def _save_backfill_state(state):
+    os.makedirs(os.path.dirname(BACKFILL_STATE_FILE), exist_ok=True)
+    tmp_path = f"{BACKFILL_STATE_FILE}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=4)
+    os.replace(tmp_path, BACKFILL_STATE_FILE)
+
+def _backfill_window(group, window_start, window_end, indices):
+    """
+    Procesa una ventana de un grupo: si el catálogo no tiene escenas no se
+    hace la solicitud Process API
+    
+    Returns:
+        dict: {'scene': adquisición o None, 'results': {polygon_id: resultado}}
+    """
+    acquisitions = search_sentinel_acquisitions(window_start, window_end, bbox=group['bbox'])
+    if acquisitions is not None and not acquisitions:
+        return {'scene': None, 'results': {}}
+    scene = select_mosaic_acquisition(acquisitions)
+    results = fetch_spectral_indices(group, window_start, window_end, indices)
+    if not results:
+        return None
+    for result in results.values():
+        result['scene'] = scene
+    return {'scene': scene, 'results': results}
+
+def backfill(start_date, end_date, window_days=None, farms=None, indices=None, workers=None):
+    """
+    Reconstruye el historial de índices de un rango de fechas
+    
+    El rango se recorre en ventanas de SCENE_REVISIT_DAYS días. Cada
+    ventana x grupo de fincas reserva su cuota en el ledger justo antes de
+    lanzarse, y a lo sumo 'workers' corren a la vez. Cada ventana terminada
+    (con datos o sin escenas) se anota en data/backfill_state.json: si la
+    ejecución se interrumpe o se agota la cuota, volver a lanzar el mismo
+    comando continúa con las ventanas pendientes.
+    
+    Args:
+        start_date, end_date: Rango a reconstruir ('YYYY-MM-DD' o datetime)
+        window_days: Días por ventana (por defecto SCENE_REVISIT_DAYS)
+        farms: Fincas de load_farms() (por defecto todas)
+        indices: Índices a calcular (por defecto NDVI, NDWI y NDSI)
+        workers: Ventanas en paralelo (por defecto BACKFILL_MAX_WORKERS)
+    
+    Returns:
+        dict: {'done', 'empty', 'failed', 'pending'} ventanas por estado
+    """
+    window_days = window_days or SCENE_REVISIT_DAYS
+    workers = workers or BACKFILL_MAX_WORKERS
+    indices = list(indices or SPECTRAL_INDICES)
+    operation = 'spectral_indices' if indices == list(SPECTRAL_INDICES) else 'ndvi'
+    windows = backfill_windows(start_date, end_date, window_days)
+    groups = group_farms(farms or load_farms())
+    
+    if not windows:
+        print("[WARN] Rango de backfill vacío")
+        return {'done': 0, 'empty': 0, 'failed': 0, 'pending': 0}
+    
+    job_key = f"{windows[0][0].date()}_{windows[-1][1].date()}_{window_days:g}d_{'-'.join(indices)}"
+    state = _load_backfill_state()
+    job = state['jobs'].setdefault(job_key, {'created_at': datetime.now().isoformat(), 'windows': {}})
+    
+    todo = [
+        (group, window_start, window_end)
+        for window_start, window_end in windows
+        for group in groups
+        if f"{window_start.date()}|{group['id']}" not in job['windows']
+    ]
+    
+    print("\n" + "="*60)
+    print(f"  BACKFILL {windows[0][0].date()} -> {windows[-1][1].date()}")
+    print("="*60)
+    print(f"  Ventanas: {len(windows)} x {len(groups)} grupo(s) | "
+          f"ya terminadas: {len(windows) * len(groups) - len(todo)} | pendientes: {len(todo)}")
+    
+    counts = {'done': 0, 'empty': 0, 'failed': 0, 'pending': 0}
+    pending = iter(todo)
+    db_writer.start()
+    in_flight = {}
+    quota_exhausted = False
+    
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        def submit_next():
+            nonlocal quota_exhausted
+            if quota_exhausted:
+                return
+            task = next(pending, None)
+            if not task:
+                return
+            group, window_start, window_end = task
+            reservation = reserve_quota(operation)
+            if not reservation:
+                print("[QUOTA] Cuota agotada: el backfill se detiene y puede reanudarse luego")
+                quota_exhausted = True
+                counts['pending'] += 1
+                return
+            future = executor.submit(
+                _timed_call, lambda: _backfill_window(group, window_start, window_end, indices)
+            )
+            in_flight[future] = (group, window_start, reservation)
+        
+        for _ in range(workers):
+            submit_next()
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                group, window_start, reservation = in_flight.pop(future)
+                outcome, seconds, requests_made = future.result()
+                label = f"Backfill {window_start.date()} [{group['id']}]"
+                results = outcome['results'] if outcome else None
+                _settle_task_quota(reservation, label, results, requests_made, farm_shares(group))
+                
+                if outcome is None:
+                    print(f"[ERROR] {label}: falló, quedará pendiente")
+                    counts['failed'] += 1
+                elif not results:
+                    print(f"[CATALOG] {label}: sin escenas en la ventana")
+                    counts['empty'] += 1
+                else:
+                    _archive_indices(group, results, requests_made)
+                    # El historial local lleva la fecha de la escena, no la de hoy
+                    scene = outcome['scene'] or _request_acquisition(requests_made)
+                    for result in results.values():
+                        result['scene'] = result.get('scene') or scene
+                    observed = datetime.fromisoformat(scene['datetime'].replace('Z', '+00:00')) \
+                        if scene else window_start
+                    for polygon_id, result in results.items():
+                        save_results(result, polygon_id, flush=False, timestamp=observed)
+                    # La ventana solo se marca terminada si quedó en el spool
+                    if flush_results():
+                        counts['done'] += 1
+                        print(f"[OK] {label}: {len(results)} finca(s) en {seconds:.1f} s")
+                    else:
+                        outcome = None
+                        counts['failed'] += 1
+                
+                # Solo este hilo escribe el estado: se guarda tras cada ventana
+                if outcome is not None:
+                    job['windows'][f"{window_start.date()}|{group['id']}"] = {
+                        'status': 'done' if results else 'empty',
+                        'scene': outcome['scene']['id'] if outcome['scene'] else None,
+                        'finished_at': datetime.now().isoformat()
+                    }
+                    _save_backfill_state(state)
+                submit_next()
+    
+    counts['pending'] += sum(1 for _ in pending)
+    print(f"\n[OK] Backfill: {counts['done']} con datos, {counts['empty']} sin escenas, "
+          f"{counts['failed']} fallidas, {counts['pending']} pendientes")
+    if counts['failed'] or counts['pending']:
+        print("     Vuelve a ejecutar el mismo comando para reanudar")
+    drain_results()
+    print_quota_status()
+    return counts
+
 if __name__ == "__main__":
     import sys
     
     # Permitir seleccionar modo desde línea de comandos
-    mode = 'economic'  # Por defecto económico para ahorrar cuota
-    if len(sys.argv) > 1:
-        if sys.argv[1] in ['normal', 'economic', 'minimal', 'status']:
-            if sys.argv[1] == 'status':
+    # --sequential desactiva la consulta concurrente de fuentes
+    # --force procesa Sentinel aunque el catálogo no muestre escenas nuevas
+    concurrent = '--sequential' not in sys.argv
+    force = '--force' in sys.argv
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    
+    mode = 'auto'  # Por defecto el planificador reparte la cuota del mes
+    if len(args) > 0 and args[0] == 'backfill':
+        if len(args) < 3:
+            print("Uso: python copernicus_collector.py backfill YYYY-MM-DD YYYY-MM-DD [--window=5] [--workers=4] [--indices=ndvi,ndwi]")
+            sys.exit(1)
+        options = dict(arg[2:].split('=', 1) for arg in sys.argv[1:] if arg.startswith('--') and '=' in arg)
+        backfill(
+            args[1], args[2],
+            window_days=float(options['window']) if 'window' in options else None,
+            workers=int(options['workers']) if 'workers' in options else None,
+            indices=options['indices'].split(',') if 'indices' in options else None
+        )
+    elif len(args) > 0 and args[0] == 'era5':
+        # Clima histórico ERA5-Land: solo los tramos mensuales que faltan
+        get_climate_data_cds(
+            start_date=args[1] if len(args) > 1 else None,
+            end_date=args[2] if len(args) > 2 else None
+        )
+    elif len(args) > 0:
+        if args[0] in ['auto', 'normal', 'economic', 'stats', 'minimal', 'none', 'status']:
+            if args[0] == 'status':
                 print_quota_status()
+                planned, reason = plan_collection_mode(groups=group_farms(load_farms()))
+                print(f"[PLAN] Modo automático: {planned} ({reason})")
             else:
-                mode = sys.argv[1]
-                collect_all_copernicus_data(mode=mode)
+                mode = args[0]
+                collect_all_copernicus_data(mode=mode, concurrent=concurrent, force=force)
     else:
         # Sin argumentos, mostrar status y preguntar
         print_quota_status()
-        print("Uso: python copernicus_collector.py [normal|economic|minimal|status]")
-        print("  normal   - Todos los datos (~220 PU)")
-        print("  economic - Solo índices (~90 PU)")
+        print("Uso: python copernicus_collector.py [auto|normal|economic|stats|minimal|none|status|backfill|era5] [--sequential] [--force]")
+        print("  auto     - Elige el modo según la cuota restante del mes")
+        print("  normal   - Todos los datos (~90 PU)")
+        print("  economic - Solo índices (~40 PU)")
+        print("  stats    - Estadísticas de índices sin descargar rasters (~40 PU)")
         print("  minimal  - Solo NDVI (~30 PU)")
+        print("  none     - Solo clima y suelo (sin Sentinel)")
         print("  status   - Ver estado de cuota")
-        print("\nEjecutando modo económico por defecto...")
-        collect_all_copernicus_data(mode='normal')
+        print("  backfill INICIO FIN - Reconstruye el historial por ventanas (reanudable)")
+        print("  era5 [INICIO] [FIN] - Clima diario ERA5-Land en climate_daily (solo meses faltantes)")
+        print("  --sequential - Consultar las fuentes una tras otra")
+        print("  --force      - Procesar Sentinel aunque no haya escena nueva")
+        print("\nEjecutando modo automático por defecto...")
+        collect_all_copernicus_data(mode=mode, concurrent=concurrent, force=force)
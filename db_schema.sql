@@ -5,8 +5,9 @@
 -- Tabla de datos del clima
 CREATE TABLE IF NOT EXISTS weather_data (
     id SERIAL PRIMARY KEY,
-    timestamp TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    timestamp TIMESTAMPTZ NOT NULL DEFAULT NOW(),  -- momento de la observación
     polygon_id VARCHAR(50) NOT NULL,
+    source VARCHAR(30) NOT NULL DEFAULT 'OpenWeather',
     temperature_c DECIMAL(5,2),
     feels_like_c DECIMAL(5,2),
     temp_min_c DECIMAL(5,2),
@@ -25,8 +26,9 @@ CREATE TABLE IF NOT EXISTS weather_data (
 -- Tabla de datos del suelo
 CREATE TABLE IF NOT EXISTS soil_data (
     id SERIAL PRIMARY KEY,
-    timestamp TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    timestamp TIMESTAMPTZ NOT NULL DEFAULT NOW(),  -- momento de la observación
     polygon_id VARCHAR(50) NOT NULL,
+    source VARCHAR(30) NOT NULL DEFAULT 'Open-Meteo',
     soil_temp_c DECIMAL(5,2),
     soil_moisture DECIMAL(6,4),
     soil_moisture_percent DECIMAL(5,2),
@@ -38,7 +40,7 @@ CREATE TABLE IF NOT EXISTS ndvi_data (
     id SERIAL PRIMARY KEY,
     timestamp TIMESTAMPTZ NOT NULL DEFAULT NOW(),
     polygon_id VARCHAR(50) NOT NULL,
-    image_date TIMESTAMPTZ,
+    image_date TIMESTAMPTZ,  -- escena; timestamp se iguala a image_date al guardar
     ndvi_mean DECIMAL(6,4),
     ndvi_min DECIMAL(6,4),
     ndvi_max DECIMAL(6,4),
@@ -50,6 +52,25 @@ CREATE TABLE IF NOT EXISTS ndvi_data (
     created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
 );
 
+-- Estadísticas por zona de cultivo (calculadas del mismo raster que ndvi_data)
+CREATE TABLE IF NOT EXISTS zone_stats (
+    id SERIAL PRIMARY KEY,
+    polygon_id VARCHAR(50) NOT NULL,
+    zone VARCHAR(50) NOT NULL,  -- cultivo: platano, hortalizas, tuberculos...
+    index_name VARCHAR(10) NOT NULL,  -- ndvi | ndwi | ndsi
+    image_date TIMESTAMPTZ NOT NULL,
+    mean DECIMAL(6,4),
+    min DECIMAL(6,4),
+    max DECIMAL(6,4),
+    std DECIMAL(6,4),
+    p25 DECIMAL(6,4),
+    p50 DECIMAL(6,4),
+    p75 DECIMAL(6,4),
+    valid_fraction DECIMAL(5,4),
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    UNIQUE (polygon_id, zone, index_name, image_date)
+);
+
 -- Tabla de pronósticos diarios
 CREATE TABLE IF NOT EXISTS forecast_data (
     id SERIAL PRIMARY KEY,
@@ -64,12 +85,122 @@ CREATE TABLE IF NOT EXISTS forecast_data (
     created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
 );
 
+-- Clima diario histórico por finca (ERA5-Land via CDS, celda de tierra más cercana)
+CREATE TABLE IF NOT EXISTS climate_daily (
+    id SERIAL PRIMARY KEY,
+    polygon_id VARCHAR(50) NOT NULL,
+    source VARCHAR(30) NOT NULL DEFAULT 'ERA5-Land',
+    date DATE NOT NULL,  -- día UTC
+    temp_mean_c DECIMAL(5,2),
+    temp_min_c DECIMAL(5,2),
+    temp_max_c DECIMAL(5,2),
+    dew_point_c DECIMAL(5,2),
+    humidity_percent DECIMAL(5,2),
+    precipitation_mm DECIMAL(7,2),
+    wind_speed_ms DECIMAL(5,2),
+    soil_temp_c DECIMAL(5,2),
+    soil_moisture DECIMAL(6,4),  -- m³/m³, capa 0-7 cm
+    grid_lat DECIMAL(7,4),  -- celda ERA5-Land usada
+    grid_lon DECIMAL(7,4),
+    hours INTEGER,  -- horas con dato en el día
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    UNIQUE (polygon_id, source, date)
+);
+
+-- Adquisiciones Sentinel-2 ya procesadas (evita reprocesar la misma escena)
+CREATE TABLE IF NOT EXISTS processed_acquisitions (
+    id SERIAL PRIMARY KEY,
+    polygon_id VARCHAR(50) NOT NULL,
+    acquisition_id VARCHAR(100) NOT NULL,
+    acquisition_date TIMESTAMPTZ NOT NULL,
+    cloud_cover DECIMAL(5,2),
+    processed_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    UNIQUE (polygon_id, acquisition_id)
+);
+
+-- Libro de cuota mensual de Copernicus (compartido por todos los schedulers)
+CREATE TABLE IF NOT EXISTS quota_ledger (
+    month CHAR(7) PRIMARY KEY,  -- 'YYYY-MM'
+    monthly_limit_pu INTEGER NOT NULL,
+    monthly_limit_requests INTEGER NOT NULL,
+    processing_units_used DECIMAL(12,2) NOT NULL DEFAULT 0,
+    requests_used INTEGER NOT NULL DEFAULT 0,
+    processing_units_reserved DECIMAL(12,2) NOT NULL DEFAULT 0,
+    requests_reserved INTEGER NOT NULL DEFAULT 0,
+    collections_today INTEGER NOT NULL DEFAULT 0,
+    last_collection_date DATE,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+-- Reservas de cuota: se crean antes de cada solicitud y se liquidan después
+CREATE TABLE IF NOT EXISTS quota_reservations (
+    id SERIAL PRIMARY KEY,
+    month CHAR(7) NOT NULL REFERENCES quota_ledger(month),
+    operation VARCHAR(50) NOT NULL,
+    pu_reserved DECIMAL(10,2) NOT NULL,
+    pu_actual DECIMAL(10,2),
+    status VARCHAR(10) NOT NULL DEFAULT 'reserved',  -- reserved | settled | released
+    request_shape VARCHAR(100),  -- 'operación:anchoxalto' de la solicitud liquidada
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    settled_at TIMESTAMPTZ
+);
+
+-- Consumo mensual por finca (el costo de una solicitud de grupo se reparte por área)
+CREATE TABLE IF NOT EXISTS quota_farm_usage (
+    month CHAR(7) NOT NULL REFERENCES quota_ledger(month),
+    polygon_id VARCHAR(50) NOT NULL,
+    processing_units_used DECIMAL(12,3) NOT NULL DEFAULT 0,
+    requests_used INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (month, polygon_id)
+);
+
+-- Modelo de costo medido: promedio móvil de PU reales por forma de solicitud
+CREATE TABLE IF NOT EXISTS quota_cost_model (
+    request_shape VARCHAR(100) PRIMARY KEY,
+    avg_pu DECIMAL(10,3) NOT NULL,
+    samples INTEGER NOT NULL DEFAULT 1,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
 -- Índices para mejorar rendimiento
 CREATE INDEX IF NOT EXISTS idx_weather_timestamp ON weather_data(timestamp DESC);
 CREATE INDEX IF NOT EXISTS idx_weather_polygon ON weather_data(polygon_id);
 CREATE INDEX IF NOT EXISTS idx_soil_timestamp ON soil_data(timestamp DESC);
 CREATE INDEX IF NOT EXISTS idx_ndvi_timestamp ON ndvi_data(timestamp DESC);
 CREATE INDEX IF NOT EXISTS idx_forecast_date ON forecast_data(forecast_date);
+CREATE INDEX IF NOT EXISTS idx_reservations_open ON quota_reservations(month, status, created_at);
+CREATE INDEX IF NOT EXISTS idx_zone_stats_polygon ON zone_stats(polygon_id, zone, image_date DESC);
+CREATE INDEX IF NOT EXISTS idx_acquisitions_polygon ON processed_acquisitions(polygon_id, acquisition_date DESC);
+
+-- Claves naturales para escrituras idempotentes (db_writer: ON CONFLICT).
+-- En bases existentes se agrega la columna source y, una sola vez (mientras
+-- no exista el índice único), se eliminan los duplicados de ejecuciones
+-- reintentadas (se conserva la fila más reciente) y se crea el índice
+ALTER TABLE weather_data ADD COLUMN IF NOT EXISTS source VARCHAR(30) NOT NULL DEFAULT 'OpenWeather';
+ALTER TABLE soil_data ADD COLUMN IF NOT EXISTS source VARCHAR(30) NOT NULL DEFAULT 'Open-Meteo';
+
+DO $$
+BEGIN
+    IF to_regclass('uq_weather_observation') IS NULL THEN
+        DELETE FROM weather_data a USING weather_data b
+        WHERE a.polygon_id = b.polygon_id AND a.source = b.source
+          AND a.timestamp = b.timestamp AND a.id < b.id;
+        CREATE UNIQUE INDEX uq_weather_observation ON weather_data(polygon_id, source, timestamp);
+    END IF;
+    IF to_regclass('uq_soil_observation') IS NULL THEN
+        DELETE FROM soil_data a USING soil_data b
+        WHERE a.polygon_id = b.polygon_id AND a.source = b.source
+          AND a.timestamp = b.timestamp AND a.id < b.id;
+        CREATE UNIQUE INDEX uq_soil_observation ON soil_data(polygon_id, source, timestamp);
+    END IF;
+    IF to_regclass('uq_ndvi_image') IS NULL THEN
+        DELETE FROM ndvi_data a USING ndvi_data b
+        WHERE a.polygon_id = b.polygon_id AND a.image_date = b.image_date AND a.id < b.id;
+        CREATE UNIQUE INDEX uq_ndvi_image ON ndvi_data(polygon_id, image_date);
+    END IF;
+END
+$$;
 
 -- Vista para el último registro de cada tipo
 CREATE OR REPLACE VIEW latest_weather AS
@@ -85,4 +216,4 @@ ORDER BY polygon_id, timestamp DESC;
 CREATE OR REPLACE VIEW latest_ndvi AS
 SELECT DISTINCT ON (polygon_id) *
 FROM ndvi_data
-ORDER BY polygon_id, timestamp DESC;
+ORDER BY polygon_id, image_date DESC NULLS LAST, timestamp DESC;
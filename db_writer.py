@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+AgroMonitor - Escrituras por lotes e idempotentes en PostgreSQL
+
+save_results ya no hace un INSERT por tabla y por finca: cada fila pasa
+primero por el spool local (spool.py, escritura anticipada en disco) y
+flush() sella el segmento para que el replicador en segundo plano lo
+escriba en una sola transacción, con un INSERT multi-fila
+(psycopg2.extras.execute_values) por tabla. La recolección no espera a la
+BD: si Neon está dormido o no responde, las filas quedan en data/spool y
+se reintentan (también en la próxima ejecución).
+
+Cada tabla tiene una clave natural (finca, fuente, momento de la
+observación) respaldada por un índice único en db_schema.sql, y el INSERT
+es un upsert:
+
+    INSERT ... VALUES (...), (...), ...
+    ON CONFLICT (clave natural) DO UPDATE SET <resto de columnas>
+
+Así una ejecución reintentada, un backfill repetido o un segmento del
+spool replicado dos veces no duplican filas: la última lectura de la misma
+observación reemplaza a la anterior. Dentro de un lote, filas con la misma
+clave se reducen a la última antes de enviarlas (PostgreSQL no admite
+actualizar dos veces la misma fila en una sentencia).
+"""
+
+import os
+import threading
+
+import db_config
+import spool
+
+# Filas por sentencia INSERT (execute_values divide lotes mayores)
+DB_BATCH_PAGE_SIZE = int(os.environ.get('DB_BATCH_PAGE_SIZE', 500))
+# Segundos que drain() espera al replicador antes de dejar filas en el spool
+DB_DRAIN_TIMEOUT = float(os.environ.get('DB_DRAIN_TIMEOUT', 60))
+
+# Columnas y clave natural de cada tabla
+TABLES = {
+    'weather_data': {
+        'columns': ('timestamp', 'polygon_id', 'source', 'temperature_c', 'temp_min_c',
+                    'temp_max_c', 'humidity_percent', 'pressure_hpa', 'wind_speed_ms',
+                    'wind_deg', 'clouds_percent', 'weather_main', 'weather_description',
+                    'dew_point_c'),
+        'key': ('polygon_id', 'source', 'timestamp')
+    },
+    'soil_data': {
+        'columns': ('timestamp', 'polygon_id', 'source', 'soil_temp_c', 'soil_moisture',
+                    'soil_moisture_percent'),
+        'key': ('polygon_id', 'source', 'timestamp')
+    },
+    'ndvi_data': {
+        'columns': ('timestamp', 'polygon_id', 'image_date', 'ndvi_mean', 'ndvi_min', 'ndvi_max',
+                    'ndvi_std', 'ndwi_mean', 'ndsi_mean', 'ndsi_interpretation',
+                    'cloud_coverage'),
+        'key': ('polygon_id', 'image_date')
+    },
+    'zone_stats': {
+        'columns': ('polygon_id', 'zone', 'index_name', 'image_date', 'mean', 'min', 'max',
+                    'std', 'p25', 'p50', 'p75', 'valid_fraction'),
+        'key': ('polygon_id', 'zone', 'index_name', 'image_date')
+    },
+    # Filas parciales (p.ej. solo la precipitación de un día) se combinan:
+    # un NULL nuevo no borra un valor ya guardado
+    'climate_daily': {
+        'columns': ('polygon_id', 'source', 'date', 'temp_mean_c', 'temp_min_c', 'temp_max_c',
+                    'dew_point_c', 'humidity_percent', 'precipitation_mm', 'wind_speed_ms',
+                    'soil_temp_c', 'soil_moisture', 'grid_lat', 'grid_lon', 'hours'),
+        'key': ('polygon_id', 'source', 'date'),
+        'merge': True
+    },
+}
+
+_lock = threading.Lock()
+_conn = None
+
+def _get_conn():
+    """Conexión persistente del proceso (None si la BD no está disponible)"""
+    global _conn
+    if _conn is not None and not _conn.closed:
+        return _conn
+    try:
+        _conn = db_config.get_connection()
+    except Exception as e:
+        print(f"[ERROR] BD no disponible: {e}")
+        _conn = None
+    return _conn
+
+def _upsert_sql(table):
+    spec = TABLES[table]
+    updates = [column for column in spec['columns'] if column not in spec['key']]
+    if spec.get('merge'):
+        assignments = [f'{column} = COALESCE(EXCLUDED.{column}, {table}.{column})' for column in updates]
+    else:
+        assignments = [f'{column} = EXCLUDED.{column}' for column in updates]
+    return f"""
+        INSERT INTO {table} ({', '.join(spec['columns'])})
+        VALUES %s
+        ON CONFLICT ({', '.join(spec['key'])}) DO UPDATE SET
+            {', '.join(assignments)}
+    """
+
+def add(table, row):
+    """
+    Escribe una fila en el spool (durable al retornar)
+
+    Args:
+        table: Tabla de TABLES
+        row: {columna: valor}; las columnas ausentes se envían como NULL
+    """
+    if table not in TABLES:
+        raise KeyError(f"Tabla desconocida: {table}")
+    spool.append(table, row)
+
+def pending():
+    """Filas en el spool aún no escritas en la BD"""
+    return spool.pending()
+
+def write(records):
+    """
+    Escribe filas en la BD en una transacción (destino del replicador)
+
+    Args:
+        records: [(tabla, fila)]
+
+    Returns:
+        dict: {tabla: filas escritas}, o None si la BD no está disponible
+
+    Raises:
+        spool.Rejected: Si la BD rechazó las filas (dato inválido, tabla
+                        desconocida); el replicador sigue con otro segmento
+    """
+    import psycopg2
+    from psycopg2.extras import execute_values
+
+    # {tabla: {clave natural: valores}}: la última fila de cada clave gana
+    # (en tablas 'merge', columna por columna si la nueva trae NULL)
+    batches = {}
+    for table, row in records:
+        if table not in TABLES:
+            raise spool.Rejected(f"tabla desconocida: {table}")
+        spec = TABLES[table]
+        key = tuple(row.get(column) for column in spec['key'])
+        values = tuple(row.get(column) for column in spec['columns'])
+        rows = batches.setdefault(table, {})
+        if spec.get('merge') and key in rows:
+            values = tuple(old if new is None else new for new, old in zip(values, rows[key]))
+        rows[key] = values
+
+    with _lock:
+        conn = _get_conn()
+        if not conn:
+            return None
+        cur = conn.cursor()
+        try:
+            for table, rows in batches.items():
+                execute_values(cur, _upsert_sql(table), list(rows.values()), page_size=DB_BATCH_PAGE_SIZE)
+            conn.commit()
+        except Exception as e:
+            print(f"[ERROR] Escritura por lotes en BD: {e}")
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+            # Conexión caída: reintentar; cualquier otro error es del lote
+            if isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError)):
+                return None
+            raise spool.Rejected(str(e).strip().splitlines()[0])
+        finally:
+            try:
+                cur.close()
+            except Exception:
+                pass
+    return {table: len(rows) for table, rows in batches.items()}
+
+def start():
+    """Arranca el replicador; retoma lo que quedó en el spool de ejecuciones previas"""
+    spool.start_replayer(write)
+
+def flush():
+    """
+    Sella las filas agregadas para que el replicador las escriba en la BD
+
+    No espera a la BD; drain() espera (acotado) a que se vacíe el spool.
+
+    Returns:
+        int: Filas selladas, o None si no se pudo escribir el spool
+    """
+    try:
+        rows = spool.seal()
+    except OSError as e:
+        print(f"[ERROR] Sellando el spool: {e}")
+        return None
+    start()
+    return rows
+
+def drain(timeout=None):
+    """
+    Espera a que el spool se vacíe en la BD
+
+    Returns:
+        bool: True si todo quedó en la BD; False si quedan filas en el spool
+    """
+    return spool.drain(DB_DRAIN_TIMEOUT if timeout is None else timeout)
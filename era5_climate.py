@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+AgroMonitor - Decodificación de ERA5-Land (NetCDF) a series diarias por finca
+
+Un archivo mensual de la CDS API trae las variables horarias en una grilla
+(tiempo, latitud, longitud) que cubre todas las fincas. Todo se resuelve
+con operaciones de arreglos, sin recorrer horas ni celdas en Python:
+
+    1. Cada finca toma la celda de tierra más cercana a su centro
+       (distancia en la grilla completa; las celdas de mar son NaN en
+       ERA5-Land y se descartan).
+    2. Un solo indexado avanzado extrae (horas, fincas) de cada variable.
+    3. Las horas se agrupan por día UTC con np.*.reduceat.
+
+Precipitación: en ERA5-Land 'tp' se acumula desde las 00 UTC y el valor de
+las 00 UTC es el total del día anterior. Por eso el total del día D sale
+del paso 00 UTC de D+1: un archivo que cubre los días d0..d1 trae la
+precipitación de d0-1..d1-1, y la del último día llega con el archivo
+siguiente (la tabla climate_daily combina ambas filas con COALESCE).
+
+Requiere netCDF4 (pip install netCDF4).
+"""
+
+import numpy as np
+
+# Nombre en la CDS API -> nombre corto en el NetCDF
+VARIABLES = {
+    '2m_temperature': 't2m',
+    '2m_dewpoint_temperature': 'd2m',
+    'total_precipitation': 'tp',
+    '10m_u_component_of_wind': 'u10',
+    '10m_v_component_of_wind': 'v10',
+    'soil_temperature_level_1': 'stl1',
+    'volumetric_soil_water_layer_1': 'swvl1',
+}
+
+KELVIN = 273.15
+
+# Constantes de Magnus-Tetens (las de calculate_dew_point)
+MAGNUS_A = 17.27
+MAGNUS_B = 237.7
+
+_TIME_UNITS = {'seconds': 's', 'minutes': 'm', 'hours': 'h', 'days': 'D'}
+
+def _decode_time(variable):
+    """Coordenada temporal CF ('<unidad> since <fecha>') a datetime64[s]"""
+    unit, _, origin = variable.units.partition(' since ')
+    origin = np.datetime64(origin.strip().replace(' ', 'T').rstrip('Z')[:19], 's')
+    offsets = np.asarray(variable[:], dtype=np.int64)
+    return origin + offsets.astype(f"timedelta64[{_TIME_UNITS[unit.strip()]}]")
+
+def _read_variable(dataset, name, time_dim):
+    """Variable como float32 (tiempo, lat, lon), NaN donde está enmascarada"""
+    variable = dataset.variables[name]
+    values = np.ma.filled(np.ma.asarray(variable[:], dtype=np.float32), np.nan)
+    dims = list(variable.dimensions)
+    # Dimensiones extra de tamaño 1 ('number', 'expver') se eliminan
+    for axis in reversed(range(len(dims))):
+        if dims[axis] not in (time_dim, 'latitude', 'longitude'):
+            values = values.take(0, axis=axis)
+            dims.pop(axis)
+    return values.transpose([dims.index(time_dim), dims.index('latitude'), dims.index('longitude')])
+
+def read_netcdf(path):
+    """
+    Lee un NetCDF de ERA5-Land
+
+    Returns:
+        dict: {'time': datetime64[s] (T,), 'lat': (Y,), 'lon': (X,),
+               nombre corto: float32 (T, Y, X)} con las variables presentes
+    """
+    import netCDF4
+
+    with netCDF4.Dataset(path) as dataset:
+        # La CDS nueva usa 'valid_time'; la anterior, 'time'
+        time_dim = 'valid_time' if 'valid_time' in dataset.variables else 'time'
+        data = {
+            'time': _decode_time(dataset.variables[time_dim]),
+            'lat': np.asarray(dataset.variables['latitude'][:], dtype=np.float64),
+            'lon': np.asarray(dataset.variables['longitude'][:], dtype=np.float64),
+        }
+        for short in VARIABLES.values():
+            if short in dataset.variables:
+                data[short] = _read_variable(dataset, short, time_dim)
+
+    # Horas en orden cronológico (reduceat agrupa por posiciones contiguas)
+    order = np.argsort(data['time'], kind='stable')
+    for key in data:
+        if key not in ('lat', 'lon'):
+            data[key] = data[key][order]
+    return data
+
+def farm_cells(data, farms):
+    """
+    Celda de tierra más cercana al centro de cada finca
+
+    Returns:
+        (iy, ix): arreglos de índices (F,) en la grilla
+    """
+    lat = np.array([farm['lat'] for farm in farms], dtype=np.float64)
+    lon = np.array([farm['lon'] for farm in farms], dtype=np.float64)
+    grid_lat, grid_lon = np.meshgrid(data['lat'], data['lon'], indexing='ij')
+
+    # (F, Y, X): distancia en grados, con la longitud escalada por cos(lat)
+    scale = np.cos(np.radians(lat))[:, None, None]
+    distance = (grid_lat[None] - lat[:, None, None]) ** 2 + \
+        ((grid_lon[None] - lon[:, None, None]) * scale) ** 2
+    land = np.isfinite(data['t2m']).any(axis=0) if 't2m' in data else np.ones(grid_lat.shape, bool)
+    distance[:, ~land] = np.inf
+
+    flat = distance.reshape(len(farms), -1).argmin(axis=1)
+    return np.unravel_index(flat, grid_lat.shape)
+
+def _relative_humidity(temp_c, dew_c):
+    """Humedad relativa (%) desde temperatura y punto de rocío (Magnus-Tetens)"""
+    return 100.0 * np.exp(
+        MAGNUS_A * dew_c / (MAGNUS_B + dew_c) - MAGNUS_A * temp_c / (MAGNUS_B + temp_c)
+    )
+
+def daily_series(data, farms, first_day=None, last_day=None):
+    """
+    Series diarias por finca a partir de los datos horarios
+
+    Args:
+        data: Retorno de read_netcdf
+        farms: Fincas de load_farms() (usa 'id', 'lat', 'lon')
+        first_day, last_day: Días (ISO) a incluir; por defecto los del archivo
+
+    Returns:
+        list: filas para climate_daily (una por finca y día); las de
+              precipitación del día anterior al archivo solo traen esa columna
+    """
+    iy, ix = farm_cells(data, farms)
+    times = data['time']
+    days = times.astype('datetime64[D]')
+    first_day = np.datetime64(first_day or days.min(), 'D')
+    last_day = np.datetime64(last_day or days.max(), 'D')
+
+    # (T, F) por variable: un solo indexado avanzado por variable
+    hourly = {short: data[short][:, iy, ix] for short in VARIABLES.values() if short in data}
+    if 't2m' in hourly:
+        hourly['t2m'] = hourly['t2m'] - KELVIN
+    if 'd2m' in hourly:
+        hourly['d2m'] = hourly['d2m'] - KELVIN
+    if 'stl1' in hourly:
+        hourly['stl1'] = hourly['stl1'] - KELVIN
+    if 't2m' in hourly and 'd2m' in hourly:
+        hourly['rh'] = _relative_humidity(hourly['t2m'], hourly['d2m'])
+    if 'u10' in hourly and 'v10' in hourly:
+        hourly['wind'] = np.hypot(hourly['u10'], hourly['v10'])
+
+    # Agrupar por día UTC (las horas vienen ordenadas)
+    inside = (days >= first_day) & (days <= last_day)
+    group_days, starts, counts = np.unique(days[inside], return_index=True, return_counts=True)
+
+    def mean(short):
+        values = hourly[short][inside]
+        return np.add.reduceat(values, starts, axis=0) / counts[:, None]
+
+    def extreme(short, ufunc):
+        return ufunc.reduceat(hourly[short][inside], starts, axis=0)
+
+    columns = {}
+    if 't2m' in hourly:
+        columns['temp_mean_c'] = mean('t2m')
+        columns['temp_min_c'] = extreme('t2m', np.fmin)
+        columns['temp_max_c'] = extreme('t2m', np.fmax)
+    if 'd2m' in hourly:
+        columns['dew_point_c'] = mean('d2m')
+    if 'rh' in hourly:
+        columns['humidity_percent'] = mean('rh')
+    if 'wind' in hourly:
+        columns['wind_speed_ms'] = mean('wind')
+    if 'stl1' in hourly:
+        columns['soil_temp_c'] = mean('stl1')
+    if 'swvl1' in hourly:
+        columns['soil_moisture'] = mean('swvl1')
+
+    rows = {}
+    for d, day in enumerate(group_days):
+        for f, farm in enumerate(farms):
+            row = {
+                'polygon_id': farm['id'],
+                'date': str(day),
+                'grid_lat': float(data['lat'][iy[f]]),
+                'grid_lon': float(data['lon'][ix[f]]),
+                'hours': int(counts[d])
+            }
+            for column, values in columns.items():
+                value = float(values[d, f])
+                row[column] = round(value, 4) if np.isfinite(value) else None
+            rows[(farm['id'], str(day))] = row
+
+    # Precipitación: el paso 00 UTC de D+1 es el total del día D (m -> mm)
+    if 'tp' in hourly:
+        midnight = (times.astype('datetime64[h]') - days).astype(np.int64) == 0
+        precip_days = days[midnight] - np.timedelta64(1, 'D')
+        totals = hourly['tp'][midnight] * 1000.0
+        keep = (precip_days >= first_day - np.timedelta64(1, 'D')) & (precip_days <= last_day)
+        for day, day_totals in zip(precip_days[keep], totals[keep]):
+            for f, farm in enumerate(farms):
+                value = float(day_totals[f])
+                if not np.isfinite(value):
+                    continue
+                row = rows.setdefault((farm['id'], str(day)), {'polygon_id': farm['id'], 'date': str(day)})
+                row['precipitation_mm'] = round(max(value, 0.0), 2)
+
+    return list(rows.values())
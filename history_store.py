@@ -0,0 +1,392 @@
+# -*- coding: utf-8 -*-
+"""
+AgroMonitor - Historial columnar de las ejecuciones del colector
+
+Reemplaza a data/copernicus_history.csv. Cada mes es un segmento con un
+archivo binario por columna, sin encabezado, de solo-agregado:
+
+    data/history/<AAAA-MM>/
+        index.json          filas, rango de timestamps y diccionarios
+        timestamp.dat       int64, segundos desde 1970 (hora local)
+        ndvi_mean.dat       float32, NaN = sin dato
+        polygon_id.dat      int32, código en el diccionario; -1 = sin dato
+        ...
+
+Las columnas de texto (finca, descripción del clima, rutas de mapas) se
+guardan como códigos de diccionario: se repiten muchas veces por mes.
+
+Una consulta por rango (scan) solo abre los segmentos de los meses que
+toca y, dentro de cada uno, usa la columna timestamp como índice
+(np.searchsorted si el segmento está ordenado) para leer solo esas filas
+de las columnas pedidas, vía np.memmap.
+
+Agregar es escribir al final de cada columna y luego reemplazar index.json
+de forma atómica; bytes escritos sin su entrada en el índice (proceso
+interrumpido) se descartan en el siguiente agregado, como en
+raster_archive.
+
+Las columnas de mapas guardan la ruta del blob en map_store, relativa al
+repositorio. Las filas anteriores apuntaban a los PNG sueltos de data/maps
+(ya migrados); relink() reescribe esas rutas en los diccionarios.
+
+Migración del CSV existente (una vez; luego se borra el CSV) y de las rutas
+de mapas:
+
+    python history_store.py migrate
+"""
+
+import os
+import sys
+import csv
+import json
+import threading
+from datetime import datetime
+import numpy as np
+import map_store
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+HISTORY_DIR = os.environ.get('HISTORY_DIR', os.path.join(BASE_DIR, 'data', 'history'))
+LEGACY_CSV = os.path.join(BASE_DIR, 'data', 'copernicus_history.csv')
+
+# Columnas y tipo de almacenamiento ('str' = código de diccionario int32)
+COLUMNS = (
+    ('timestamp', 'int64'),
+    ('polygon_id', 'str'),
+    ('ndvi_mean', 'float32'),
+    ('ndwi_mean', 'float32'),
+    ('ndsi_mean', 'float32'),
+    ('ndsi_interp', 'str'),
+    ('map_rgb', 'str'),
+    ('map_ndvi', 'str'),
+    ('temp_c', 'float32'),
+    ('temp_min_c', 'float32'),
+    ('temp_max_c', 'float32'),
+    ('humidity', 'float32'),
+    ('weather_desc', 'str'),
+)
+COLUMN_TYPES = dict(COLUMNS)
+MAP_COLUMNS = ('map_rgb', 'map_ndvi')
+
+STR_NODATA = -1
+
+_lock = threading.Lock()
+
+def _segment_dir(month):
+    return os.path.join(HISTORY_DIR, month)
+
+def _column_path(segment_dir, column):
+    return os.path.join(segment_dir, f"{column}.dat")
+
+def _storage_dtype(column):
+    kind = COLUMN_TYPES[column]
+    return np.dtype(np.int32 if kind == 'str' else kind)
+
+def _read_index(segment_dir):
+    try:
+        with open(os.path.join(segment_dir, 'index.json'), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _write_index(segment_dir, index):
+    path = os.path.join(segment_dir, 'index.json')
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(index, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def _to_seconds(value):
+    """Timestamp (datetime o texto ISO) a segundos desde 1970, sin zona"""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    return int(np.datetime64(value.replace(tzinfo=None), 's').astype(np.int64))
+
+def _from_seconds(seconds):
+    return np.asarray(seconds, dtype='datetime64[s]')
+
+def _encode_number(value):
+    if value is None or value == '':
+        return np.nan
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+def _map_refs(values):
+    """
+    Rutas de mapas a la ruta de su blob, relativa al repositorio
+
+    Una ruta a un PNG suelto que ya no existe (data/maps/farm_rgb_*.png) se
+    resuelve por nombre en el manifiesto de map_store; si no está, queda igual.
+    """
+    manifest = None
+    refs = []
+    for value in values:
+        if value:
+            path = value if os.path.isabs(value) else os.path.join(BASE_DIR, value)
+            if not os.path.isfile(path):
+                if manifest is None:
+                    manifest = map_store.load_manifest()['maps']
+                entry = manifest.get(os.path.splitext(os.path.basename(value))[0])
+                path = map_store.blob_path(entry['blob']) if entry else path
+            relative = os.path.relpath(path, BASE_DIR)
+            value = value if relative.startswith(os.pardir) else relative.replace(os.sep, '/')
+        refs.append(value)
+    return refs
+
+def _encode_column(column, values, dictionary):
+    """Valores de una columna al tipo de almacenamiento (agrega al diccionario)"""
+    kind = COLUMN_TYPES[column]
+    if column == 'timestamp':
+        return np.array([_to_seconds(value) for value in values], dtype=np.int64)
+    if column in MAP_COLUMNS:
+        values = _map_refs(values)
+    if kind == 'str':
+        codes = {value: code for code, value in enumerate(dictionary)}
+        encoded = []
+        for value in values:
+            if value is None or value == '':
+                encoded.append(STR_NODATA)
+                continue
+            value = str(value)
+            if value not in codes:
+                codes[value] = len(dictionary)
+                dictionary.append(value)
+            encoded.append(codes[value])
+        return np.array(encoded, dtype=np.int32)
+    return np.array([_encode_number(value) for value in values], dtype=kind)
+
+def _append_segment(month, rows):
+    """Agrega filas (ya del mismo mes) al segmento; se llama con _lock tomado"""
+    segment_dir = _segment_dir(month)
+    os.makedirs(segment_dir, exist_ok=True)
+    index = _read_index(segment_dir) or {
+        'month': month,
+        'rows': 0,
+        'min_ts': None,
+        'max_ts': None,
+        'sorted': True,
+        'columns': {column: kind for column, kind in COLUMNS},
+        'dictionaries': {column: [] for column, kind in COLUMNS if kind == 'str'}
+    }
+
+    blocks = {
+        column: _encode_column(column, [row.get(column) for row in rows],
+                               index['dictionaries'].get(column))
+        for column, _ in COLUMNS
+    }
+    timestamps = blocks['timestamp']
+    for column, block in blocks.items():
+        with open(_column_path(segment_dir, column), 'ab') as f:
+            # Descartar bytes huérfanos de un agregado interrumpido
+            f.truncate(index['rows'] * block.itemsize)
+            f.write(block.tobytes())
+
+    first, last = int(timestamps.min()), int(timestamps.max())
+    index['sorted'] = bool(
+        index['sorted'] and np.all(np.diff(timestamps) >= 0)
+        and (index['max_ts'] is None or int(timestamps[0]) >= index['max_ts'])
+    )
+    index['min_ts'] = first if index['min_ts'] is None else min(index['min_ts'], first)
+    index['max_ts'] = last if index['max_ts'] is None else max(index['max_ts'], last)
+    index['rows'] += len(rows)
+    index['updated_at'] = datetime.now().isoformat()
+    _write_index(segment_dir, index)
+
+def _month(row):
+    return str(_from_seconds(_to_seconds(row['timestamp'])).astype('datetime64[M]'))
+
+def append(row):
+    """
+    Agrega una fila al historial
+
+    Args:
+        row: {columna: valor} con las columnas de COLUMNS; 'timestamp'
+             como datetime o texto ISO; '' o None = sin dato
+    """
+    append_many([row])
+
+def append_many(rows):
+    """Agrega varias filas; se escriben en bloque por segmento mensual"""
+    by_month = {}
+    for row in rows:
+        by_month.setdefault(_month(row), []).append(row)
+    with _lock:
+        for month in sorted(by_month):
+            _append_segment(month, by_month[month])
+
+def segments():
+    """Meses con segmento, en orden ('AAAA-MM')"""
+    if not os.path.isdir(HISTORY_DIR):
+        return []
+    return sorted(
+        name for name in os.listdir(HISTORY_DIR)
+        if os.path.isfile(os.path.join(HISTORY_DIR, name, 'index.json'))
+    )
+
+def _read_column(segment_dir, index, column, rows):
+    values = np.memmap(_column_path(segment_dir, column), dtype=_storage_dtype(column),
+                       mode='r', shape=(index['rows'],))
+    return np.array(values[rows])
+
+def scan(start=None, end=None, columns=None, polygon_id=None):
+    """
+    Filas del historial en [start, end], ordenadas por timestamp
+
+    Args:
+        start, end: datetime o texto ISO (incluidos); None = sin límite
+        columns: Columnas a leer (por defecto todas; timestamp siempre)
+        polygon_id: Filtrar por finca
+
+    Returns:
+        dict: {columna: np.ndarray}; 'timestamp' como datetime64[s], texto
+              como arreglo de objetos (None = sin dato), números float32
+    """
+    columns = [column for column, _ in COLUMNS] if columns is None else \
+        ['timestamp'] + [column for column in columns if column != 'timestamp']
+    low = _to_seconds(start) if start is not None else None
+    high = _to_seconds(end) if end is not None else None
+    first_month = str(_from_seconds(low).astype('datetime64[M]')) if low is not None else None
+    last_month = str(_from_seconds(high).astype('datetime64[M]')) if high is not None else None
+
+    parts = {column: [] for column in columns}
+    times = []
+    for month in segments():
+        # Solo los segmentos de los meses del rango
+        if (first_month and month < first_month) or (last_month and month > last_month):
+            continue
+        segment_dir = _segment_dir(month)
+        index = _read_index(segment_dir)
+        if not index or not index['rows']:
+            continue
+
+        timestamps = np.memmap(_column_path(segment_dir, 'timestamp'), dtype=np.int64,
+                               mode='r', shape=(index['rows'],))
+        if index['sorted']:
+            lo = 0 if low is None else int(np.searchsorted(timestamps, low, side='left'))
+            hi = index['rows'] if high is None else int(np.searchsorted(timestamps, high, side='right'))
+            rows = np.arange(lo, hi)
+        else:
+            selected = np.ones(index['rows'], dtype=bool)
+            if low is not None:
+                selected &= timestamps >= low
+            if high is not None:
+                selected &= timestamps <= high
+            rows = np.flatnonzero(selected)
+
+        if polygon_id is not None and len(rows):
+            dictionary = index['dictionaries']['polygon_id']
+            if polygon_id not in dictionary:
+                continue
+            codes = _read_column(segment_dir, index, 'polygon_id', rows)
+            rows = rows[codes == dictionary.index(polygon_id)]
+        if not len(rows):
+            continue
+
+        times.append(np.array(timestamps[rows]))
+        for column in columns:
+            values = _read_column(segment_dir, index, column, rows)
+            if COLUMN_TYPES[column] == 'str':
+                lookup = np.array(index['dictionaries'][column] + [None], dtype=object)
+                values = lookup[values]   # STR_NODATA (-1) apunta al None final
+            parts[column].append(values)
+
+    order = np.argsort(np.concatenate(times), kind='stable') if times else np.array([], dtype=np.int64)
+    result = {}
+    for column in columns:
+        kind = COLUMN_TYPES[column]
+        if parts[column]:
+            values = np.concatenate(parts[column])[order]
+        else:
+            values = np.array([], dtype=object if kind == 'str' else _storage_dtype(column))
+        result[column] = _from_seconds(values) if column == 'timestamp' else values
+    return result
+
+def records(start=None, end=None, columns=None, polygon_id=None):
+    """Como scan(), pero como lista de dicts (NaN -> None, timestamp ISO)"""
+    data = scan(start, end, columns, polygon_id)
+    names = list(data)
+    rows = []
+    for position in range(len(data[names[0]]) if names else 0):
+        row = {}
+        for column in names:
+            value = data[column][position]
+            if column == 'timestamp':
+                value = str(value).replace('T', ' ')
+            elif isinstance(value, np.floating):
+                value = None if np.isnan(value) else float(value)
+            row[column] = value
+        rows.append(row)
+    return rows
+
+def relink():
+    """
+    Reescribe las rutas de mapas de los segmentos a la ruta de su blob
+
+    Solo cambia los diccionarios de index.json (los códigos de las filas no
+    cambian); es idempotente.
+
+    Returns:
+        int: Rutas reescritas
+    """
+    changed = 0
+    with _lock:
+        for month in segments():
+            segment_dir = _segment_dir(month)
+            index = _read_index(segment_dir)
+            if not index:
+                continue
+            updated = 0
+            for column in MAP_COLUMNS:
+                dictionary = index['dictionaries'].get(column) or []
+                refs = _map_refs(dictionary)
+                updated += sum(1 for old, new in zip(dictionary, refs) if old != new)
+                index['dictionaries'][column] = refs
+            if updated:
+                _write_index(segment_dir, index)
+                changed += updated
+    return changed
+
+def migrate(csv_file=None):
+    """
+    Importa el CSV histórico al almacén columnar y borra el CSV
+
+    Returns:
+        dict: {'rows', 'segments', 'bytes_before', 'bytes_after'}, o None si
+              no hay CSV que migrar
+    """
+    csv_file = csv_file or LEGACY_CSV
+    if not os.path.isfile(csv_file):
+        return None
+
+    with open(csv_file, 'r', newline='', encoding='utf-8') as f:
+        rows = [row for row in csv.DictReader(f) if row.get('timestamp')]
+    append_many(rows)
+
+    segment_bytes = sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(HISTORY_DIR) for name in names
+    )
+    summary = {
+        'rows': len(rows),
+        'segments': len(segments()),
+        'bytes_before': os.path.getsize(csv_file),
+        'bytes_after': segment_bytes
+    }
+    os.remove(csv_file)
+    return summary
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'migrate':
+        result = migrate()
+        if result is None:
+            print("[OK] Sin CSV histórico que migrar")
+        else:
+            print(f"[OK] {result['rows']} filas migradas a {result['segments']} segmentos mensuales "
+                  f"({result['bytes_before'] / 1e3:.0f} KB en CSV, {result['bytes_after'] / 1e3:.0f} KB columnar)")
+        print(f"[OK] {relink()} rutas de mapas apuntan ahora al almacén de mapas")
+    else:
+        months = segments()
+        total = sum(_read_index(_segment_dir(month))['rows'] for month in months)
+        print(f"Historial: {total} filas en {len(months)} segmentos ({', '.join(months) or '-'})")
+        print("Uso: python history_store.py migrate")
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+AgroMonitor - Renderizado local de mapas
+
+El mapa NDVI coloreado se genera a partir del raster NDVI FLOAT32 que el
+colector ya descarga para las estadísticas, en lugar de pedir a Sentinel
+Hub una imagen aparte con NDVI_COLOR_EVALSCRIPT.
+
+La paleta es una tabla (LUT) con los mismos cortes y colores que el
+evalscript, aplicada de forma vectorizada:
+
+    clase = digitize(ndvi, [0, 0.2, 0.4, 0.6, 0.8])  ->  LUT[clase]
+
+Igual que en el evalscript, un NDVI no numérico (0/0 en píxeles sin dato)
+no cumple ninguna comparación y cae en la última clase (verde oscuro); el
+canal alfa sale de dataMask.
+
+Los mapas se piden a la resolución nativa de Sentinel-2 (10 m): el PU
+cobrado crece con el tamaño de salida, así que la ampliación para
+visualización se hace aquí, al guardar el PNG, con el filtro configurado.
+"""
+
+import io
+import os
+import numpy as np
+
+# Ampliación de los PNG para visualización (1 = resolución nativa)
+MAP_DISPLAY_SCALE = int(os.environ.get('MAP_DISPLAY_SCALE', 2))
+
+# Filtro de ampliación de Pillow: nearest | bilinear | bicubic | lanczos
+MAP_RESAMPLE = os.environ.get('MAP_RESAMPLE', 'bicubic')
+
+# Cortes de NDVI_COLOR_EVALSCRIPT (copernicus_collector.py)
+NDVI_CLASS_EDGES = np.array([0.0, 0.2, 0.4, 0.6, 0.8])
+
+# Colores por clase en 0-1, como en el evalscript
+NDVI_CLASS_COLORS = (
+    (0.5, 0.5, 0.5),  # < 0: gris para agua/nubes
+    (0.8, 0.2, 0.1),  # < 0.2: rojo - suelo/vegetación pobre
+    (0.9, 0.6, 0.1),  # < 0.4: naranja
+    (0.9, 0.9, 0.2),  # < 0.6: amarillo
+    (0.4, 0.8, 0.2),  # < 0.8: verde claro
+    (0.1, 0.6, 0.1),  # resto: verde oscuro - vegetación densa
+)
+
+# La salida PNG (UINT8 AUTO) de Sentinel Hub escala 0-1 a 0-255
+NDVI_LUT = np.round(np.array(NDVI_CLASS_COLORS) * 255).astype(np.uint8)
+
+def colorize_ndvi(ndvi, mask=None):
+    """
+    Colorea un raster NDVI con la paleta de NDVI_COLOR_EVALSCRIPT
+
+    Args:
+        ndvi: Raster 2-D de NDVI
+        mask: Banda dataMask (0 = sin dato) o None
+
+    Returns:
+        np.ndarray: imagen RGBA uint8 (alto, ancho, 4)
+    """
+    ndvi = np.asarray(ndvi)
+    classes = np.digitize(ndvi, NDVI_CLASS_EDGES)
+    classes[np.isnan(ndvi)] = len(NDVI_CLASS_COLORS) - 1
+
+    rgba = np.empty(ndvi.shape + (4,), dtype=np.uint8)
+    rgba[..., :3] = NDVI_LUT[classes]
+    if mask is None:
+        rgba[..., 3] = 255
+    else:
+        rgba[..., 3] = np.where(np.asarray(mask) != 0, 255, 0)
+    return rgba
+
+def _resample_filter(name):
+    from PIL import Image
+
+    filters = getattr(Image, 'Resampling', Image)
+    try:
+        return getattr(filters, name.upper())
+    except AttributeError:
+        raise ValueError(f"Filtro de ampliación desconocido: {name}")
+
+def encode_png(image, scale=None, resample=None):
+    """
+    Codifica una imagen uint8 (RGB o RGBA) como PNG
+
+    Args:
+        image: Array (alto, ancho, bandas) a resolución nativa
+        scale: Factor de ampliación (por defecto MAP_DISPLAY_SCALE)
+        resample: Filtro de ampliación (por defecto MAP_RESAMPLE)
+
+    Returns:
+        bytes: contenido del PNG
+    """
+    from PIL import Image
+
+    scale = MAP_DISPLAY_SCALE if scale is None else scale
+    mode = 'RGBA' if image.ndim == 3 and image.shape[-1] == 4 else None
+    img = Image.fromarray(image, mode)
+    if scale > 1:
+        img = img.resize((img.width * scale, img.height * scale),
+                         _resample_filter(resample or MAP_RESAMPLE))
+    buffer = io.BytesIO()
+    img.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+def save_png(image, path, scale=None, resample=None):
+    """Guarda una imagen uint8 como PNG en una ruta (ver encode_png)"""
+    with open(path, 'wb') as f:
+        f.write(encode_png(image, scale, resample))
+    return path
+
+def encode_ndvi_png(ndvi, mask, scale=None, resample='nearest'):
+    """
+    Colorea el NDVI y lo codifica como PNG
+
+    La paleta es por clases, así que por defecto se amplía con 'nearest'
+    para no inventar colores intermedios en los bordes.
+    """
+    return encode_png(colorize_ndvi(ndvi, mask), scale, resample)
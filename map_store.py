@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+AgroMonitor - Almacén de mapas PNG direccionado por contenido
+
+Mientras el mosaico de 30 días no cambia, los mapas diarios salen idénticos
+byte a byte. En lugar de un PNG por día, cada imagen se guarda una sola vez
+con su hash como nombre y un manifiesto apunta cada mapa diario a su blob:
+
+    data/maps/blobs/<aa>/<sha256>.png      contenido, único
+    data/maps/manifest.json                {nombre: {'blob', 'bytes', ...}}
+
+El nombre de cada mapa es el mismo que usaba el archivo suelto
+(p.ej. 'farm_ndvi_20260203'), así que los nombres históricos siguen siendo
+válidos a través de resolve(). Un mapa repetido solo agrega una entrada al
+manifiesto.
+
+Migración de los PNG sueltos existentes:
+
+    python map_store.py migrate
+"""
+
+import os
+import re
+import sys
+import json
+import glob
+import hashlib
+import threading
+from datetime import datetime
+
+MAPS_DIR = os.environ.get(
+    'MAP_STORE_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'maps')
+)
+BLOBS_DIR = os.path.join(MAPS_DIR, 'blobs')
+MANIFEST_FILE = os.path.join(MAPS_DIR, 'manifest.json')
+
+# Nombre de los PNG sueltos: <prefijo>_<tipo>_<AAAAMMDD>; el prefijo es el
+# ID de la finca, salvo 'farm', que era la finca original
+LEGACY_NAME = re.compile(r'^(?P<prefix>.+)_(?P<map_type>rgb|ndvi)_(?P<date>\d{8})$')
+LEGACY_FARM_PREFIX = 'farm'
+DEFAULT_POLYGON_ID = 'los_valles_veraguas'
+
+_lock = threading.Lock()
+
+def blob_path(digest):
+    return os.path.join(BLOBS_DIR, digest[:2], f"{digest}.png")
+
+def load_manifest():
+    """Manifiesto {nombre: entrada}; vacío si todavía no existe"""
+    try:
+        with open(MANIFEST_FILE, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'version': 1, 'maps': {}}
+
+def _save_manifest(manifest):
+    os.makedirs(MAPS_DIR, exist_ok=True)
+    tmp_path = f"{MANIFEST_FILE}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, MANIFEST_FILE)
+
+def _write_blob(data):
+    """Guarda el contenido si no existe; retorna (hash, ruta, nuevo)"""
+    digest = hashlib.sha256(data).hexdigest()
+    path = blob_path(digest)
+    if os.path.exists(path):
+        return digest, path, False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return digest, path, True
+
+def put(name, data, **meta):
+    """
+    Guarda un mapa PNG
+
+    Args:
+        name: Nombre del mapa (p.ej. 'farm_rgb_20260203')
+        data: Bytes del PNG
+        meta: Metadatos extra para el manifiesto (polygon_id, map_type, date)
+
+    Returns:
+        str: Ruta del blob con el contenido
+    """
+    with _lock:
+        digest, path, created = _write_blob(data)
+        manifest = load_manifest()
+        manifest['maps'][name] = {
+            'blob': digest,
+            'bytes': len(data),
+            'stored_at': datetime.now().isoformat(),
+            **meta
+        }
+        _save_manifest(manifest)
+    if not created:
+        print(f"[CACHE] Mapa {name} idéntico a uno existente ({digest[:12]}), sin bytes extra")
+    return path
+
+def legacy_meta(name):
+    """polygon_id, map_type y date de un nombre de mapa suelto ({} si no coincide)"""
+    match = LEGACY_NAME.match(name)
+    if not match:
+        return {}
+    prefix, date = match.group('prefix'), match.group('date')
+    return {
+        'polygon_id': DEFAULT_POLYGON_ID if prefix == LEGACY_FARM_PREFIX else prefix,
+        'map_type': match.group('map_type'),
+        'date': f"{date[:4]}-{date[4:6]}-{date[6:]}"
+    }
+
+def resolve(name):
+    """Ruta del blob de un mapa por nombre, o None si no está en el manifiesto"""
+    entry = load_manifest()['maps'].get(name)
+    return blob_path(entry['blob']) if entry else None
+
+def migrate(maps_dir=None):
+    """
+    Mueve los PNG sueltos de data/maps al almacén (idempotente)
+
+    También completa polygon_id/map_type/date (desde el nombre) en las
+    entradas migradas que no los tengan.
+
+    Returns:
+        dict: {'files', 'blobs_created', 'bytes_before', 'bytes_added',
+               'entries_updated'}
+    """
+    maps_dir = maps_dir or MAPS_DIR
+    files = sorted(glob.glob(os.path.join(maps_dir, '*.png')))
+    summary = {'files': len(files), 'blobs_created': 0, 'bytes_before': 0, 'bytes_added': 0,
+               'entries_updated': 0}
+
+    with _lock:
+        manifest = load_manifest()
+        for path in files:
+            with open(path, 'rb') as f:
+                data = f.read()
+            digest, _, created = _write_blob(data)
+            name = os.path.splitext(os.path.basename(path))[0]
+            manifest['maps'].setdefault(name, {
+                'blob': digest,
+                'bytes': len(data),
+                'stored_at': datetime.fromtimestamp(os.path.getmtime(path)).isoformat(),
+                'migrated': True,
+                **legacy_meta(name)
+            })
+            summary['bytes_before'] += len(data)
+            if created:
+                summary['blobs_created'] += 1
+                summary['bytes_added'] += len(data)
+        for name, entry in manifest['maps'].items():
+            missing = {key: value for key, value in legacy_meta(name).items() if key not in entry}
+            if missing:
+                entry.update(missing)
+                summary['entries_updated'] += 1
+        if files or summary['entries_updated']:
+            _save_manifest(manifest)
+        for path in files:
+            os.remove(path)
+    return summary
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'migrate':
+        result = migrate()
+        print(f"[OK] {result['files']} mapas migrados a {result['blobs_created']} blobs "
+              f"({result['bytes_before'] / 1e6:.1f} MB sueltos, {result['bytes_added'] / 1e6:.1f} MB nuevos); "
+              f"{result['entries_updated']} entradas completadas")
+    else:
+        manifest = load_manifest()
+        blobs = {entry['blob'] for entry in manifest['maps'].values()}
+        print(f"Mapas: {len(manifest['maps'])} | Blobs únicos: {len(blobs)}")
+        print("Uso: python map_store.py migrate")
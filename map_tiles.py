@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+AgroMonitor - Pirámide de teselas y derivados comprimidos de los mapas
+
+Después de guardar un mapa en el almacén por contenido (map_store), se
+generan a partir del PNG:
+
+    data/maps/tiles/<sha256>/
+        pyramid.json        tamaño, niveles y formatos
+        full.webp           imagen completa comprimida
+        <z>/<x>/<y>.webp    teselas de TILE_SIZE px
+
+El nivel más alto es la resolución del PNG y cada nivel inferior la reduce
+a la mitad, hasta que la imagen entra en una sola tesela (z = 0). Un panel
+del dashboard pide solo las teselas visibles en lugar del PNG completo.
+
+Como todo cuelga del hash del PNG original, el contenido de una URL nunca
+cambia: el servidor puede marcarlas 'immutable' y un mapa repetido no
+genera teselas nuevas.
+
+Formatos (MAP_TILE_FORMATS, separados por coma): 'webp' por defecto;
+'avif' solo si el Pillow instalado lo soporta, si no se omite con aviso.
+
+Generar derivados de todos los mapas ya guardados (idempotente):
+
+    python map_tiles.py
+"""
+
+import os
+import json
+import math
+import threading
+
+import map_store
+
+TILES_DIR = os.path.join(map_store.MAPS_DIR, 'tiles')
+TILE_SIZE = int(os.environ.get('MAP_TILE_SIZE', 256))
+TILE_FORMATS = [fmt.strip() for fmt in os.environ.get('MAP_TILE_FORMATS', 'webp').split(',') if fmt.strip()]
+WEBP_QUALITY = int(os.environ.get('MAP_WEBP_QUALITY', 80))
+
+# Tipos MIME de los formatos soportados
+MIME_TYPES = {'webp': 'image/webp', 'avif': 'image/avif'}
+
+def pyramid_dir(digest):
+    return os.path.join(TILES_DIR, digest)
+
+def tile_path(digest, z, x, y, fmt='webp'):
+    return os.path.join(pyramid_dir(digest), str(z), str(x), f"{y}.{fmt}")
+
+def load_pyramid(digest):
+    """Manifiesto de la pirámide de un blob, o None si no se generó"""
+    try:
+        with open(os.path.join(pyramid_dir(digest), 'pyramid.json'), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+_formats = None
+
+def _available_formats():
+    """Formatos de MAP_TILE_FORMATS que el Pillow instalado puede escribir"""
+    global _formats
+    if _formats is None:
+        from PIL import features
+
+        _formats = []
+        for fmt in TILE_FORMATS:
+            if fmt in MIME_TYPES and features.check(fmt):
+                _formats.append(fmt)
+            else:
+                print(f"[WARN] Formato de teselas no soportado por Pillow: {fmt}")
+    return _formats
+
+def _save(img, path, fmt):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    img.save(tmp_path, format=fmt.upper(), quality=WEBP_QUALITY)
+    os.replace(tmp_path, path)
+
+def build_pyramid(blob_file):
+    """
+    Genera la pirámide y los derivados de un PNG del almacén (idempotente)
+
+    Args:
+        blob_file: Ruta del blob (retorno de map_store.put)
+
+    Returns:
+        dict: contenido de pyramid.json, o None si falló
+    """
+    from PIL import Image
+
+    digest = os.path.splitext(os.path.basename(blob_file))[0]
+    existing = load_pyramid(digest)
+    if existing:
+        return existing
+
+    try:
+        formats = _available_formats()
+        if not formats:
+            return None
+        image = Image.open(blob_file)
+        image.load()
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA')
+
+        width, height = image.size
+        max_zoom = max(0, math.ceil(math.log2(max(width, height) / TILE_SIZE)))
+        levels = []
+        for z in range(max_zoom, -1, -1):
+            factor = 2 ** (max_zoom - z)
+            level = image if factor == 1 else image.resize(
+                (max(1, math.ceil(width / factor)), max(1, math.ceil(height / factor))),
+                getattr(Image, 'Resampling', Image).LANCZOS
+            )
+            cols = math.ceil(level.width / TILE_SIZE)
+            rows = math.ceil(level.height / TILE_SIZE)
+            for x in range(cols):
+                for y in range(rows):
+                    box = (x * TILE_SIZE, y * TILE_SIZE,
+                           min((x + 1) * TILE_SIZE, level.width), min((y + 1) * TILE_SIZE, level.height))
+                    tile = level.crop(box)
+                    for fmt in formats:
+                        _save(tile, tile_path(digest, z, x, y, fmt), fmt)
+            levels.append({'z': z, 'width': level.width, 'height': level.height,
+                           'cols': cols, 'rows': rows})
+
+        full_bytes = {}
+        for fmt in formats:
+            path = os.path.join(pyramid_dir(digest), f"full.{fmt}")
+            _save(image, path, fmt)
+            full_bytes[fmt] = os.path.getsize(path)
+
+        pyramid = {
+            'blob': digest,
+            'width': width,
+            'height': height,
+            'tile_size': TILE_SIZE,
+            'min_zoom': 0,
+            'max_zoom': max_zoom,
+            'formats': formats,
+            'levels': sorted(levels, key=lambda level: level['z']),
+            'bytes': {'png': os.path.getsize(blob_file), **full_bytes}
+        }
+        path = os.path.join(pyramid_dir(digest), 'pyramid.json')
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(pyramid, f, indent=2)
+        os.replace(tmp_path, path)
+        return pyramid
+
+    except Exception as e:
+        print(f"[ERROR] Pirámide de teselas {digest[:12]}: {e}")
+        return None
+
+def build_all():
+    """Genera los derivados de todos los blobs del manifiesto que no los tengan"""
+    digests = {entry['blob'] for entry in map_store.load_manifest()['maps'].values()}
+    built = 0
+    for digest in sorted(digests):
+        if load_pyramid(digest):
+            continue
+        if build_pyramid(map_store.blob_path(digest)):
+            built += 1
+    return built, len(digests)
+
+if __name__ == '__main__':
+    built, total = build_all()
+    print(f"[OK] Pirámides generadas: {built} nuevas ({total} blobs en el manifiesto)")
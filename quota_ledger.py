@@ -0,0 +1,557 @@
+# -*- coding: utf-8 -*-
+"""
+AgroMonitor - Libro de cuota de Copernicus en PostgreSQL
+
+Reemplaza a quota_tracker.json como fuente de verdad de la cuota mensual.
+El cron de Render y GitHub Actions comparten la misma fila por mes, y todas
+las modificaciones son sentencias atómicas, así que no se pierden
+actualizaciones cuando dos ejecuciones coinciden.
+
+Flujo por solicitud:
+    reserva = reserve('map_rgb', 50)   # Reserva PU antes de la solicitud
+    ... solicitud a Sentinel Hub ...
+    settle(reserva, pu_real)           # Liquida con el costo real
+    release(reserva)                   # o libera si no se consumió nada
+
+Las verificaciones (check) se resuelven con una copia en memoria que se
+carga una vez por ejecución y se actualiza con lo que devuelve cada
+sentencia, de modo que no requieren viajes adicionales a la base de datos.
+
+Al liquidar, el costo real (cabecera x-processingunits-spent de Sentinel
+Hub) alimenta un modelo de costo por forma de solicitud
+('operación:anchoxalto'), un promedio móvil exponencial que el colector usa
+para reservar y proyectar el gasto del mes en lugar de costos fijos. Una
+reserva que cubrió varias solicitudes (un AOI por teselas) se liquida con
+todas ellas: cuenta una request por solicitud y aporta una muestra por
+tesela al modelo.
+
+Cuando una solicitud cubre varias fincas, settle() reparte el costo entre
+ellas (farm_shares) para llevar el consumo mensual por polígono.
+
+Si la base de datos no está disponible se usa quota_tracker.json como
+respaldo local, con la misma interfaz. Si falla a mitad de la ejecución
+(p.ej. al reservar), el proceso sigue con el respaldo partiendo de lo
+último que leyó de la BD, en lugar de tratar el error como falta de cuota.
+"""
+
+import os
+import json
+import threading
+from datetime import datetime
+
+import db_config
+
+QUOTA_FILE = os.path.join(os.path.dirname(__file__), 'quota_tracker.json')
+
+# Límites por defecto (se aplican al crear la fila de un mes nuevo)
+DEFAULT_LIMITS = {
+    'monthly_limit_pu': int(os.environ.get('QUOTA_MONTHLY_LIMIT_PU', 30000)),
+    'monthly_limit_requests': int(os.environ.get('QUOTA_MONTHLY_LIMIT_REQUESTS', 30000)),
+    'daily_budget_pu': 1000,
+    'daily_budget_requests': 1000,
+}
+
+# Reservas sin liquidar más antiguas que esto se consideran huérfanas
+# (proceso interrumpido) y se liberan al cargar el libro
+STALE_RESERVATION_MINUTES = 60
+
+# Peso mínimo de cada nueva medición en el promedio móvil del modelo de costo.
+# Las primeras muestras usan 1/n (promedio simple) hasta llegar a este peso.
+COST_MODEL_ALPHA = 0.2
+
+_LEDGER_COLUMNS = (
+    'month', 'monthly_limit_pu', 'monthly_limit_requests',
+    'processing_units_used', 'requests_used',
+    'processing_units_reserved', 'requests_reserved',
+    'collections_today', 'last_collection_date'
+)
+
+_lock = threading.RLock()
+_conn = None
+_backend = None      # 'db' o 'json', se decide en la primera carga
+_cache = None        # Copia en memoria del estado del mes
+_cost_model = None  # {forma: {'avg_pu', 'samples'}}, se lee una vez por ejecución
+
+
+def _current_month():
+    return datetime.now().strftime('%Y-%m')
+
+
+# ============================================================
+# BACKEND POSTGRESQL
+# ============================================================
+
+def _get_conn():
+    """Conexión persistente del proceso (None si la BD no está disponible)"""
+    global _conn
+    if _conn is not None and not _conn.closed:
+        return _conn
+    try:
+        _conn = db_config.get_connection()
+    except Exception as e:
+        print(f"[QUOTA] BD no disponible: {e}")
+        _conn = None
+    return _conn
+
+def _row_to_quota(row):
+    quota = dict(zip(_LEDGER_COLUMNS, row))
+    for key in ('processing_units_used', 'processing_units_reserved'):
+        quota[key] = float(quota[key])
+    quota['current_month'] = quota.pop('month')
+    if quota['last_collection_date'] is not None:
+        quota['last_collection_date'] = quota['last_collection_date'].isoformat()
+    return quota
+
+def _db_execute(sql, params, fetch=True):
+    """Ejecuta una sentencia en su propia transacción y retorna la primera fila"""
+    conn = _get_conn()
+    cur = conn.cursor()
+    try:
+        cur.execute(sql, params)
+        row = cur.fetchone() if fetch else None
+        conn.commit()
+        return row
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+def _db_load():
+    """
+    Asegura la fila del mes, libera reservas huérfanas y lee el estado,
+    todo en un único viaje a la base de datos
+    """
+    seed = _json_seed_for_month(_current_month())
+    columns = ', '.join(_LEDGER_COLUMNS)
+    return _row_to_quota(_db_execute(f"""
+        INSERT INTO quota_ledger
+            (month, monthly_limit_pu, monthly_limit_requests, processing_units_used, requests_used)
+        VALUES (%(month)s, %(limit_pu)s, %(limit_req)s, %(seed_pu)s, %(seed_req)s)
+        ON CONFLICT (month) DO NOTHING;
+
+        WITH stale AS (
+            UPDATE quota_reservations
+            SET status = 'released', settled_at = NOW()
+            WHERE month = %(month)s AND status = 'reserved'
+              AND created_at < NOW() - INTERVAL '{STALE_RESERVATION_MINUTES} minutes'
+            RETURNING pu_reserved
+        )
+        UPDATE quota_ledger
+        SET processing_units_reserved = processing_units_reserved
+                - COALESCE((SELECT SUM(pu_reserved) FROM stale), 0),
+            requests_reserved = requests_reserved - (SELECT COUNT(*) FROM stale)
+        WHERE month = %(month)s
+        RETURNING {columns};
+    """, {
+        'month': _current_month(),
+        'limit_pu': seed['monthly_limit_pu'],
+        'limit_req': seed['monthly_limit_requests'],
+        'seed_pu': seed['processing_units_used'],
+        'seed_req': seed['requests_used'],
+    }))
+
+def _db_reserve(operation, pu_cost):
+    columns = ', '.join(f"l.{column}" for column in _LEDGER_COLUMNS)
+    row = _db_execute(f"""
+        WITH l AS (
+            UPDATE quota_ledger
+            SET processing_units_reserved = processing_units_reserved + %(pu)s,
+                requests_reserved = requests_reserved + 1,
+                updated_at = NOW()
+            WHERE month = %(month)s
+              AND processing_units_used + processing_units_reserved + %(pu)s <= monthly_limit_pu
+              AND requests_used + requests_reserved + 1 <= monthly_limit_requests
+            RETURNING *
+        ), r AS (
+            INSERT INTO quota_reservations (month, operation, pu_reserved)
+            SELECT month, %(operation)s, %(pu)s FROM l
+            RETURNING id
+        )
+        SELECT r.id, {columns} FROM r, l
+    """, {'month': _current_month(), 'operation': operation, 'pu': pu_cost})
+    if not row:
+        return None, None
+    return row[0], _row_to_quota(row[1:])
+
+def _db_settle(reservation_id, pu_actual, status, measurements=None, farm_shares=None, requests=1):
+    """
+    Cierra una reserva; con status='settled' el costo real y las 'requests'
+    solicitudes pasan a 'usado', se reparte entre las fincas de farm_shares
+    y las mediciones ({forma: (PU promedio, muestras)}) actualizan el
+    modelo de costo
+    """
+    farm_shares = farm_shares or {}
+    measurements = measurements or {}
+    columns = ', '.join(f"l.{column}" for column in _LEDGER_COLUMNS)
+    settled = status == 'settled'
+    row = _db_execute(f"""
+        WITH s AS (
+            UPDATE quota_reservations
+            SET status = %(status)s, pu_actual = %(pu_actual)s,
+                request_shape = %(shape)s, settled_at = NOW()
+            WHERE id = %(id)s AND status = 'reserved'
+            RETURNING month, pu_reserved
+        ), m AS (
+            INSERT INTO quota_cost_model (request_shape, avg_pu, samples)
+            SELECT sample.shape, sample.avg_pu, sample.n
+            FROM s, unnest(%(shapes)s::text[], %(shape_pu)s::float8[], %(shape_n)s::int[])
+                AS sample(shape, avg_pu, n)
+            WHERE %(settled)s
+            ON CONFLICT (request_shape) DO UPDATE
+            SET avg_pu = quota_cost_model.avg_pu
+                    + GREATEST(EXCLUDED.samples::float8 / (quota_cost_model.samples + EXCLUDED.samples),
+                               %(alpha)s)
+                    * (EXCLUDED.avg_pu - quota_cost_model.avg_pu),
+                samples = quota_cost_model.samples + EXCLUDED.samples,
+                updated_at = NOW()
+        ), f AS (
+            INSERT INTO quota_farm_usage (month, polygon_id, processing_units_used, requests_used)
+            SELECT s.month, farm.polygon_id, %(pu_actual)s * farm.share, 1
+            FROM s, unnest(%(farm_ids)s::text[], %(farm_shares)s::float8[]) AS farm(polygon_id, share)
+            WHERE %(settled)s
+            ON CONFLICT (month, polygon_id) DO UPDATE
+            SET processing_units_used = quota_farm_usage.processing_units_used
+                    + EXCLUDED.processing_units_used,
+                requests_used = quota_farm_usage.requests_used + 1,
+                updated_at = NOW()
+        )
+        UPDATE quota_ledger l
+        SET processing_units_reserved = l.processing_units_reserved - s.pu_reserved,
+            requests_reserved = l.requests_reserved - 1,
+            processing_units_used = l.processing_units_used + %(pu_used)s,
+            requests_used = l.requests_used + %(req_used)s,
+            collections_today = CASE
+                WHEN NOT %(settled)s THEN l.collections_today
+                WHEN l.last_collection_date = CURRENT_DATE THEN l.collections_today + 1
+                ELSE 1 END,
+            last_collection_date = CASE
+                WHEN %(settled)s THEN CURRENT_DATE ELSE l.last_collection_date END,
+            updated_at = NOW()
+        FROM s
+        WHERE l.month = s.month
+        RETURNING {columns}
+    """, {
+        'id': reservation_id,
+        'status': status,
+        'pu_actual': pu_actual,
+        'shape': ','.join(sorted(measurements))[:100] or None,
+        'shapes': list(measurements),
+        'shape_pu': [float(avg_pu) for avg_pu, _ in measurements.values()],
+        'shape_n': [samples for _, samples in measurements.values()],
+        'alpha': COST_MODEL_ALPHA,
+        'farm_ids': list(farm_shares),
+        'farm_shares': [float(share) for share in farm_shares.values()],
+        'pu_used': pu_actual if settled else 0,
+        'req_used': requests if settled else 0,
+        'settled': settled,
+    })
+    return _row_to_quota(row) if row else None
+
+def _db_farm_usage():
+    conn = _get_conn()
+    cur = conn.cursor()
+    try:
+        cur.execute("""
+            SELECT polygon_id, processing_units_used, requests_used
+            FROM quota_farm_usage
+            WHERE month = %s
+        """, (_current_month(),))
+        rows = cur.fetchall()
+        conn.commit()
+    finally:
+        cur.close()
+    return {polygon_id: {'pu': float(pu), 'requests': requests} for polygon_id, pu, requests in rows}
+
+def _db_cost_model():
+    conn = _get_conn()
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT request_shape, avg_pu, samples FROM quota_cost_model")
+        rows = cur.fetchall()
+        conn.commit()
+    finally:
+        cur.close()
+    return {shape: {'avg_pu': float(avg_pu), 'samples': samples} for shape, avg_pu, samples in rows}
+
+
+# ============================================================
+# BACKEND JSON (RESPALDO LOCAL)
+# ============================================================
+
+def _json_read():
+    if not os.path.exists(QUOTA_FILE):
+        return None
+    with open(QUOTA_FILE, 'r') as f:
+        return json.load(f)
+
+def _json_seed_for_month(month):
+    """Valores iniciales del mes (migra lo registrado en quota_tracker.json)"""
+    seed = dict(DEFAULT_LIMITS, processing_units_used=0, requests_used=0)
+    quota = _json_read()
+    if quota:
+        seed['monthly_limit_pu'] = quota.get('monthly_limit_pu', seed['monthly_limit_pu'])
+        seed['monthly_limit_requests'] = quota.get('monthly_limit_requests', seed['monthly_limit_requests'])
+        if quota.get('current_month') == month:
+            seed['processing_units_used'] = quota.get('processing_units_used', 0)
+            seed['requests_used'] = quota.get('requests_used', 0)
+    return seed
+
+def _json_load():
+    quota = _json_read()
+    month = _current_month()
+    if quota is None:
+        quota = dict(DEFAULT_LIMITS, current_month=month, processing_units_used=0,
+                     requests_used=0, collections_today=0, last_collection_date=None)
+        _json_save(quota)
+    elif quota.get('current_month') != month:
+        # Reset si es un nuevo mes
+        quota['current_month'] = month
+        quota['processing_units_used'] = 0
+        quota['requests_used'] = 0
+        quota['collections_today'] = 0
+        quota['farm_usage'] = {}
+        _json_save(quota)
+        print("[QUOTA] Nuevo mes detectado - cuota reseteada")
+    # Las reservas del respaldo JSON solo viven en memoria del proceso
+    quota['processing_units_reserved'] = 0
+    quota['requests_reserved'] = 0
+    return quota
+
+def _use_json_backend():
+    """Pasa al respaldo JSON sin perder lo ya leído de la BD (se llama con _lock)"""
+    global _backend, _cache
+    previous = _cache
+    _backend = 'json'
+    _cache = _json_load()
+    if previous and previous['current_month'] == _cache['current_month']:
+        if any(previous[key] > _cache[key] for key in ('processing_units_used', 'requests_used')):
+            # El archivo queda con el consumo que ya registró la BD
+            for key in ('processing_units_used', 'requests_used'):
+                _cache[key] = max(_cache[key], previous[key])
+            _json_save(_cache)
+        _cache['processing_units_reserved'] = previous['processing_units_reserved']
+        _cache['requests_reserved'] = previous['requests_reserved']
+
+def _json_save(quota):
+    stored = {k: v for k, v in quota.items() if k not in ('processing_units_reserved', 'requests_reserved')}
+    stored['last_updated'] = datetime.now().isoformat()
+    with open(QUOTA_FILE, 'w') as f:
+        json.dump(stored, f, indent=4)
+
+
+# ============================================================
+# API PÚBLICA
+# ============================================================
+
+def load(refresh=False):
+    """
+    Estado de la cuota del mes (copia en memoria, se lee una vez por ejecución)
+
+    Returns:
+        dict: monthly_limit_pu, processing_units_used, processing_units_reserved,
+              requests_used, collections_today, ...
+    """
+    global _backend, _cache
+    with _lock:
+        if _cache is not None and not refresh and _cache['current_month'] == _current_month():
+            return dict(_cache)
+
+        if _backend != 'json' and _get_conn() is not None:
+            try:
+                _cache = _db_load()
+                _backend = 'db'
+                return dict(_cache)
+            except Exception as e:
+                print(f"[QUOTA] Libro en BD no disponible, usando {os.path.basename(QUOTA_FILE)}: {e}")
+
+        # Conserva las reservas en curso de este proceso
+        _use_json_backend()
+        return dict(_cache)
+
+def remaining(quota=None):
+    """PU y requests disponibles descontando lo usado y lo reservado"""
+    quota = quota or load()
+    pu = quota['monthly_limit_pu'] - quota['processing_units_used'] - quota['processing_units_reserved']
+    req = quota['monthly_limit_requests'] - quota['requests_used'] - quota['requests_reserved']
+    return pu, req
+
+def check(pu_cost):
+    """True si hay cuota para pu_cost (sin viajes a la BD)"""
+    pu, req = remaining()
+    return pu >= pu_cost and req >= 1
+
+def reserve(operation, pu_cost):
+    """
+    Reserva PU antes de una solicitud (atómico en BD)
+
+    Si la BD falla, la reserva se hace en el respaldo JSON: None significa
+    siempre falta de cuota, nunca un error de la BD.
+
+    Returns:
+        dict: reserva {'id', 'operation', 'pu'} o None si no hay cuota
+    """
+    global _cache
+    load()
+    with _lock:
+        if _backend == 'db':
+            try:
+                reservation_id, quota = _db_reserve(operation, pu_cost)
+            except Exception as e:
+                print(f"[QUOTA] Error reservando en BD, se continúa con {os.path.basename(QUOTA_FILE)}: {e}")
+                _use_json_backend()
+            else:
+                if reservation_id is None:
+                    return None
+                _cache = quota
+                return {'id': reservation_id, 'operation': operation, 'pu': pu_cost}
+
+        if not check(pu_cost):
+            return None
+        _cache['processing_units_reserved'] += pu_cost
+        _cache['requests_reserved'] += 1
+        return {'id': None, 'operation': operation, 'pu': pu_cost}
+
+def settle(reservation, pu_actual=None, cost_samples=None, farm_shares=None, requests=1):
+    """
+    Liquida una reserva con el costo real (por defecto, lo reservado)
+
+    Args:
+        reservation: Reserva retornada por reserve()
+        pu_actual: PU reportadas por Sentinel Hub (total de la reserva)
+        cost_samples: [(forma, PU)] una por solicitud ('operación:anchoxalto');
+            se incorporan al modelo de costo
+        farm_shares: {polygon_id: fracción} para repartir el costo por finca
+        requests: Solicitudes hechas con la reserva (teselas de un AOI grande)
+    """
+    global _cache
+    measurements = _cost_measurements(cost_samples)
+    if pu_actual is None:
+        pu_actual = reservation['pu']
+    with _lock:
+        model = cost_model() if measurements else None
+        for shape, (avg_pu, samples) in measurements.items():
+            _update_cost_model(model, shape, avg_pu, samples)
+        if _backend == 'db':
+            try:
+                quota = _db_settle(reservation['id'], pu_actual, 'settled',
+                                   measurements, farm_shares, requests)
+            except Exception as e:
+                # Las PU ya se gastaron: se registran en el respaldo JSON
+                print(f"[QUOTA] Error liquidando en BD, se continúa con {os.path.basename(QUOTA_FILE)}: {e}")
+                _use_json_backend()
+            else:
+                if quota:
+                    _cache = quota
+                return dict(_cache)
+
+        # Releer el archivo para no pisar lo que otro proceso haya guardado
+        reserved_pu = _cache['processing_units_reserved'] - reservation['pu']
+        reserved_req = _cache['requests_reserved'] - 1
+        quota = _json_load()
+        quota['processing_units_used'] += pu_actual
+        quota['requests_used'] += requests
+        today = datetime.now().strftime('%Y-%m-%d')
+        if quota.get('last_collection_date') != today:
+            quota['collections_today'] = 1
+            quota['last_collection_date'] = today
+        else:
+            quota['collections_today'] += 1
+        for shape, (avg_pu, samples) in measurements.items():
+            _update_cost_model(quota.setdefault('cost_model', {}), shape, avg_pu, samples)
+        usage = quota.setdefault('farm_usage', {})
+        for polygon_id, share in (farm_shares or {}).items():
+            entry = usage.setdefault(polygon_id, {'pu': 0, 'requests': 0})
+            entry['pu'] += pu_actual * share
+            entry['requests'] += 1
+        _json_save(quota)
+        quota['processing_units_reserved'] = reserved_pu
+        quota['requests_reserved'] = reserved_req
+        _cache = quota
+        return dict(_cache)
+
+def release(reservation):
+    """Libera una reserva que no llegó a consumir cuota"""
+    global _cache
+    with _lock:
+        if _backend == 'db':
+            try:
+                quota = _db_settle(reservation['id'], 0, 'released')
+            except Exception as e:
+                print(f"[QUOTA] Error liberando en BD, se continúa con {os.path.basename(QUOTA_FILE)}: {e}")
+                _use_json_backend()
+            else:
+                if quota:
+                    _cache = quota
+                return
+        _cache['processing_units_reserved'] -= reservation['pu']
+        _cache['requests_reserved'] -= 1
+
+def cost_model(refresh=False):
+    """
+    Modelo de costo medido por forma de solicitud
+
+    Returns:
+        dict: {'operación:anchoxalto': {'avg_pu': float, 'samples': int}}
+    """
+    global _cost_model
+    load()
+    with _lock:
+        if _cost_model is not None and not refresh:
+            return _cost_model
+        model = None
+        if _backend == 'db':
+            try:
+                model = _db_cost_model()
+            except Exception as e:
+                print(f"[QUOTA] Error leyendo modelo de costo: {e}")
+        if model is None:
+            model = (_json_read() or {}).get('cost_model', {})
+        _cost_model = model
+        return _cost_model
+
+def farm_usage():
+    """
+    Consumo del mes por finca
+
+    Returns:
+        dict: {polygon_id: {'pu': float, 'requests': int}}
+    """
+    load()
+    with _lock:
+        if _backend == 'db':
+            try:
+                return _db_farm_usage()
+            except Exception as e:
+                print(f"[QUOTA] Error leyendo consumo por finca: {e}")
+                return {}
+        return dict((_json_read() or {}).get('farm_usage', {}))
+
+def _cost_measurements(cost_samples):
+    """[(forma, PU)] a {forma: (PU promedio, muestras)}"""
+    grouped = {}
+    for shape, pu in cost_samples or ():
+        grouped.setdefault(shape, []).append(float(pu))
+    return {shape: (sum(values) / len(values), len(values)) for shape, values in grouped.items()}
+
+def _update_cost_model(model, request_shape, pu_actual, samples=1):
+    """
+    Promedio móvil: 1/n para las primeras muestras, luego COST_MODEL_ALPHA
+
+    Varias muestras de la misma forma (teselas iguales) entran juntas con su
+    promedio y peso samples/n.
+    """
+    entry = model.get(request_shape)
+    if entry is None:
+        model[request_shape] = {'avg_pu': float(pu_actual), 'samples': samples}
+        return
+    weight = max(samples / (entry['samples'] + samples), COST_MODEL_ALPHA)
+    entry['avg_pu'] += weight * (float(pu_actual) - entry['avg_pu'])
+    entry['samples'] += samples
+
+def record(operation, pu_cost):
+    """Registra directamente un consumo ya realizado (reserva + liquidación)"""
+    reservation = reserve(operation, 0)
+    if reservation is None:
+        return None
+    return settle(reservation, pu_cost)
@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+"""
+AgroMonitor - Archivo local de rasters de índices (datacube)
+
+Cada adquisición procesada deja sus rasters NDVI/NDWI/NDSI y la banda
+dataMask en un archivo local de solo-agregado, para poder re-analizar la
+historia sin volver a pagar PU.
+
+Estructura por polígono y forma de raster:
+
+    archive/<polygon_id>/<alto>x<ancho>/
+        index.json      fechas, adquisiciones y metadatos de la pila
+        ndvi.dat        pila (tiempo, y, x) binaria, sin encabezado
+        ndwi.dat
+        ndsi.dat
+        dataMask.dat    uint8
+
+Los .dat se leen con np.memmap: una serie temporal de un píxel o de una
+ventana solo toca esas posiciones del disco, sin cargar la historia en RAM.
+Agregar una fecha es escribir un bloque al final de cada archivo y luego
+reemplazar index.json de forma atómica; un bloque escrito sin su entrada en
+el índice (proceso interrumpido) se descarta en el siguiente agregado.
+
+Las consultas interactivas (api_server.py) leen por teselas de
+TILE_SIZE x TILE_SIZE píxeles con toda su serie temporal, ya decodificadas
+y enmascaradas, guardadas en una caché LRU: consultar de nuevo la misma
+zona no vuelve a tocar el disco. La clave incluye el número de fechas, así
+que un agregado nuevo invalida las teselas viejas sin más trámite.
+
+Compresión opcional (RASTER_ARCHIVE_DTYPE):
+    'float32'  valores exactos, NaN = sin dato (por defecto)
+    'int16'    cuantizado a 1e-4 (mitad de tamaño), -32768 = sin dato;
+               sigue siendo mapeable en memoria, a diferencia de zlib
+"""
+
+import os
+import json
+import threading
+from collections import OrderedDict
+from datetime import datetime
+import numpy as np
+import zone_masks
+
+ARCHIVE_DIR = os.environ.get(
+    'RASTER_ARCHIVE_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'archive')
+)
+ARCHIVE_DTYPE = os.environ.get('RASTER_ARCHIVE_DTYPE', 'float32')
+
+LAYERS = ('ndvi', 'ndwi', 'ndsi')
+MASK_LAYER = 'dataMask'
+
+INT16_SCALE = 10000
+INT16_NODATA = -32768
+
+# Caché LRU de teselas decodificadas (tiempo, TILE_SIZE, TILE_SIZE)
+TILE_SIZE = int(os.environ.get('RASTER_TILE_SIZE', 64))
+TILE_CACHE_SIZE = int(os.environ.get('RASTER_TILE_CACHE_SIZE', 256))
+
+_lock = threading.Lock()
+_tiles = OrderedDict()
+_tiles_lock = threading.Lock()
+
+def _stack_dir(polygon_id, shape):
+    return os.path.join(ARCHIVE_DIR, polygon_id, f"{shape[0]}x{shape[1]}")
+
+def _layer_path(stack_dir, layer):
+    return os.path.join(stack_dir, f"{layer}.dat")
+
+def _read_index(stack_dir):
+    try:
+        with open(os.path.join(stack_dir, 'index.json'), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _write_index(stack_dir, index):
+    path = os.path.join(stack_dir, 'index.json')
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f, indent=2)
+    os.replace(tmp_path, path)
+
+def _encode(array, dtype):
+    """Convierte un raster float al tipo de almacenamiento"""
+    array = np.asarray(array, dtype=np.float32)
+    if dtype == 'int16':
+        encoded = np.round(np.clip(array, -3.2767, 3.2767) * INT16_SCALE)
+        encoded[~np.isfinite(array)] = INT16_NODATA
+        return encoded.astype(np.int16)
+    return array
+
+def decode(values, dtype):
+    """Convierte valores almacenados a float32 con NaN como sin dato"""
+    if dtype == 'int16':
+        decoded = values.astype(np.float32) / INT16_SCALE
+        decoded[values == INT16_NODATA] = np.nan
+        return decoded
+    return np.asarray(values, dtype=np.float32)
+
+def append(polygon_id, date, rasters, mask, acquisition_id=None, bbox=None):
+    """
+    Agrega una adquisición al archivo del polígono
+
+    Args:
+        polygon_id: ID de la finca
+        date: Fecha de la adquisición (ISO)
+        rasters: {índice: np.ndarray 2-D}; los índices ausentes quedan sin dato
+        mask: Banda dataMask del mismo tamaño
+        acquisition_id: ID de la escena (evita duplicados)
+        bbox: bbox WGS84 del raster (para ubicar píxeles por coordenada)
+
+    Returns:
+        bool: True si se agregó, False si ya estaba archivada
+    """
+    shape = tuple(np.asarray(mask).shape)
+    stack_dir = _stack_dir(polygon_id, shape)
+
+    with _lock:
+        os.makedirs(stack_dir, exist_ok=True)
+        index = _read_index(stack_dir) or {
+            'polygon_id': polygon_id,
+            'shape': list(shape),
+            'bbox': bbox,
+            'dtype': ARCHIVE_DTYPE,
+            'layers': list(LAYERS),
+            'dates': []
+        }
+        key = acquisition_id or date
+        if any((entry['acquisition'] or entry['date']) == key for entry in index['dates']):
+            return False
+
+        dtype = index['dtype']
+        slot = len(index['dates'])
+        blocks = {layer: _encode(rasters.get(layer, np.full(shape, np.nan)), dtype)
+                  for layer in index['layers']}
+        blocks[MASK_LAYER] = (np.asarray(mask) != 0).astype(np.uint8)
+
+        for layer, block in blocks.items():
+            path = _layer_path(stack_dir, layer)
+            with open(path, 'ab') as f:
+                # Descartar bloques huérfanos de un agregado interrumpido
+                f.truncate(slot * block.nbytes)
+                f.write(block.tobytes())
+
+        index['dates'].append({'date': date, 'acquisition': acquisition_id})
+        index['updated_at'] = datetime.now().isoformat()
+        _write_index(stack_dir, index)
+    return True
+
+def available():
+    """
+    True si este equipo tiene el archivo de rasters
+
+    El archivo vive en archive/ (fuera del repo, en la caché de GitHub
+    Actions donde corre el colector); el servidor de la API en Render no lo
+    recibe.
+    """
+    return os.path.isdir(ARCHIVE_DIR) and any(
+        os.path.isdir(os.path.join(ARCHIVE_DIR, name)) for name in os.listdir(ARCHIVE_DIR)
+    )
+
+def open_stack(polygon_id):
+    """
+    Índice de la pila más reciente del polígono (la forma del raster puede
+    cambiar si cambia el bbox; cada forma es una pila aparte)
+
+    Returns:
+        dict: contenido de index.json más 'dir', o None si no hay archivo
+    """
+    root = os.path.join(ARCHIVE_DIR, polygon_id)
+    if not os.path.isdir(root):
+        return None
+    stacks = []
+    for name in os.listdir(root):
+        index = _read_index(os.path.join(root, name))
+        if index and index['dates']:
+            index['dir'] = os.path.join(root, name)
+            stacks.append(index)
+    if not stacks:
+        return None
+    return max(stacks, key=lambda index: index.get('updated_at', ''))
+
+def read_layer(stack, layer):
+    """
+    Pila completa de una capa como memmap de solo lectura (tiempo, y, x)
+
+    Los valores quedan en el tipo de almacenamiento; usar decode() sobre
+    la porción leída.
+    """
+    count = len(stack['dates'])
+    height, width = stack['shape']
+    dtype = np.uint8 if layer == MASK_LAYER else np.dtype(stack['dtype'])
+    return np.memmap(_layer_path(stack['dir'], layer), dtype=dtype, mode='r',
+                     shape=(count, height, width))
+
+def _read_tile(stack, layer, tile_row, tile_col):
+    """Tesela decodificada y enmascarada, desde la caché LRU o el disco"""
+    key = (stack['dir'], layer, len(stack['dates']), tile_row, tile_col)
+    with _tiles_lock:
+        tile = _tiles.get(key)
+        if tile is not None:
+            _tiles.move_to_end(key)
+            return tile
+
+    rows = slice(tile_row * TILE_SIZE, (tile_row + 1) * TILE_SIZE)
+    cols = slice(tile_col * TILE_SIZE, (tile_col + 1) * TILE_SIZE)
+    tile = decode(np.array(read_layer(stack, layer)[:, rows, cols]), stack['dtype'])
+    tile[np.array(read_layer(stack, MASK_LAYER)[:, rows, cols]) == 0] = np.nan
+
+    with _tiles_lock:
+        _tiles[key] = tile
+        while len(_tiles) > TILE_CACHE_SIZE:
+            _tiles.popitem(last=False)
+    return tile
+
+def read_window(stack, layer, rows, cols):
+    """
+    Serie temporal de una ventana, decodificada y enmascarada
+
+    Args:
+        rows, cols: (inicio, fin) de filas y columnas, fin excluido
+
+    Returns:
+        np.ndarray: (tiempo, filas, columnas) float32 con NaN sin dato
+    """
+    height, width = stack['shape']
+    r0, r1 = max(rows[0], 0), min(rows[1], height)
+    c0, c1 = max(cols[0], 0), min(cols[1], width)
+    window = np.full((len(stack['dates']), max(r1 - r0, 0), max(c1 - c0, 0)),
+                     np.nan, dtype=np.float32)
+    if r1 <= r0 or c1 <= c0:
+        return window
+
+    for tile_row in range(r0 // TILE_SIZE, (r1 - 1) // TILE_SIZE + 1):
+        for tile_col in range(c0 // TILE_SIZE, (c1 - 1) // TILE_SIZE + 1):
+            tile = _read_tile(stack, layer, tile_row, tile_col)
+            top, left = tile_row * TILE_SIZE, tile_col * TILE_SIZE
+            tr0, tr1 = max(r0, top), min(r1, top + TILE_SIZE)
+            tc0, tc1 = max(c0, left), min(c1, left + TILE_SIZE)
+            window[:, tr0 - r0:tr1 - r0, tc0 - c0:tc1 - c0] = \
+                tile[:, tr0 - top:tr1 - top, tc0 - left:tc1 - left]
+    return window
+
+def region_series(stack, layers, rows, cols, region=None):
+    """
+    Serie temporal resumida de una ventana o de una región dentro de ella
+
+    Args:
+        layers: Índices a consultar ('ndvi', 'ndwi'...)
+        rows, cols: (inicio, fin) de la ventana
+        region: Máscara booleana del tamaño de la ventana (None = toda)
+
+    Returns:
+        list: [{'date', 'acquisition', <índice>: {'mean', 'min', 'max', 'count'}}]
+    """
+    series = [{'date': entry['date'], 'acquisition': entry['acquisition']}
+              for entry in stack['dates']]
+    for layer in layers:
+        window = read_window(stack, layer, rows, cols)
+        values = window.reshape(window.shape[0], -1)
+        if region is not None:
+            values = values[:, np.asarray(region).ravel()]
+        counts = np.isfinite(values).sum(axis=1)
+        for point, count, row in zip(series, counts, values):
+            if count == 0:
+                point[layer] = None
+                continue
+            point[layer] = {
+                'mean': round(float(np.nanmean(row)), 4),
+                'min': round(float(np.nanmin(row)), 4),
+                'max': round(float(np.nanmax(row)), 4),
+                'count': int(count)
+            }
+    # Un backfill puede archivar fechas fuera de orden
+    return sorted(series, key=lambda point: point['date'])
+
+def lonlat_to_pixel(stack, lon, lat):
+    """Fila y columna del píxel que contiene (lon, lat), o None si cae fuera"""
+    bbox = stack.get('bbox')
+    if not bbox:
+        return None
+    height, width = stack['shape']
+    col = int((lon - bbox[0]) / (bbox[2] - bbox[0]) * width)
+    row = int((bbox[3] - lat) / (bbox[3] - bbox[1]) * height)
+    if 0 <= row < height and 0 <= col < width:
+        return row, col
+    return None
+
+def bbox_to_window(stack, bbox):
+    """Ventana ((fila0, fila1), (col0, col1)) del raster que cubre un bbox WGS84"""
+    height, width = stack['shape']
+    outer = stack['bbox']
+    c0 = int(np.floor((bbox[0] - outer[0]) / (outer[2] - outer[0]) * width))
+    c1 = int(np.ceil((bbox[2] - outer[0]) / (outer[2] - outer[0]) * width))
+    r0 = int(np.floor((outer[3] - bbox[3]) / (outer[3] - outer[1]) * height))
+    r1 = int(np.ceil((outer[3] - bbox[1]) / (outer[3] - outer[1]) * height))
+    return (max(r0, 0), min(r1, height)), (max(c0, 0), min(c1, width))
+
+def geometry_window(stack, geometry):
+    """
+    Ventana que contiene un polígono GeoJSON y su máscara rasterizada
+
+    Returns:
+        tuple: (filas, columnas, máscara booleana de la ventana), con
+               máscara None si el polígono no cubre ningún píxel
+    """
+    points = np.array([point[:2] for ring in zone_masks.rings(geometry) for point in ring])
+    rows, cols = bbox_to_window(stack, [*points.min(axis=0), *points.max(axis=0)])
+    if rows[1] <= rows[0] or cols[1] <= cols[0]:
+        return rows, cols, None
+
+    height, width = stack['shape']
+    outer = stack['bbox']
+    lon_step = (outer[2] - outer[0]) / width
+    lat_step = (outer[3] - outer[1]) / height
+    window_bbox = [outer[0] + cols[0] * lon_step, outer[3] - rows[1] * lat_step,
+                   outer[0] + cols[1] * lon_step, outer[3] - rows[0] * lat_step]
+    region = zone_masks.rasterize(geometry, window_bbox, (rows[1] - rows[0], cols[1] - cols[0]))
+    return rows, cols, region if region.any() else None
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+AgroMonitor - Estadísticas de rasters con máscara de datos
+
+Motor común para resumir un raster de índice (NDVI, NDWI, NDSI...) usando
+la banda dataMask de Sentinel Hub en lugar de tratar el valor 0 como "sin
+dato": un índice puede valer 0 de verdad (suelo desnudo, borde agua/tierra).
+
+Todas las estadísticas salen de una única copia 1-D de los píxeles
+válidos, construida una sola vez:
+
+    válidos = dataMask & finito(valor)
+    media, mín, máx, desviación, histograma  -> sobre la copia
+    percentiles                              -> al final, reordenando la copia
+
+Así la memoria extra es una máscara booleana más un vector de píxeles
+válidos, independiente de cuántas estadísticas se pidan.
+"""
+
+import numpy as np
+
+# Percentiles por defecto (mismos que la Statistical API en modo 'stats')
+PERCENTILES = (10, 25, 50, 75, 90)
+
+# Histograma de índices normalizados: 20 clases de 0.1 entre -1 y 1
+HISTOGRAM_BINS = 20
+HISTOGRAM_RANGE = (-1.0, 1.0)
+
+def valid_mask(array, mask=None):
+    """
+    Máscara booleana de píxeles válidos
+
+    Args:
+        array: Raster 2-D del índice
+        mask: Banda dataMask (0 = sin dato) o None
+    """
+    valid = np.isfinite(array)
+    if mask is not None:
+        valid &= np.asarray(mask).reshape(valid.shape) != 0
+    return valid
+
+def masked_stats(array, mask=None, percentiles=PERCENTILES,
+                 bins=HISTOGRAM_BINS, value_range=HISTOGRAM_RANGE):
+    """
+    Calcula todas las estadísticas de un raster en una pasada
+
+    Args:
+        array: Raster 2-D del índice
+        mask: Banda dataMask (0 = sin dato) o None para usar solo valores finitos
+        percentiles: Percentiles a calcular
+        bins: Número de clases del histograma
+        value_range: Rango (mín, máx) del histograma
+
+    Returns:
+        dict: {'mean', 'min', 'max', 'std', 'percentiles', 'histogram',
+               'valid_fraction', 'count'} o None si no hay píxeles válidos
+    """
+    array = np.asarray(array)
+    if array.size == 0:
+        return None
+
+    valid = valid_mask(array, mask)
+    values = array[valid].astype(np.float64, copy=False)
+    count = values.size
+    if count == 0:
+        return None
+
+    counts, edges = np.histogram(values, bins=bins, range=value_range)
+    stats = {
+        'mean': float(values.mean()),
+        'min': float(values.min()),
+        'max': float(values.max()),
+        'std': float(values.std()),
+        'histogram': {
+            'edges': [round(float(edge), 4) for edge in edges],
+            'counts': counts.tolist()
+        },
+        'valid_fraction': count / array.size,
+        'count': int(count)
+    }
+
+    # Último paso: los percentiles reordenan la copia en su lugar
+    stats['percentiles'] = {
+        int(q): float(v)
+        for q, v in zip(percentiles, np.percentile(values, percentiles, overwrite_input=True))
+    }
+    return stats
+
+# ============================================================
+# ESTADÍSTICAS POR BLOQUES (AOI GRANDES)
+# ============================================================
+#
+# Para un raster que se descarga por teselas, cada bloque deja un
+# acumulador pequeño (conteo, media, M2, mín, máx, histograma) que se
+# fusiona con el resto (Chan et al.) y el bloque se descarta. La memoria
+# no depende del tamaño del AOI; los percentiles se interpolan del
+# histograma fusionado, con la resolución de sus clases.
+
+def partial_stats(array, mask=None, bins=HISTOGRAM_BINS, value_range=HISTOGRAM_RANGE):
+    """
+    Acumulador fusionable de un bloque del raster
+
+    Returns:
+        dict: {'count', 'mean', 'm2', 'min', 'max', 'histogram', 'pixels'}
+    """
+    array = np.asarray(array)
+    values = array[valid_mask(array, mask)].astype(np.float64, copy=False)
+    counts, _ = np.histogram(values, bins=bins, range=value_range)
+    partial = {
+        'count': int(values.size),
+        'mean': 0.0,
+        'm2': 0.0,
+        'min': np.inf,
+        'max': -np.inf,
+        'histogram': counts,
+        'pixels': int(array.size)
+    }
+    if values.size:
+        mean = values.mean()
+        partial.update(mean=float(mean), m2=float(((values - mean) ** 2).sum()),
+                       min=float(values.min()), max=float(values.max()))
+    return partial
+
+def merge_stats(a, b):
+    """Fusiona dos acumuladores de partial_stats (a puede ser None)"""
+    if a is None:
+        return b
+    count = a['count'] + b['count']
+    delta = b['mean'] - a['mean']
+    merged = {
+        'count': count,
+        'mean': a['mean'],
+        'm2': a['m2'] + b['m2'],
+        'min': min(a['min'], b['min']),
+        'max': max(a['max'], b['max']),
+        'histogram': a['histogram'] + b['histogram'],
+        'pixels': a['pixels'] + b['pixels']
+    }
+    if count:
+        merged['mean'] = a['mean'] + delta * b['count'] / count
+        merged['m2'] += delta * delta * a['count'] * b['count'] / count
+    return merged
+
+def histogram_percentiles(counts, edges, percentiles=PERCENTILES):
+    """Percentiles aproximados por interpolación lineal dentro de cada clase"""
+    cumulative = np.cumsum(counts)
+    total = cumulative[-1] if len(cumulative) else 0
+    result = {}
+    for q in percentiles:
+        target = q / 100 * total
+        i = min(int(np.searchsorted(cumulative, target, side='left')), len(counts) - 1)
+        previous = cumulative[i - 1] if i else 0
+        fraction = (target - previous) / counts[i] if counts[i] else 0.0
+        result[int(q)] = float(edges[i] + fraction * (edges[i + 1] - edges[i]))
+    return result
+
+def finalize_stats(partial, percentiles=PERCENTILES, value_range=HISTOGRAM_RANGE):
+    """
+    Convierte un acumulador fusionado al formato de masked_stats
+
+    Returns:
+        dict: mismas claves que masked_stats, o None si no hay píxeles válidos
+    """
+    if not partial or partial['count'] == 0:
+        return None
+    counts = np.asarray(partial['histogram'])
+    edges = np.linspace(value_range[0], value_range[1], len(counts) + 1)
+    quantiles = histogram_percentiles(counts, edges, percentiles)
+    return {
+        'mean': float(partial['mean']),
+        'min': float(partial['min']),
+        'max': float(partial['max']),
+        'std': float(np.sqrt(partial['m2'] / partial['count'])),
+        'histogram': {
+            'edges': [round(float(edge), 4) for edge in edges],
+            'counts': counts.tolist()
+        },
+        'valid_fraction': partial['count'] / partial['pixels'],
+        'count': int(partial['count']),
+        'percentiles': {
+            q: min(max(value, partial['min']), partial['max']) for q, value in quantiles.items()
+        }
+    }
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+AgroMonitor - Caché local de respuestas de Sentinel Hub
+
+El mosaico 'leastCC' de los últimos 30 días suele resolver a la misma
+adquisición durante varios días, así que volver a pedirlo cuesta PU sin
+aportar datos nuevos. Esta caché guarda los rasters devueltos por la
+Process API indexados por contenido:
+
+    clave = sha256(bbox, tamaño, evalscript, adquisición seleccionada)
+
+Mientras no aparezca una escena más limpia la clave no cambia y el
+colector reutiliza los rasters guardados sin hacer la solicitud.
+
+Los archivos son .npz comprimidos; el tamaño total está acotado por
+SENTINEL_CACHE_MAX_MB y se desalojan primero los menos usados (LRU por
+fecha de modificación, que se actualiza en cada acierto).
+"""
+
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+
+CACHE_DIR = os.environ.get(
+    'SENTINEL_CACHE_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'sentinel')
+)
+CACHE_MAX_BYTES = int(float(os.environ.get('SENTINEL_CACHE_MAX_MB', 200)) * 1024 * 1024)
+
+_lock = threading.Lock()
+
+def make_key(bbox, size, evalscript, acquisition_id, **extra):
+    """
+    Calcula la clave de contenido de una solicitud
+
+    Args:
+        bbox: [min_lon, min_lat, max_lon, max_lat]
+        size: (ancho, alto) en píxeles
+        evalscript: Texto del evalscript
+        acquisition_id: ID de la escena que selecciona el mosaico
+        extra: Parámetros adicionales que cambian la respuesta (p.ej. mosaicking_order)
+    """
+    payload = json.dumps({
+        'bbox': [round(float(v), 6) for v in bbox],
+        'size': list(size),
+        'evalscript': hashlib.sha256(evalscript.strip().encode('utf-8')).hexdigest(),
+        'acquisition': acquisition_id,
+        'extra': extra
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def _path(key):
+    return os.path.join(CACHE_DIR, key[:2], f"{key}.npz")
+
+def get(key):
+    """
+    Retorna los rasters guardados para la clave o None si no existen
+
+    Returns:
+        dict: {nombre_salida: np.ndarray}
+    """
+    path = _path(key)
+    try:
+        with np.load(path, allow_pickle=False) as stored:
+            arrays = {name: stored[name] for name in stored.files}
+        os.utime(path)  # Marca como usado recientemente
+        return arrays
+    except (OSError, ValueError) as e:
+        if os.path.exists(path):
+            print(f"[WARN] Entrada de caché corrupta, se descarta: {e}")
+            _remove(path)
+        return None
+
+def put(key, arrays):
+    """Guarda los rasters de una respuesta y aplica el límite de tamaño"""
+    path = _path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"[WARN] No se pudo escribir en caché: {e}")
+        _remove(tmp_path)
+        return
+    evict()
+
+def evict(max_bytes=None):
+    """Elimina las entradas menos usadas hasta quedar bajo el límite"""
+    if max_bytes is None:
+        max_bytes = CACHE_MAX_BYTES
+
+    with _lock:
+        entries = []
+        for root, _, files in os.walk(CACHE_DIR):
+            for name in files:
+                if not name.endswith('.npz'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= max_bytes:
+                break
+            _remove(path)
+            total -= size
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
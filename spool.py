@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""
+AgroMonitor - Spool local de escritura anticipada para la base de datos
+
+Cada fila que save_results destina a PostgreSQL se escribe primero aquí,
+en un segmento de solo-anexado (una línea JSON por fila):
+
+    data/spool/
+        open-<run>.jsonl                 segmento activo de una ejecución
+        <YYYYmmddTHHMMSSffffff>-<run>.jsonl   segmentos sellados, por orden
+        <...>-<run>.r<N>.jsonl           sellado, rechazado N veces por la BD
+        dead/                            segmentos en cuarentena
+
+seal() cierra el segmento activo y lo deja listo para replicar. Un hilo en
+segundo plano (el replicador) recorre los segmentos sellados en orden, los
+entrega a un destino (db_writer.write) y borra cada segmento solo después
+de que su transacción se confirmó. Si la BD no responde (Neon dormido o
+sin red), los segmentos quedan en disco y se reintentan con espera
+creciente; en la siguiente ejecución el replicador retoma donde quedó.
+
+Como las escrituras en la BD son upserts por clave natural, replicar dos
+veces el mismo segmento (p.ej. si el proceso muere entre el COMMIT y el
+borrado) no duplica filas.
+
+Si la BD no está disponible (sink retorna None) la pasada se detiene y se
+reintenta. Si la BD responde pero rechaza un segmento (sink lanza
+Rejected: un dato inválido, una tabla desconocida), se cuenta el intento
+en el nombre del archivo y la réplica sigue con los demás; tras
+SPOOL_MAX_ATTEMPTS rechazos el segmento pasa a dead/ para revisarlo a mano.
+
+El proceso dueño del segmento 'open-' lo mantiene bloqueado (flock). Al
+arrancar el replicador, un segmento 'open-' cuyo bloqueo se puede tomar
+quedó de una ejecución interrumpida (en este equipo o en otro runner, si
+el spool se restauró de la caché) y se sella; una última línea incompleta
+se descarta con aviso.
+"""
+
+import os
+import re
+import json
+import glob
+import time
+import uuid
+import threading
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: un archivo abierto no se puede renombrar, lo que ya protege
+    # el segmento activo de otro proceso
+    fcntl = None
+
+SPOOL_DIR = os.environ.get(
+    'SPOOL_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'spool')
+)
+DEAD_DIR = os.path.join(SPOOL_DIR, 'dead')
+# fsync tras cada fila: sobrevive a un corte de luz, no solo a una caída del proceso
+SPOOL_FSYNC = os.environ.get('SPOOL_FSYNC', '1') == '1'
+# Espera entre reintentos del replicador (se duplica hasta el máximo)
+SPOOL_RETRY_SECONDS = float(os.environ.get('SPOOL_RETRY_SECONDS', 5))
+SPOOL_RETRY_MAX_SECONDS = float(os.environ.get('SPOOL_RETRY_MAX_SECONDS', 300))
+# Rechazos de la BD antes de poner un segmento en cuarentena (dead/)
+SPOOL_MAX_ATTEMPTS = int(os.environ.get('SPOOL_MAX_ATTEMPTS', 3))
+
+# Identificador de esta ejecución (el PID se repite entre runners)
+RUN_ID = uuid.uuid4().hex[:12]
+
+_ATTEMPTS = re.compile(r'\.r(\d+)\.jsonl$')
+
+_lock = threading.Lock()          # segmento activo
+_replay_lock = threading.Lock()   # una sola réplica a la vez
+_active = None                    # archivo abierto del segmento activo
+_active_rows = 0
+_wakeup = threading.Event()
+_replayer = None
+
+class Rejected(Exception):
+    """La BD respondió pero no aceptó el segmento (reintentarlo no basta)"""
+
+def _active_path():
+    return os.path.join(SPOOL_DIR, f"open-{RUN_ID}.jsonl")
+
+def _try_lock(f):
+    """Bloqueo exclusivo sin espera; False si otro proceso lo tiene"""
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return False
+    return True
+
+def _json_default(value):
+    """Serializa fechas (isoformat) y escalares numpy (item)"""
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    if hasattr(value, 'item'):
+        return value.item()
+    raise TypeError(f"{type(value).__name__} no serializable")
+
+def append(table, row):
+    """
+    Escribe una fila en el segmento activo (durable al retornar)
+
+    Args:
+        table: Tabla de destino
+        row: {columna: valor}; fechas y escalares numpy se serializan
+    """
+    global _active, _active_rows
+    line = json.dumps({'table': table, 'row': row}, default=_json_default, ensure_ascii=False)
+    with _lock:
+        if _active is None:
+            os.makedirs(SPOOL_DIR, exist_ok=True)
+            _active = open(_active_path(), 'a', encoding='utf-8')
+            _try_lock(_active)
+        _active.write(line + '\n')
+        _active.flush()
+        if SPOOL_FSYNC:
+            os.fsync(_active.fileno())
+        _active_rows += 1
+
+def _sealed_name(run_id):
+    return os.path.join(SPOOL_DIR, f"{datetime.now().strftime('%Y%m%dT%H%M%S%f')}-{run_id}.jsonl")
+
+def seal():
+    """
+    Cierra el segmento activo y lo deja listo para replicar
+
+    Returns:
+        int: Filas selladas (0 si el segmento activo estaba vacío)
+    """
+    global _active, _active_rows
+    with _lock:
+        if _active is None:
+            return 0
+        # Renombrar antes de cerrar: mientras tanto el bloqueo sigue tomado
+        _active.flush()
+        os.replace(_active_path(), _sealed_name(RUN_ID))
+        _active.close()
+        rows, _active, _active_rows = _active_rows, None, 0
+    _wakeup.set()
+    return rows
+
+def recover():
+    """Sella los segmentos 'open-' que nadie tiene bloqueados"""
+    recovered = 0
+    for path in glob.glob(os.path.join(SPOOL_DIR, 'open-*.jsonl')):
+        if path == _active_path():
+            continue
+        try:
+            with open(path, 'a', encoding='utf-8') as f:
+                if not _try_lock(f):
+                    continue
+                os.replace(path, _sealed_name(os.path.basename(path)[5:-6]))
+        except OSError:
+            # Desapareció (otro proceso lo selló) o está en uso
+            continue
+        recovered += 1
+    if recovered:
+        print(f"[WARN] Spool: {recovered} segmento(s) de una ejecución interrumpida recuperados")
+    return recovered
+
+def segments():
+    """Segmentos sellados, del más antiguo al más reciente"""
+    return sorted(
+        path for path in glob.glob(os.path.join(SPOOL_DIR, '*.jsonl'))
+        if not os.path.basename(path).startswith('open-')
+    )
+
+def read(path):
+    """
+    Filas [(tabla, fila)] de un segmento; descarta una última línea incompleta
+
+    Raises:
+        Rejected: Si una línea completa no es una fila válida
+    """
+    records = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for number, line in enumerate(f, 1):
+            if not line.endswith('\n'):
+                print(f"[WARN] Spool: línea {number} incompleta en {os.path.basename(path)}, descartada")
+                break
+            try:
+                record = json.loads(line)
+                records.append((record['table'], record['row']))
+            except (ValueError, KeyError, TypeError) as e:
+                raise Rejected(f"línea {number} inválida: {e}")
+    return records
+
+def attempts(path):
+    """Rechazos ya registrados en el nombre del segmento"""
+    match = _ATTEMPTS.search(path)
+    return int(match.group(1)) if match else 0
+
+def _reject(path, error):
+    """Cuenta un rechazo; en cuarentena (dead/) al llegar a SPOOL_MAX_ATTEMPTS"""
+    count = attempts(path) + 1
+    base = _ATTEMPTS.sub('.jsonl', path)
+    if count >= SPOOL_MAX_ATTEMPTS:
+        os.makedirs(DEAD_DIR, exist_ok=True)
+        os.replace(path, os.path.join(DEAD_DIR, os.path.basename(base)))
+        print(f"[ERROR] Spool: {os.path.basename(base)} rechazado {count} veces, en cuarentena ({error})")
+        return True
+    os.replace(path, f"{base[:-len('.jsonl')]}.r{count}.jsonl")
+    print(f"[WARN] Spool: {os.path.basename(base)} rechazado ({count}/{SPOOL_MAX_ATTEMPTS}): {error}")
+    return False
+
+def pending():
+    """Filas en el spool aún no replicadas (activo + sellados)"""
+    total = 0
+    for path in segments():
+        with open(path, 'rb') as f:
+            total += sum(1 for _ in f)
+    with _lock:
+        return total + _active_rows
+
+def replay(sink):
+    """
+    Entrega los segmentos sellados a sink en orden, uno por transacción
+
+    Un segmento rechazado no detiene a los siguientes (ver Rejected).
+
+    Args:
+        sink: función(records) -> dict o None; None indica que la BD no
+              está disponible (se detiene la pasada); lanza Rejected si la
+              BD no aceptó el segmento
+
+    Returns:
+        dict: {'segments', 'rows', 'rejected', 'quarantined', 'failed'}
+              de esta pasada
+    """
+    summary = {'segments': 0, 'rows': 0, 'rejected': 0, 'quarantined': 0, 'failed': False}
+    with _replay_lock:
+        for path in segments():
+            try:
+                records = read(path)
+                if records and sink(records) is None:
+                    summary['failed'] = True
+                    break
+            except Rejected as e:
+                summary['rejected'] += 1
+                summary['quarantined'] += _reject(path, e)
+                continue
+            os.remove(path)
+            summary['segments'] += 1
+            summary['rows'] += len(records)
+    return summary
+
+def _run(sink):
+    delay = SPOOL_RETRY_SECONDS
+    while True:
+        _wakeup.clear()
+        try:
+            summary = replay(sink)
+        except Exception as e:
+            print(f"[ERROR] Spool: réplica interrumpida: {e}")
+            summary = {'segments': 0, 'rows': 0, 'rejected': 0, 'quarantined': 0, 'failed': True}
+        if summary['segments']:
+            print(f"[OK] Spool: {summary['rows']} fila(s) de {summary['segments']} segmento(s) replicadas en la BD")
+        # Un rechazo se reintenta con la misma espera que una BD caída
+        if summary['failed'] or summary['rejected'] > summary['quarantined']:
+            _wakeup.wait(delay)
+            delay = min(delay * 2, SPOOL_RETRY_MAX_SECONDS)
+            continue
+        delay = SPOOL_RETRY_SECONDS
+        _wakeup.wait()
+
+def start_replayer(sink):
+    """Arranca (una vez por proceso) el hilo que vacía el spool en la BD"""
+    global _replayer
+    with _lock:
+        if _replayer is not None:
+            return _replayer
+        os.makedirs(SPOOL_DIR, exist_ok=True)
+        recover()
+        _replayer = threading.Thread(target=_run, args=(sink,), name='spool-replayer', daemon=True)
+        _replayer.start()
+    return _replayer
+
+def drain(timeout=None):
+    """
+    Espera a que el replicador vacíe los segmentos sellados
+
+    Returns:
+        bool: True si no quedan segmentos pendientes
+    """
+    if _replayer is None:
+        return not segments()
+    _wakeup.set()
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while segments():
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and remaining <= 0:
+            return False
+        time.sleep(0.1 if remaining is None else min(0.1, remaining))
+    return True
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Pruebas del backfill: reanudación tras fallos parciales y conteo de
+ventanas pendientes cuando se agota la cuota
+
+Las llamadas a Sentinel Hub, la cuota y la BD se reemplazan por funciones
+locales; solo se ejercita la planificación de ventanas y el estado en disco.
+"""
+
+import os
+import sys
+import types
+
+import pytest
+
+pytest.importorskip('numpy')
+pytest.importorskip('cdsapi')
+pytest.importorskip('sentinelhub')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# db_config lo genera el workflow con las credenciales; aquí no hay BD
+sys.modules.setdefault('db_config', types.SimpleNamespace(get_connection=lambda: None))
+
+import copernicus_collector as cc
+
+START, END = '2026-01-01', '2026-01-21'   # 4 ventanas de 5 días
+BBOX = [-81.2, 8.4, -81.1, 8.5]
+GROUPS = [
+    {'id': 'g1', 'bbox': BBOX, 'farms': [{'id': 'f1', 'bbox': BBOX}]},
+    {'id': 'g2', 'bbox': BBOX, 'farms': [{'id': 'f2', 'bbox': BBOX}]},
+]
+
+@pytest.fixture
+def collector(tmp_path, monkeypatch):
+    """Backfill sin red: registra las ventanas procesadas y guardadas"""
+    calls = {'windows': [], 'saved': [], 'fail': set(), 'quota': None}
+
+    def reserve(operation):
+        if calls['quota'] is not None:
+            if calls['quota'] <= 0:
+                return None
+            calls['quota'] -= 1
+        return {'operation': operation}
+
+    def window(group, window_start, window_end, indices):
+        key = (str(window_start.date()), group['id'])
+        calls['windows'].append(key)
+        if key in calls['fail']:
+            return None
+        scene = {'id': f"S2_{key[0]}", 'datetime': f"{key[0]}T15:00:00Z"}
+        return {'scene': scene, 'results': {farm['id']: {'ndvi': {}} for farm in group['farms']}}
+
+    monkeypatch.setattr(cc, 'BACKFILL_STATE_FILE', str(tmp_path / 'backfill_state.json'))
+    monkeypatch.setattr(cc, 'group_farms', lambda farms: GROUPS)
+    monkeypatch.setattr(cc, 'reserve_quota', reserve)
+    monkeypatch.setattr(cc, '_backfill_window', window)
+    monkeypatch.setattr(cc, '_settle_task_quota', lambda *args, **kwargs: None)
+    monkeypatch.setattr(cc, '_archive_indices', lambda *args: None)
+    monkeypatch.setattr(cc, 'save_results',
+                        lambda result, polygon_id, **kwargs: calls['saved'].append(polygon_id))
+    monkeypatch.setattr(cc, 'flush_results', lambda: True)
+    monkeypatch.setattr(cc, 'drain_results', lambda timeout=None: True)
+    monkeypatch.setattr(cc, 'print_quota_status', lambda: None)
+    monkeypatch.setattr(cc.db_writer, 'start', lambda: None)
+    return calls
+
+def test_resume_after_partial_failure(collector):
+    collector['fail'] = {('2026-01-06', 'g2')}
+    counts = cc.backfill(START, END, window_days=5, farms=[], workers=2)
+    assert counts == {'done': 7, 'empty': 0, 'failed': 1, 'pending': 0}
+
+    # La segunda ejecución solo repite la ventana que falló
+    collector['fail'] = set()
+    collector['windows'].clear()
+    counts = cc.backfill(START, END, window_days=5, farms=[], workers=2)
+    assert collector['windows'] == [('2026-01-06', 'g2')]
+    assert counts == {'done': 1, 'empty': 0, 'failed': 0, 'pending': 0}
+
+    # Todo terminado: nada que pedir
+    collector['windows'].clear()
+    counts = cc.backfill(START, END, window_days=5, farms=[], workers=2)
+    assert collector['windows'] == []
+    assert counts == {'done': 0, 'empty': 0, 'failed': 0, 'pending': 0}
+
+def test_pending_counts_windows_left_without_quota(collector):
+    collector['quota'] = 3
+    counts = cc.backfill(START, END, window_days=5, farms=[], workers=1)
+    # 8 ventanas x grupo: 3 con cuota, el resto queda pendiente
+    assert counts == {'done': 3, 'empty': 0, 'failed': 0, 'pending': 5}
+    assert len(collector['windows']) == 3
+
+    collector['quota'] = None
+    collector['windows'].clear()
+    counts = cc.backfill(START, END, window_days=5, farms=[], workers=2)
+    assert counts == {'done': 5, 'empty': 0, 'failed': 0, 'pending': 0}
+    assert len(collector['windows']) == 5
+    assert len(collector['saved']) == 8
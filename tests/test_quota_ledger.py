@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Pruebas del libro de cuota: respaldo JSON cuando la BD falla a mitad de
+la ejecución
+
+La BD se simula con funciones que lanzan errores; el respaldo JSON usa un
+quota_tracker.json temporal.
+"""
+
+import os
+import sys
+import json
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# db_config lo genera el workflow con las credenciales; aquí no hay BD
+sys.modules.setdefault('db_config', types.SimpleNamespace(get_connection=lambda: None))
+
+import quota_ledger
+
+@pytest.fixture
+def ledger(tmp_path, monkeypatch):
+    """Libro sin BD, con quota_tracker.json temporal y estado del proceso limpio"""
+    monkeypatch.setattr(quota_ledger, 'QUOTA_FILE', str(tmp_path / 'quota_tracker.json'))
+    monkeypatch.setattr(quota_ledger, '_get_conn', lambda: None)
+    monkeypatch.setattr(quota_ledger, '_backend', None)
+    monkeypatch.setattr(quota_ledger, '_cache', None)
+    monkeypatch.setattr(quota_ledger, '_cost_model', None)
+    return quota_ledger
+
+def _stored(ledger):
+    with open(ledger.QUOTA_FILE, 'r') as f:
+        return json.load(f)
+
+def _db_state(ledger, used=100.0, reserved=0.0):
+    """Simula un libro ya cargado desde la BD"""
+    ledger._backend = 'db'
+    ledger._cache = dict(ledger.DEFAULT_LIMITS, current_month=ledger._current_month(),
+                         processing_units_used=used, requests_used=10,
+                         processing_units_reserved=reserved, requests_reserved=1 if reserved else 0,
+                         collections_today=0, last_collection_date=None)
+
+def _db_down(*args, **kwargs):
+    raise RuntimeError('conexión perdida')
+
+def test_settle_falls_back_to_json_when_db_fails(ledger, monkeypatch):
+    _db_state(ledger, used=100.0, reserved=40.0)
+    monkeypatch.setattr(ledger, '_db_settle', _db_down)
+
+    quota = ledger.settle({'id': 7, 'operation': 'map_rgb', 'pu': 40.0}, 35.0,
+                          farm_shares={'f1': 1.0})
+
+    assert ledger._backend == 'json'
+    # Lo leído de la BD más lo gastado en esta solicitud
+    assert quota['processing_units_used'] == 135.0
+    assert quota['processing_units_reserved'] == 0
+    stored = _stored(ledger)
+    assert stored['processing_units_used'] == 135.0
+    assert stored['requests_used'] == 11
+    assert stored['farm_usage'] == {'f1': {'pu': 35.0, 'requests': 1}}
+
+def test_release_falls_back_to_json_when_db_fails(ledger, monkeypatch):
+    _db_state(ledger, used=100.0, reserved=40.0)
+    monkeypatch.setattr(ledger, '_db_settle', _db_down)
+
+    ledger.release({'id': 7, 'operation': 'map_rgb', 'pu': 40.0})
+
+    assert ledger._backend == 'json'
+    assert ledger._cache['processing_units_reserved'] == 0
+    assert ledger._cache['requests_reserved'] == 0
+    assert _stored(ledger)['processing_units_used'] == 100.0
+
+def test_tiled_settle_counts_every_request_and_samples_per_tile(ledger):
+    ledger.load()
+    reservation = ledger.reserve('spectral_indices', 100)
+    samples = [('spectral_indices:2500x2500', 30.0), ('spectral_indices:2500x2500', 34.0),
+               ('spectral_indices:1200x2500', 20.0)]
+
+    quota = ledger.settle(reservation, 84.0, samples, requests=3)
+
+    assert quota['requests_used'] == 3
+    assert quota['processing_units_used'] == 84.0
+    # Una entrada por forma de tesela, no una forma concatenada
+    assert _stored(ledger)['cost_model'] == {
+        'spectral_indices:2500x2500': {'avg_pu': 32.0, 'samples': 2},
+        'spectral_indices:1200x2500': {'avg_pu': 20.0, 'samples': 1},
+    }
+
+def test_json_reserve_settle_release_accounting(ledger):
+    quota = ledger.load()
+    assert ledger._backend == 'json'
+    limit = quota['monthly_limit_pu']
+
+    first = ledger.reserve('map_rgb', 50)
+    second = ledger.reserve('spectral_indices', 40)
+    assert ledger.remaining() == (limit - 90, quota['monthly_limit_requests'] - 2)
+
+    # Se liquida con el costo real, no con lo reservado
+    quota = ledger.settle(first, 42.0, [('map_rgb:512x512', 42.0)], {'f1': 0.5, 'f2': 0.5})
+    assert quota['processing_units_used'] == 42.0
+    assert quota['processing_units_reserved'] == 40
+    assert quota['requests_reserved'] == 1
+
+    ledger.release(second)
+    assert ledger.remaining() == (limit - 42.0, quota['monthly_limit_requests'] - 1)
+
+    stored = _stored(ledger)
+    assert stored['processing_units_used'] == 42.0
+    assert stored['requests_used'] == 1
+    assert stored['farm_usage'] == {'f1': {'pu': 21.0, 'requests': 1}, 'f2': {'pu': 21.0, 'requests': 1}}
+    assert stored['cost_model'] == {'map_rgb:512x512': {'avg_pu': 42.0, 'samples': 1}}
+    # Las reservas solo viven en memoria
+    assert 'processing_units_reserved' not in stored
+
+def test_reserve_denied_without_quota(ledger):
+    limit = ledger.load()['monthly_limit_pu']
+    assert ledger.reserve('map_rgb', limit - 10) is not None
+    assert ledger.reserve('map_rgb', 20) is None
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Pruebas del spool: recuperación de segmentos sin sellar y cuarentena de
+segmentos que la BD rechaza
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import spool
+
+@pytest.fixture
+def spool_dir(tmp_path, monkeypatch):
+    """Spool en un directorio temporal, sin segmento activo ni replicador"""
+    monkeypatch.setattr(spool, 'SPOOL_DIR', str(tmp_path))
+    monkeypatch.setattr(spool, 'DEAD_DIR', str(tmp_path / 'dead'))
+    monkeypatch.setattr(spool, '_active', None)
+    monkeypatch.setattr(spool, '_active_rows', 0)
+    yield tmp_path
+    if spool._active is not None:
+        spool._active.close()
+
+def _segment(rows):
+    """Sella un segmento con las filas [(tabla, fila)]"""
+    for table, row in rows:
+        spool.append(table, row)
+    spool.seal()
+    return spool.segments()[-1]
+
+def test_recover_seals_unlocked_segment_and_drops_partial_line(spool_dir):
+    with open(spool_dir / 'open-deadrun.jsonl', 'w', encoding='utf-8') as f:
+        f.write('{"table": "soil_data", "row": {"polygon_id": "a"}}\n')
+        f.write('{"table": "soil_data", "row": {"polygon_id": "b"}}\n')
+        f.write('{"table": "soil_da')   # la caída cortó la última línea
+
+    assert spool.recover() == 1
+    assert not list(spool_dir.glob('open-*'))
+    (segment,) = spool.segments()
+    assert segment.endswith('-deadrun.jsonl')
+    assert spool.read(segment) == [('soil_data', {'polygon_id': 'a'}), ('soil_data', {'polygon_id': 'b'})]
+
+@pytest.mark.skipif(spool.fcntl is None, reason='flock no disponible')
+def test_recover_skips_segment_locked_by_running_process(spool_dir):
+    path = spool_dir / 'open-liverun.jsonl'
+    with open(path, 'a', encoding='utf-8') as owner:
+        assert spool._try_lock(owner)
+        assert spool.recover() == 0
+        assert path.exists()
+    # El dueño terminó: ya se puede recuperar
+    assert spool.recover() == 1
+
+def test_rejected_segment_is_quarantined_and_replay_continues(spool_dir, monkeypatch):
+    monkeypatch.setattr(spool, 'SPOOL_MAX_ATTEMPTS', 2)
+    bad = _segment([('weather_data', {'timestamp': 'no es fecha'})])
+    _segment([('weather_data', {'timestamp': '2026-10-18T10:00:00'})])
+    written = []
+
+    def sink(records):
+        if records[0][1]['timestamp'] == 'no es fecha':
+            raise spool.Rejected('invalid input syntax for type timestamp')
+        written.extend(records)
+        return {'weather_data': len(records)}
+
+    summary = spool.replay(sink)
+    assert summary == {'segments': 1, 'rows': 1, 'rejected': 1, 'quarantined': 0, 'failed': False}
+    assert len(written) == 1
+    (pending,) = spool.segments()
+    assert spool.attempts(pending) == 1
+
+    # La BD caída (sink -> None) no cuenta como rechazo
+    assert spool.replay(lambda records: None)['failed']
+    assert spool.attempts(spool.segments()[0]) == 1
+
+    summary = spool.replay(sink)
+    assert summary['quarantined'] == 1
+    assert spool.segments() == []
+    assert os.listdir(spool.DEAD_DIR) == [os.path.basename(bad)]
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+AgroMonitor - Máscaras rasterizadas de zonas de cultivo
+
+Cada finca de polygon_config.json puede declarar 'zonas': un polígono
+GeoJSON por cultivo (plátano, hortalizas, tubérculos...), levantado en
+campo; una zona con "placeholder": true (borrador sin medir) se ignora.
+Sin zonas no se generan estadísticas por cultivo. Para calcular
+estadísticas por cultivo sin pedir más datos a Sentinel Hub, cada zona se
+rasteriza una vez sobre la grilla del raster de la finca y la máscara
+booleana se reutiliza en todas las ejecuciones:
+
+    clave = sha256(geometría de la zona, bbox de la finca, forma del raster)
+
+Las máscaras se guardan en memoria y en disco (.npz junto a la caché de
+Sentinel); mientras no cambie la geometría ni el tamaño del raster la
+rasterización no se repite.
+"""
+
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+
+MASK_CACHE_DIR = os.environ.get(
+    'ZONE_MASK_CACHE_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'zones')
+)
+
+_memo = {}
+_lock = threading.Lock()
+
+def rings(geometry):
+    """Anillos (listas de [lon, lat]) de un Polygon o MultiPolygon GeoJSON"""
+    if geometry['type'] == 'Polygon':
+        return list(geometry['coordinates'])
+    if geometry['type'] == 'MultiPolygon':
+        return [ring for polygon in geometry['coordinates'] for ring in polygon]
+    raise ValueError(f"Geometría no soportada: {geometry['type']}")
+
+def rasterize(geometry, bbox, shape):
+    """
+    Rasteriza una geometría sobre la grilla de un raster WGS84
+
+    Se evalúa el centro de cada píxel con la regla par-impar, vectorizada
+    sobre todos los píxeles a la vez (los huecos del polígono quedan fuera).
+
+    Args:
+        geometry: Polygon o MultiPolygon GeoJSON en lon/lat
+        bbox: [min_lon, min_lat, max_lon, max_lat] del raster
+        shape: (alto, ancho) del raster
+
+    Returns:
+        np.ndarray: máscara booleana (alto, ancho)
+    """
+    height, width = shape
+    lon_step = (bbox[2] - bbox[0]) / width
+    lat_step = (bbox[3] - bbox[1]) / height
+    lons = bbox[0] + (np.arange(width) + 0.5) * lon_step
+    lats = bbox[3] - (np.arange(height) + 0.5) * lat_step
+    x = lons[np.newaxis, :]
+    y = lats[:, np.newaxis]
+
+    inside = np.zeros(shape, dtype=bool)
+    for ring in rings(geometry):
+        ring = np.asarray(ring, dtype=np.float64)
+        for (xi, yi), (xj, yj) in zip(ring, np.roll(ring, -1, axis=0)):
+            if yi == yj:
+                continue
+            crosses = (yi > y) != (yj > y)
+            x_cross = xi + (y - yi) * (xj - xi) / (yj - yi)
+            inside ^= crosses & (x < x_cross)
+    return inside
+
+def _key(geometry, bbox, shape):
+    payload = json.dumps({
+        'geometry': geometry,
+        'bbox': [round(float(v), 6) for v in bbox],
+        'shape': list(shape)
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def get_mask(geometry, bbox, shape):
+    """Máscara de una zona, desde memoria, disco o rasterizándola"""
+    key = _key(geometry, bbox, shape)
+    with _lock:
+        if key in _memo:
+            return _memo[key]
+
+    path = os.path.join(MASK_CACHE_DIR, f"{key}.npz")
+    mask = None
+    try:
+        with np.load(path, allow_pickle=False) as stored:
+            mask = stored['mask']
+    except (OSError, ValueError, KeyError):
+        mask = rasterize(geometry, bbox, shape)
+        try:
+            os.makedirs(MASK_CACHE_DIR, exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                np.savez_compressed(f, mask=mask)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"[WARN] No se pudo guardar la máscara de zona: {e}")
+
+    with _lock:
+        _memo[key] = mask
+    return mask
+
+def zone_masks(farm, shape):
+    """
+    Máscaras de todas las zonas de una finca para un raster de la forma dada
+
+    Returns:
+        dict: {cultivo: np.ndarray booleano}
+    """
+    return {
+        zone['cultivo']: get_mask(zone['polygon'], farm['bbox'], shape)
+        for zone in farm.get('zonas', [])
+    }